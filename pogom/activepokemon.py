@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import math
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class ActivePokemonIndex(object):
+    """Active Pokemon kept in memory on a uniform lat/lng grid.
+
+    Rows are the same dicts that are upserted into the pokemon table, and
+    each one is dropped once its disappear_time has passed. Queries mirror
+    Pokemon.get_active() and Pokemon.get_active_by_id().
+    """
+
+    def __init__(self, cell_size=0.01):
+        # Roughly 1.1km per cell at the equator.
+        self.cell_size = cell_size
+        self.pokemon = {}
+        self.cells = {}
+        self.expiry = []
+        self.loaded = False
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.pokemon)
+
+    def load(self, rows):
+        # Rows already added by the db updater are newer than what was
+        # read from the database, so they are kept.
+        with self.lock:
+            if self.loaded:
+                return
+            for row in rows:
+                if row['encounter_id'] not in self.pokemon:
+                    self._add(row)
+            self.loaded = True
+        log.info('Loaded %d active Pokemon into memory.', len(self.pokemon))
+
+    def update(self, rows):
+        now_date = datetime.utcnow()
+        with self.lock:
+            for row in rows:
+                if row['disappear_time'] > now_date:
+                    self._add(row)
+            self._expire(now_date)
+
+    def get_active(self, swLat, swLng, neLat, neLng, timestamp=0,
+                   oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None,
+                   exclude=None):
+        now_date = datetime.utcnow()
+        box = None
+        old_box = None
+        since = None
+
+        if swLat and swLng and neLat and neLng:
+            box = (float(swLat), float(swLng), float(neLat), float(neLng))
+            if timestamp > 0:
+                # If timestamp is known only load modified Pokemon.
+                since = datetime.utcfromtimestamp(timestamp / 1000)
+            elif oSwLat and oSwLng and oNeLat and oNeLng:
+                # Only send newly uncovered Pokemon.
+                old_box = (float(oSwLat), float(oSwLng),
+                           float(oNeLat), float(oNeLng))
+
+        result = []
+        with self.lock:
+            self._expire(now_date)
+            for row in self._rows(box):
+                if exclude and row['pokemon_id'] in exclude:
+                    continue
+                if since and not row['last_modified'] > since:
+                    continue
+                if old_box and self._in_box(row, old_box):
+                    continue
+                result.append(row.copy())
+
+        return result
+
+    def get_active_by_id(self, ids, swLat, swLng, neLat, neLng):
+        now_date = datetime.utcnow()
+        box = None
+        if swLat and swLng and neLat and neLng:
+            box = (float(swLat), float(swLng), float(neLat), float(neLng))
+
+        ids = set(ids)
+        with self.lock:
+            self._expire(now_date)
+            return [row.copy() for row in self._rows(box)
+                    if row['pokemon_id'] in ids]
+
+    def _cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def _add(self, row):
+        encounter_id = row['encounter_id']
+        self._discard(encounter_id)
+
+        row = row.copy()
+        if row.get('last_modified') is None:
+            row['last_modified'] = datetime.utcnow()
+
+        cell = self._cell(row['latitude'], row['longitude'])
+        self.pokemon[encounter_id] = row
+        self.cells.setdefault(cell, set()).add(encounter_id)
+        heapq.heappush(self.expiry, (row['disappear_time'], encounter_id))
+
+    def _discard(self, encounter_id):
+        row = self.pokemon.pop(encounter_id, None)
+        if row is None:
+            return
+
+        cell = self._cell(row['latitude'], row['longitude'])
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(encounter_id)
+            if not members:
+                del self.cells[cell]
+
+    def _expire(self, now_date):
+        while self.expiry and self.expiry[0][0] <= now_date:
+            disappear_time, encounter_id = heapq.heappop(self.expiry)
+            row = self.pokemon.get(encounter_id)
+            # Updated rows leave stale heap entries behind, skip those.
+            if row is not None and row['disappear_time'] <= now_date:
+                self._discard(encounter_id)
+
+    @staticmethod
+    def _in_box(row, box):
+        return (box[0] <= row['latitude'] <= box[2] and
+                box[1] <= row['longitude'] <= box[3])
+
+    def _rows(self, box):
+        if box is None:
+            return self.pokemon.values()
+
+        min_x, min_y = self._cell(box[0], box[1])
+        max_x, max_y = self._cell(box[2], box[3])
+
+        # Zoomed out views span more grid cells than there are occupied
+        # ones, walk the occupied cells instead.
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            cells = [c for c in self.cells
+                     if min_x <= c[0] <= max_x and min_y <= c[1] <= max_y]
+        else:
+            cells = [(x, y) for x in range(min_x, max_x + 1)
+                     for y in range(min_y, max_y + 1)
+                     if (x, y) in self.cells]
+
+        rows = []
+        for cell in cells:
+            for encounter_id in self.cells[cell]:
+                row = self.pokemon[encounter_id]
+                if self._in_box(row, box):
+                    rows.append(row)
+        return rows
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import requests
+
+from Queue import Queue, Full, Empty
+from threading import Lock
+from urllib import urlencode
+
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+# Measurement protocol endpoint taking up to 20 hits per request.
+GA_BATCH_URL = 'https://www.google-analytics.com/batch'
+GA_BATCH_SIZE = 20
+
+
+class AnalyticsSender(object):
+    """Google Analytics events sent from a background thread in batches.
+
+    track() only queues the hit, so a slow analytics round trip doesn't add
+    to the latency of device requests. Hits are dropped when the queue is
+    full.
+    """
+
+    def __init__(self, url=GA_BATCH_URL, queue_size=1000,
+                 batch_size=GA_BATCH_SIZE, timeout=5):
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.queue = Queue(maxsize=queue_size)
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lock = Lock()
+
+        # One pooled session, keeping the connection alive between batches.
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=1))
+
+    def track(self, hit):
+        try:
+            self.queue.put_nowait(hit)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'queued': self.queue.qsize()
+            }
+
+    # Blocks until there's a hit, then sends it with whatever else is
+    # already queued, up to batch_size hits.
+    def send_queued(self):
+        hits = [self.queue.get()]
+        while len(hits) < self.batch_size:
+            try:
+                hits.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        payload = '\n'.join(
+            urlencode([(k, v) for k, v in sorted(hit.items())
+                       if v is not None])
+            for hit in hits)
+        try:
+            response = self.session.post(self.url, data=payload,
+                                         timeout=self.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            with self.lock:
+                self.failed += len(hits)
+            log.warning('Failed to send %d analytics events: %s', len(hits),
+                        e)
+            return False
+
+        with self.lock:
+            self.sent += len(hits)
+        log.debug('Sent %d analytics events (%s).', len(hits),
+                  self.get_stats())
+        return True
+
+
+def analytics_sender(analytics):
+    while True:
+        try:
+            analytics.send_queued()
+        except Exception as e:
+            log.exception('Exception in analytics_sender: %s', repr(e))
+            time.sleep(5)
@@ -12,15 +12,15 @@ from datetime import datetime, timedelta
 from s2sphere import LatLng
 from bisect import bisect_left
 from flask import Flask, abort, jsonify, render_template, request,\
-    make_response, send_from_directory, json, send_file, redirect, session
+    make_response, send_from_directory, json, redirect, session,\
+    Response
 from flask.json import JSONEncoder
 from flask_compress import Compress
-from pogom.transform import jitter_location
+from pogom.transform import jitter_location, haversine_distance
 from pogom.dyn_img import get_gym_icon
 from pogom.weather import get_weather_cells, get_s2_coverage, get_weather_alerts
 from base64 import b64decode
 
-import gpxpy
 
 import s2sphere
 from peewee import DeleteQuery
@@ -29,48 +29,111 @@ from .userAuth import DiscordAPI
 from .models import (Pokemon, Gym, GymDetails, Pokestop, Raid, ScannedLocation,
                      MainWorker, WorkerStatus, Token,
                      SpawnPoint, DeviceWorker, SpawnpointDetectionData, ScanSpawnPoint, PokestopMember,
-                     Quest, PokestopDetails, GymMember, GymPokemon, Weather)
+                     Quest, PokestopDetails, GymMember, GymPokemon, Weather,
+                     add_geocells, remember_upserted)
 from .utils import (get_args, get_pokemon_name, get_pokemon_types,
                     now, dottedQuadToNum, date_secs, calc_pokemon_level,
-                    get_timezone_offset)
+                    get_timezone_offset, rarity_table)
 from .transform import transform_from_wgs_to_gcj
 from .blacklist import fingerprints, get_ip_blacklist
 from .customLog import printPokemon
+from .routecache import RouteCache
+from .gpxroutes import GpxRoutes
+from .claims import ClaimTable
+from .endpoints import (get_endpoint_spec, pogo_version, requested_endpoint,
+                        typed_params)
+from .analytics import AnalyticsSender
+from .mapstream import map_stream
+from .devices import DeviceRegistry
 import re
 import json
-from werkzeug.datastructures import MultiDict
 
-import geopy
 
-from google.protobuf.json_format import MessageToJson
+from google.protobuf.json_format import MessageToDict
 from protos.pogoprotos.networking.responses.fort_search_response_pb2 import FortSearchResponse
 from protos.pogoprotos.networking.responses.encounter_response_pb2 import EncounterResponse
-from protos.pogoprotos.networking.responses.get_map_objects_response_pb2 import GetMapObjectsResponse, _GETMAPOBJECTSRESPONSE_TIMEOFDAY
+from protos.pogoprotos.networking.responses.get_map_objects_response_pb2 import GetMapObjectsResponse
 from protos.pogoprotos.networking.responses.gym_get_info_response_pb2 import GymGetInfoResponse
 from protos.pogoprotos.networking.responses.fort_details_response_pb2 import FortDetailsResponse
 from protos.pogoprotos.networking.responses.get_player_response_pb2 import GetPlayerResponse
-from protos.pogoprotos.map.weather.display_weather_pb2 import _DISPLAYWEATHER_DISPLAYLEVEL
-from protos.pogoprotos.map.weather.gameplay_weather_pb2 import _GAMEPLAYWEATHER_WEATHERCONDITION
-from protos.pogoprotos.map.weather.weather_alert_pb2 import _WEATHERALERT_SEVERITY
+from protos.pogoprotos.map.fort.fort_type_pb2 import CHECKPOINT
 
-from protos.pogoprotos.enums.team_color_pb2 import _TEAMCOLOR
 from protos.pogoprotos.enums.pokemon_id_pb2 import _POKEMONID
-from protos.pogoprotos.enums.pokemon_move_pb2 import _POKEMONMOVE
-from protos.pogoprotos.enums.raid_level_pb2 import _RAIDLEVEL
-from protos.pogoprotos.enums.gender_pb2 import _GENDER
-from protos.pogoprotos.enums.form_pb2 import _FORM
-from protos.pogoprotos.enums.costume_pb2 import _COSTUME
-from protos.pogoprotos.enums.weather_condition_pb2 import _WEATHERCONDITION
-from protos.pogoprotos.enums.quest_type_pb2 import _QUESTTYPE
-from protos.pogoprotos.data.quests.quest_reward_pb2 import _QUESTREWARD_TYPE
-from protos.pogoprotos.inventory.item.item_id_pb2 import _ITEMID
-from protos.pogoprotos.data.quests.quest_condition_pb2 import _QUESTCONDITION_CONDITIONTYPE
-from protos.pogoprotos.enums.pokemon_type_pb2 import _POKEMONTYPE
-from protos.pogoprotos.enums.activity_type_pb2 import _ACTIVITYTYPE
+from protos.pogoprotos.inventory.item.item_id_pb2 import _ITEMID, ITEM_TROY_DISK
 
 log = logging.getLogger(__name__)
 compress = Compress()
 
+# Gym names that are only coordinates, for /feedgym?unknown_name=true.
+COORDS_NAME = re.compile('^.*\..*,.*\..*$')
+
+# Weather shown next to boosted Pokemon in /feedpokemon.
+WEATHER_TYPES = {
+    0: {
+        "name": "None"
+    },
+    1: {
+        "name": "Clear",
+        "emoji": u"\u2600",
+        "boost": "grass,ground,fire"
+    },
+    2: {
+        "name": "Rainy",
+        "emoji": u"\u2614",
+        "boost": "water,electric,bug"
+    },
+    3: {
+        "name": "PartlyCloudy",
+        "emoji": u"\U0001F324",
+        "boost": "normal,rock"
+    },
+    4: {
+        "name": "Overcast",
+        "emoji": u"\u2601",
+        "boost": "fairy,fighting,poison"
+    },
+    5: {
+        "name": "Windy",
+        "emoji": u"\U0001F32C",
+        "boost": "dragon,flying,psychic"
+    },
+    6: {
+        "name": "Snow",
+        "emoji": u"\u2744",
+        "boost": "ice,steel"
+    },
+    7: {
+        "name": "Fog",
+        "emoji": u"\U0001F32B",
+        "boost": "dark,ghost"
+    }
+}
+
+
+# Joins feed lines into chunks of a few hundred lines for streaming.
+def feed_chunks(lines, size=200):
+    chunk = []
+    first = True
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield ('' if first else '\n') + '\n'.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else '\n') + '\n'.join(chunk)
+
+
+# Streams the lines of a text feed. With --feed-etag the feed is sent whole
+# with an ETag instead, so clients polling an unchanged feed get a 304.
+def feed_response(lines):
+    if not get_args().feed_etag:
+        return Response(feed_chunks(lines))
+
+    response = Response(''.join(feed_chunks(lines)))
+    response.add_etag()
+    return response.make_conditional(request)
+
 
 def convert_pokemon_list(pokemon):
     args = get_args()
@@ -95,6 +158,12 @@ def convert_pokemon_list(pokemon):
     return pokemon
 
 
+# The smallest of the given point limits, where booleans mean no limit.
+def route_limit(*limits):
+    limits = [limit for limit in limits if not isinstance(limit, bool)]
+    return min(limits) if limits else None
+
+
 class Pogom(Flask):
 
     def __init__(self, import_name, **kwargs):
@@ -154,6 +223,7 @@ class Pogom(Flask):
             self.route("/loc/<endpoint>", methods=['GET', 'POST'])(self.unifiedEndpoints)
             self.route("/next_loc", methods=['POST'])(self.next_loc)
             self.route("/new_endpoint", methods=['POST'])(self.new_endpoint)
+            self.route("/ingest_stats", methods=['GET'])(self.ingest_stats)
 
         self.route("/new_name", methods=['POST'])(self.new_name)
         self.route("/new_username", methods=['POST'])(self.new_username)
@@ -174,13 +244,13 @@ class Pogom(Flask):
         self.route("/feedgym", methods=['GET'])(self.feedgym)
         self.route("/feedquest", methods=['GET'])(self.feedquest)
         self.route("/gym_img", methods=['GET'])(self.gym_img)
+        self.route("/stream", methods=['GET'])(self.stream)
 
         self.deviceschedules = {}
-        self.devicesscheduling = []
-        self.devices = {}
+        self.devicesscheduling = set()
+        self.devices = DeviceRegistry(DeviceWorker.get_by_id)
         self.deviceschecked = None
         self.trusteddevices = {}
-        self.devicessavetime = {}
 
         self.devices_last_scanned_times = {}
         self.devices_last_teleport_time = {}
@@ -191,70 +261,64 @@ class Pogom(Flask):
         self.gym_details = {}
         self.pokestop_details = {}
 
+        self.route_cache = RouteCache(args.route_cache_refresh)
+        self.gpx_routes = GpxRoutes()
+        self.claims = ClaimTable(self.claim_holder)
+        self.endpoint_handlers = {
+            'scan_loc': self.scan_loc,
+            'teleport_gym': self.teleport_gym,
+            'teleport_gpx': self.teleport_gpx,
+            'walk_pokestop': self.walk_pokestop,
+            'walk_gpx': self.walk_gpx,
+            'walk_spawnpoint': self.walk_spawnpoint
+        }
+        # Set by runserver when posts are parsed in worker processes.
+        self.ingest_pool = None
+
+        self.analytics = AnalyticsSender()
+
+    # Routes through a whole geofence don't depend on where the device is,
+    # so they can be shared.
+    def route_cache_usable(self, geofence, maxradius):
+        return get_args().route_cache_refresh > 0 and geofence != "" and maxradius == 0
+
+    # Returns a function computing the route from the geofence's south west
+    # corner.
+    def geofence_route(self, get_nearby, geofence, *route_args):
+        def compute():
+            swLat, swLng, neLat, neLng = self.geofences.get_boundary_coords(geofence)
+            if swLat is None:
+                return []
+            return get_nearby(swLat, swLng, *route_args)
+        return compute
+
+    # Active devices, shared with other requests so they mustn't be changed.
     def get_active_devices(self):
-        result = []
-
-        for uuid, dev in self.devices.iteritems():
-            device = self.get_device(uuid, dev['latitude'], dev['longitude'])
-            last_updated = device['last_updated']
-            difference = (datetime.utcnow() - last_updated).total_seconds()
-            if difference > 300 and device['fetching'] != 'IDLE':
-                device['fetching'] = 'IDLE'
-            last_scanned = device['last_scanned']
-            if last_scanned is None and device['scanning'] != -1:
-                device['scanning'] = -1
-            else:
-                difference = (datetime.utcnow() - last_scanned).total_seconds()
-                if difference > 60 and device['scanning'] == 1:
-                    device['scanning'] = 0
-
-            if device['scanning'] == 1 or device['fetching'] != 'IDLE':
-                result.append(device)
-
-        return result
+        return self.devices.get_active()
 
     def get_device(self, uuid, lat, lng):
-        if uuid not in self.devices:
-            self.devices[uuid] = DeviceWorker.get_by_id(uuid, lat, lng)
-            self.devices[uuid]['route'] = ''
-            self.devices[uuid]['no_overlap'] = False
-            self.devices[uuid]['mapcontrolled'] = False
-        device = self.devices[uuid].copy()
+        return self.devices.get_device(uuid, lat, lng)
 
-        last_updated = device['last_updated']
-        last_scanned = device['last_scanned']
-
-        difference = (datetime.utcnow() - last_updated).total_seconds()
-        if last_scanned is None:
-            difference2 = 60
-        else:
-            difference2 = (datetime.utcnow() - last_scanned).total_seconds()
-        if difference > 30 and difference2 > 30:
-            route = self.devices[uuid].get('route', '')
-            no_overlap = self.devices[uuid].get('no_overlap', False)
-            mapcontrolled = self.devices[uuid].get('mapcontrolled', False)
-            self.devices[uuid] = DeviceWorker.get_by_id(uuid, lat, lng)
-            self.devices[uuid]['route'] = route
-            self.devices[uuid]['no_overlap'] = no_overlap
-            self.devices[uuid]['mapcontrolled'] = mapcontrolled
-            device = self.devices[uuid].copy()
-
-        return device
+    # Devices keep their route claims while they're active and fetching
+    # the same kind of route without overlap.
+    def claim_holder(self, uuid, kind):
+        device = self.devices.get(uuid)
+        if device is None or not device.get('no_overlap'):
+            return False
+        return self.devices.current_state(device)['fetching'] == kind
 
     def save_device(self, device, force_save=False):
         uuid = device['deviceid']
-        if uuid not in self.devices:
-            self.devices[uuid] = DeviceWorker.get_by_id(uuid, device['latitude'], device['longitude'])
-
-        self.devices[uuid] = device.copy()
+        save_due = self.devices.save_due(uuid, force_save)
+        if save_due and device.get('last_scanned') is None:
+            device = device.copy()
+            device['last_scanned'] = datetime.utcnow() - timedelta(days=1)
 
-        if force_save or uuid not in self.devicessavetime or (datetime.utcnow() - self.devicessavetime[uuid]).total_seconds() > 30:
-            self.devicessavetime[uuid] = datetime.utcnow()
-            if self.devices[uuid].get('last_scanned') is None:
-                self.devices[uuid]['last_scanned'] = datetime.utcnow() - timedelta(days=1)
+        self.devices.save(device)
 
+        if save_due:
             deviceworkers = {}
-            deviceworkers[uuid] = self.devices[uuid].copy()
+            deviceworkers[uuid] = device.copy()
 
             if 'route' in deviceworkers[uuid]:
                 del deviceworkers[uuid]['route']
@@ -295,7 +359,18 @@ class Pogom(Flask):
         if pkm_form is not None:
             pkm_form = int(pkm_form)
 
-        return send_file(get_gym_icon(team, level, raidlevel, pkm, pkm_form, is_in_battle, is_ex_raid_eligible, is_unknown), mimetype='image/png')
+        icon = get_gym_icon(team, level, raidlevel, pkm, pkm_form, is_in_battle, is_ex_raid_eligible, is_unknown)
+        if icon is None:
+            abort(404)
+
+        png, etag = icon
+        response = make_response(png)
+        response.mimetype = 'image/png'
+        response.set_etag(etag)
+        # The same url always gets the same icon.
+        response.cache_control.public = True
+        response.cache_control.max_age = 7 * 24 * 60 * 60
+        return response.make_conditional(request)
 
     def get_pokemon_rarity_code(self, pokemonid):
         rarity = self.get_pokemon_rarity(pokemonid)
@@ -310,15 +385,7 @@ class Pogom(Flask):
         return rarities.get(rarity, 0)
 
     def get_pokemon_rarity(self, pokemonid):
-        args = get_args()
-        rarity = "New Spawn"
-        root_path = args.root_path
-        rarities_path = os.path.join(root_path, 'static/dist/data/rarity.json')
-        with open(rarities_path) as f:
-            data = json.load(f)
-            rarity = data.get(str(pokemonid), "New Spawn")
-
-        return rarity
+        return rarity_table.get(pokemonid)
 
     def feedquest(self):
         self.heartbeat[0] = now()
@@ -332,26 +399,23 @@ class Pogom(Flask):
         neLng = request.args.get('neLng')
 
         d = Quest.get_quests(swLat, swLng, neLat, neLng)
+        now_date = datetime.utcnow()
 
-        result = ""
-        for quest in d:
-            if result != "":
-                result += "\n"
-            result += str(round(quest['latitude'], 5)) + "," + str(round(quest['longitude'], 5)) + ","
-            if quest["reward_type"] == "POKEMON_ENCOUNTER":
-                result += str(_POKEMONID.values_by_name[quest["reward_item"]].number)
-            else:
-                result += ""
-            result += "," + str(quest['quest_type']) + "," + str(quest["reward_type"])
-            if quest["reward_type"] != "STARDUST":
-                result += ": " + str(quest["reward_item"])
-            if quest["reward_type"] != "POKEMON_ENCOUNTER":
-                result += " (" + str(quest["reward_amount"]) + ")"
-            now_date = datetime.utcnow()
-            ttl = int(round((now_date - quest['last_scanned']).total_seconds() / 60))
-            result += ", Scanned " + str(ttl) + "m ago"
-
-        return result.strip()
+        def lines():
+            for quest in d:
+                line = [str(round(quest['latitude'], 5)), ",", str(round(quest['longitude'], 5)), ","]
+                if quest["reward_type"] == "POKEMON_ENCOUNTER":
+                    line.append(str(_POKEMONID.values_by_name[quest["reward_item"]].number))
+                line += [",", str(quest['quest_type']), ",", str(quest["reward_type"])]
+                if quest["reward_type"] != "STARDUST":
+                    line += [": ", str(quest["reward_item"])]
+                if quest["reward_type"] != "POKEMON_ENCOUNTER":
+                    line += [" (", str(quest["reward_amount"]), ")"]
+                ttl = int(round((now_date - quest['last_scanned']).total_seconds() / 60))
+                line += [", Scanned ", str(ttl), "m ago"]
+                yield ''.join(line)
+
+        return feed_response(lines())
 
     def feedpokemon(self):
         self.heartbeat[0] = now()
@@ -382,47 +446,6 @@ class Pogom(Flask):
 
         lastpokemon = request.args.get('lastpokemon')
 
-        weathertypes = {
-            0: {
-                "name": "None"
-            },
-            1: {
-                "name": "Clear",
-                "emoji": u"\u2600",
-                "boost": "grass,ground,fire"
-            },
-            2: {
-                "name": "Rainy",
-                "emoji": u"\u2614",
-                "boost": "water,electric,bug"
-            },
-            3: {
-                "name": "PartlyCloudy",
-                "emoji": u"\U0001F324",
-                "boost": "normal,rock"
-            },
-            4: {
-                "name": "Overcast",
-                "emoji": u"\u2601",
-                "boost": "fairy,fighting,poison"
-            },
-            5: {
-                "name": "Windy",
-                "emoji": u"\U0001F32C",
-                "boost": "dragon,flying,psychic"
-            },
-            6: {
-                "name": "Snow",
-                "emoji": u"\u2744",
-                "boost": "ice,steel"
-            },
-            7: {
-                "name": "Fog",
-                "emoji": u"\U0001F32B",
-                "boost": "dark,ghost"
-            }
-        }
-
         if request.args.get('pokemon', 'true') == 'true':
             d['lastpokemon'] = request.args.get('pokemon', 'true')
 
@@ -508,20 +531,20 @@ class Pogom(Flask):
                     request.args.get('spawnpoint_id'),
                     int(request.args.get('duration'))))
 
-        result = ""
-        for pokemon in d['pokemons']:
-            if result != "":
-                result += "\n"
-            result += str(round(pokemon['latitude'], 5)) + "," + str(round(pokemon['longitude'], 5)) + "," + str(pokemon['pokemon_id']) + "," + pokemon['pokemon_name']
-            if pokemon['weather_boosted_condition'] > 0 and weathertypes[pokemon['weather_boosted_condition']]:
-                result += ", " + weathertypes[pokemon['weather_boosted_condition']]["emoji"] + " " + weathertypes[pokemon['weather_boosted_condition']]["name"]
-            rarity = self.get_pokemon_rarity(pokemon['pokemon_id'])
-            result += ", " + rarity
-            now_date = datetime.utcnow()
-            ttl = int(round((pokemon['disappear_time'] - now_date).total_seconds() / 60))
-            result += ", " + str(ttl) + "m"
-
-        return result.strip()
+        now_date = datetime.utcnow()
+
+        def lines():
+            for pokemon in d.get('pokemons', []):
+                line = [str(round(pokemon['latitude'], 5)), ",", str(round(pokemon['longitude'], 5)), ",", str(pokemon['pokemon_id']), ",", pokemon['pokemon_name']]
+                weather = WEATHER_TYPES.get(pokemon['weather_boosted_condition'])
+                if pokemon['weather_boosted_condition'] > 0 and weather:
+                    line += [", ", weather["emoji"], " ", weather["name"]]
+                line += [", ", self.get_pokemon_rarity(pokemon['pokemon_id'])]
+                ttl = int(round((pokemon['disappear_time'] - now_date).total_seconds() / 60))
+                line += [", ", str(ttl), "m"]
+                yield u''.join(line)
+
+        return feed_response(lines())
 
     def feedgym(self):
         self.heartbeat[0] = now()
@@ -598,32 +621,32 @@ class Pogom(Flask):
             if len(d['gyms']) > 0 and (not args.data_outside_geofences or geofencenames != "") and self.geofences.is_enabled():
                 d['gyms'] = self.geofences.get_geofenced_results(d['gyms'], geofencenames)
 
-        result = ""
-        for gym_id, gym in d['gyms'].items():
-            if gym['name'] is None:
-                gym['name'] = 'Unknown Name'
-            if unknown_name:
-                coords_found = re.search('^.*\..*,.*\..*$', gym['name'])
-                if coords_found is None and gym['name'] != 'Unknown Name':
-                    continue
-            if result != "":
-                result += "\n"
-            result += str(round(gym['latitude'], 5)) + "," + str(round(gym['longitude'], 5)) + "," + str(gym['guard_pokemon_id']) + "," + gym['name']
-            if gym['raid'] is not None:
-                now_date = datetime.utcnow()
-                start = int(round((gym['raid']['start'] - now_date).total_seconds() / 60))
-                end = int(round((gym['raid']['end'] - now_date).total_seconds() / 60))
-                if end > 0:
-                    result += ",Active Raid:"
-                    if gym['raid']['pokemon_id']:
-                        result += " " + gym['raid']['pokemon_name']
-                    result += " Level: " + str(gym['raid']['level'])
-                    if start > 0:
-                        result += " Starting in " + str(start) + " m"
-                    else:
-                        result += " Ending in " + str(end) + " m"
-
-        return result.strip()
+        now_date = datetime.utcnow()
+
+        def lines():
+            for gym_id, gym in d.get('gyms', {}).items():
+                if gym['name'] is None:
+                    gym['name'] = 'Unknown Name'
+                if unknown_name:
+                    coords_found = COORDS_NAME.search(gym['name'])
+                    if coords_found is None and gym['name'] != 'Unknown Name':
+                        continue
+                line = [str(round(gym['latitude'], 5)), ",", str(round(gym['longitude'], 5)), ",", str(gym['guard_pokemon_id']), ",", gym['name']]
+                if gym['raid'] is not None:
+                    start = int(round((gym['raid']['start'] - now_date).total_seconds() / 60))
+                    end = int(round((gym['raid']['end'] - now_date).total_seconds() / 60))
+                    if end > 0:
+                        line.append(",Active Raid:")
+                        if gym['raid']['pokemon_id']:
+                            line += [" ", gym['raid']['pokemon_name']]
+                        line += [" Level: ", str(gym['raid']['level'])]
+                        if start > 0:
+                            line += [" Starting in ", str(start), " m"]
+                        else:
+                            line += [" Ending in ", str(end), " m"]
+                yield ''.join(line)
+
+        return feed_response(lines())
 
     def auth_callback(self):
         session.permanent = True
@@ -732,7 +755,7 @@ class Pogom(Flask):
                 deviceworker['longitude'] = lng
 
             # Update PoGo version
-            pogoversion = re.sub(r'pokemongo/([^\ ]*).*', r'\1', request.headers.get('User-Agent', 'Unknown'))
+            pogoversion = pogo_version(request.headers.get('User-Agent', 'Unknown'))
             if pogoversion != "" and pogoversion != deviceworker['pogoversion']:
                 log.info('Device {} updating pogoversion: {} => {}'.format(uuid, deviceworker['pogoversion'], pogoversion))
                 deviceworker['pogoversion'] = pogoversion
@@ -742,6 +765,8 @@ class Pogom(Flask):
 
             self.track_event('worker', 'sent', uuid)
 
+            if self.ingest_pool is not None:
+                return self.ingest_pool.parse(protos, trainerlvl, deviceworker)
             return self.parse_map_protos(protos, trainerlvl, deviceworker)
         else:
             return 'wrong'
@@ -778,17 +803,10 @@ class Pogom(Flask):
                 'ev': value,  # Event value, must be an integer
             }
 
-            import requests
-
-            response = requests.post(
-                'https://www.google-analytics.com/collect', data=data)
+            # Sent in batches by analytics_sender, started by runserver.
+            self.analytics.track(data)
 
             self.ga_alerts[uuid][category][action]['count'] = 0
-
-            # If the request fails, this will raise a RequestException. Depending
-            # on your application's needs, this may be a non-error and can be caught
-            # by the caller.
-            response.raise_for_status()
         else:
             self.ga_alerts[uuid][category][action]['count'] += 1
 
@@ -812,7 +830,7 @@ class Pogom(Flask):
         gym_members = {}
         gym_pokemon = {}
         gym_encountered = {}
-        time_of_day = "NONE"
+        time_of_day = 0
 
         now_date = datetime.utcnow()
 
@@ -850,44 +868,46 @@ class Pogom(Flask):
                 gmo = GetMapObjectsResponse()
                 try:
                     gmo.ParseFromString(gmo_response_string)
-                    gmo_response_json = json.loads(MessageToJson(gmo))
                 except:
                     continue
 
-                if "mapCells" in gmo_response_json:
+                if gmo.map_cells:
                     monmaxdist = 0
                     fortmaxdist = 0
-                    for mapcell in gmo_response_json["mapCells"]:
-                        if "wildPokemons" in mapcell:
+
+                    # Look up all spawnpoints of this response at once.
+                    known_spawn_points = SpawnPoint.get_by_ids([
+                        p.spawn_point_id for mapcell in gmo.map_cells
+                        for mons in (mapcell.wild_pokemons, mapcell.catchable_pokemons)
+                        for p in mons])
+
+                    for mapcell in gmo.map_cells:
+                        if mapcell.wild_pokemons:
                             last_scanned_times['pokemon'] = now_date
                             last_scanned_times['wild_pokemon'] = now_date
 
-                            encounter_ids = [long(p['encounterId']) for p in mapcell["wildPokemons"]]
+                            encounter_ids = [p.encounter_id for p in mapcell.wild_pokemons]
                             # For all the wild Pokemon we found check if an active Pokemon is in
                             # the database.
-                            with Pokemon.database().execution_context():
-                                query = (Pokemon
-                                         .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
-                                         .where((Pokemon.disappear_time >= now_date) &
-                                                (Pokemon.encounter_id << encounter_ids))
-                                         .dicts())
-
-                                # Store all encounter_ids and spawnpoint_ids for the Pokemon in
-                                # query.
-                                # All of that is needed to make sure it's unique.
-                                encountered_pokemon = [
-                                    (long(p['encounter_id']), p['spawnpoint_id']) for p in query]
-
-                            for p in mapcell["wildPokemons"]:
-                                spawn_id = p['spawnPointId']
-
-                                sp = SpawnPoint.get_by_id(spawn_id, p['latitude'], p['longitude'])
+                            # All encounter_ids and spawnpoint_ids of active
+                            # Pokemon are needed to make sure it's unique.
+                            encountered_pokemon = Pokemon.get_encountered(
+                                encounter_ids, now_date)
+
+                            for p in mapcell.wild_pokemons:
+                                spawn_id = p.spawn_point_id
+
+                                sp = known_spawn_points.get(spawn_id)
+                                if sp:
+                                    sp = sp.copy()
+                                else:
+                                    sp = SpawnPoint.new_spawnpoint(spawn_id, p.latitude, p.longitude)
                                 sp['last_scanned'] = datetime.utcnow()
                                 spawn_points[spawn_id] = sp
                                 sp['missed_count'] = 0
 
                                 sighting = {
-                                    'encounter_id': long(p['encounterId']),
+                                    'encounter_id': p.encounter_id,
                                     'spawnpoint_id': spawn_id,
                                     'scan_time': now_date,
                                     'tth_secs': None
@@ -898,9 +918,9 @@ class Pogom(Flask):
 
                                 # time_till_hidden_ms was overflowing causing a negative integer.
                                 # It was also returning a value above 3.6M ms.
-                                if 0 < float(p['timeTillHiddenMs']) < 3600000:
+                                if 0 < p.time_till_hidden_ms < 3600000:
                                     d_t_secs = date_secs(datetime.utcfromtimestamp(
-                                        now() + float(p['timeTillHiddenMs']) / 1000.0))
+                                        now() + p.time_till_hidden_ms / 1000.0))
 
                                     # Cover all bases, make sure we're using values < 3600.
                                     # Warning: python uses modulo as the least residue, not as
@@ -930,11 +950,11 @@ class Pogom(Flask):
                                 if (not SpawnPoint.tth_found(sp) or sighting['tth_secs']):
                                     SpawnpointDetectionData.classify(sp, scan_location, now_secs,
                                                                      sighting)
-                                    sightings[long(p['encounterId'])] = sighting
+                                    sightings[p.encounter_id] = sighting
 
                                 sp['last_scanned'] = datetime.utcnow()
 
-                                if ((long(p['encounterId']), spawn_id) in encountered_pokemon) or (long(p['encounterId']) in pokemon):
+                                if ((p.encounter_id, spawn_id) in encountered_pokemon) or (p.encounter_id in pokemon):
                                     # If Pokemon has been encountered before don't process it.
                                     pokemon_skipped += 1
                                     continue
@@ -943,22 +963,23 @@ class Pogom(Flask):
                                 seconds_until_despawn = (start_end[1] - now_secs) % 3600
                                 disappear_time = now_date + timedelta(seconds=seconds_until_despawn)
 
-                                pokemon_id = _POKEMONID.values_by_name[p['pokemonData']['pokemonId']].number
+                                pokemon_id = p.pokemon_data.pokemon_id
 
-                                gender = _GENDER.values_by_name[p['pokemonData']["pokemonDisplay"].get('gender', 'GENDER_UNSET')].number
-                                costume = _COSTUME.values_by_name[p['pokemonData']["pokemonDisplay"].get('costume', 'COSTUME_UNSET')].number
-                                form = _FORM.values_by_name[p['pokemonData']["pokemonDisplay"].get('form', 'FORM_UNSET')].number
-                                weather_boosted_condition = _WEATHERCONDITION.values_by_name[p['pokemonData']["pokemonDisplay"].get('weatherBoostedCondition', 'NONE')].number
+                                pokemon_display = p.pokemon_data.pokemon_display
+                                gender = pokemon_display.gender
+                                costume = pokemon_display.costume
+                                form = pokemon_display.form
+                                weather_boosted_condition = pokemon_display.weather_boosted_condition
 
-                                printPokemon(pokemon_id, p['latitude'], p['longitude'],
+                                printPokemon(pokemon_id, p.latitude, p.longitude,
                                              disappear_time)
 
-                                pokemon[long(p['encounterId'])] = {
-                                    'encounter_id': long(p['encounterId']),
+                                pokemon[p.encounter_id] = {
+                                    'encounter_id': p.encounter_id,
                                     'spawnpoint_id': spawn_id,
                                     'pokemon_id': pokemon_id,
-                                    'latitude': p['latitude'],
-                                    'longitude': p['longitude'],
+                                    'latitude': p.latitude,
+                                    'longitude': p.longitude,
                                     'disappear_time': disappear_time,
                                     'individual_attack': None,
                                     'individual_defense': None,
@@ -975,7 +996,7 @@ class Pogom(Flask):
                                     'weather_boosted_condition': weather_boosted_condition
                                 }
 
-                                distance_m = geopy.distance.vincenty((deviceworker['latitude'], deviceworker['longitude']), (p['latitude'], p['longitude'])).meters
+                                distance_m = haversine_distance(deviceworker['latitude'], deviceworker['longitude'], p.latitude, p.longitude)
                                 if distance_m <= 150:
                                     monmaxdist = max(monmaxdist, distance_m)
 
@@ -983,12 +1004,12 @@ class Pogom(Flask):
                                     if (pokemon_id in args.webhook_whitelist or
                                         (not args.webhook_whitelist and pokemon_id
                                          not in args.webhook_blacklist)):
-                                        wh_poke = pokemon[long(p['encounterId'])].copy()
+                                        wh_poke = pokemon[p.encounter_id].copy()
                                         wh_poke.update({
                                             'disappear_time': calendar.timegm(
                                                 disappear_time.timetuple()),
                                             'last_modified_time': now(),
-                                            'time_until_hidden_ms': float(p['timeTillHiddenMs']),
+                                            'time_until_hidden_ms': float(p.time_till_hidden_ms),
                                             'verified': SpawnPoint.tth_found(sp),
                                             'seconds_until_despawn': seconds_until_despawn,
                                             'spawn_start': start_end[0],
@@ -1014,36 +1035,32 @@ class Pogom(Flask):
 
                                         self.wh_update_queue.put(('pokemon', wh_poke))
 
-                        if "catchablePokemons" in mapcell:
+                        if mapcell.catchable_pokemons:
                             last_scanned_times['pokemon'] = now_date
                             last_scanned_times['wild_pokemon'] = now_date
 
-                            encounter_ids = [long(p['encounterId']) for p in mapcell["catchablePokemons"]]
+                            encounter_ids = [p.encounter_id for p in mapcell.catchable_pokemons]
                             # For all the wild Pokemon we found check if an active Pokemon is in
                             # the database.
-                            with Pokemon.database().execution_context():
-                                query = (Pokemon
-                                         .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
-                                         .where((Pokemon.disappear_time >= now_date) &
-                                                (Pokemon.encounter_id << encounter_ids))
-                                         .dicts())
-
-                                # Store all encounter_ids and spawnpoint_ids for the Pokemon in
-                                # query.
-                                # All of that is needed to make sure it's unique.
-                                encountered_pokemon = [
-                                    (long(p['encounter_id']), p['spawnpoint_id']) for p in query]
-
-                            for p in mapcell["catchablePokemons"]:
-                                spawn_id = p['spawnPointId']
-
-                                sp = SpawnPoint.get_by_id(spawn_id, p['latitude'], p['longitude'])
+                            # All encounter_ids and spawnpoint_ids of active
+                            # Pokemon are needed to make sure it's unique.
+                            encountered_pokemon = Pokemon.get_encountered(
+                                encounter_ids, now_date)
+
+                            for p in mapcell.catchable_pokemons:
+                                spawn_id = p.spawn_point_id
+
+                                sp = known_spawn_points.get(spawn_id)
+                                if sp:
+                                    sp = sp.copy()
+                                else:
+                                    sp = SpawnPoint.new_spawnpoint(spawn_id, p.latitude, p.longitude)
                                 sp['last_scanned'] = datetime.utcnow()
                                 spawn_points[spawn_id] = sp
                                 sp['missed_count'] = 0
 
                                 sighting = {
-                                    'encounter_id': long(p['encounterId']),
+                                    'encounter_id': p.encounter_id,
                                     'spawnpoint_id': spawn_id,
                                     'scan_time': now_date,
                                     'tth_secs': None
@@ -1052,12 +1069,12 @@ class Pogom(Flask):
                                 # Keep a list of sp_ids to return.
                                 sp_id_list.append(spawn_id)
 
-                                expirationTimestampMs = float(p.get('expirationTimestampMs', -1))
+                                expiration_time_ms = float(p.expiration_time_ms)
 
                                 # time_till_hidden_ms was overflowing causing a negative integer.
                                 # It was also returning a value above 3.6M ms.
-                                if expirationTimestampMs > 0:
-                                    d_t_secs = date_secs(datetime.utcfromtimestamp(expirationTimestampMs / 1000.0))
+                                if expiration_time_ms > 0:
+                                    d_t_secs = date_secs(datetime.utcfromtimestamp(expiration_time_ms / 1000.0))
 
                                     # Cover all bases, make sure we're using values < 3600.
                                     # Warning: python uses modulo as the least residue, not as
@@ -1087,11 +1104,11 @@ class Pogom(Flask):
                                 if (not SpawnPoint.tth_found(sp) or sighting['tth_secs']):
                                     SpawnpointDetectionData.classify(sp, scan_location, now_secs,
                                                                      sighting)
-                                    sightings[long(p['encounterId'])] = sighting
+                                    sightings[p.encounter_id] = sighting
 
                                 sp['last_scanned'] = datetime.utcnow()
 
-                                if ((long(p['encounterId']), spawn_id) in encountered_pokemon) or (long(p['encounterId']) in pokemon):
+                                if ((p.encounter_id, spawn_id) in encountered_pokemon) or (p.encounter_id in pokemon):
                                     # If Pokemon has been encountered before don't process it.
                                     pokemon_skipped += 1
                                     continue
@@ -1100,22 +1117,22 @@ class Pogom(Flask):
                                 seconds_until_despawn = (start_end[1] - now_secs) % 3600
                                 disappear_time = now_date + timedelta(seconds=seconds_until_despawn)
 
-                                pokemon_id = _POKEMONID.values_by_name[p['pokemonId']].number
+                                pokemon_id = p.pokedex_type_id
 
-                                gender = _GENDER.values_by_name[p["pokemonDisplay"].get('gender', 'GENDER_UNSET')].number
-                                costume = _COSTUME.values_by_name[p["pokemonDisplay"].get('costume', 'COSTUME_UNSET')].number
-                                form = _FORM.values_by_name[p["pokemonDisplay"].get('form', 'FORM_UNSET')].number
-                                weather_boosted_condition = _WEATHERCONDITION.values_by_name[p["pokemonDisplay"].get('weatherBoostedCondition', 'NONE')].number
+                                gender = p.pokemon_display.gender
+                                costume = p.pokemon_display.costume
+                                form = p.pokemon_display.form
+                                weather_boosted_condition = p.pokemon_display.weather_boosted_condition
 
-                                printPokemon(pokemon_id, p['latitude'], p['longitude'],
+                                printPokemon(pokemon_id, p.latitude, p.longitude,
                                              disappear_time)
 
-                                pokemon[long(p['encounterId'])] = {
-                                    'encounter_id': long(p['encounterId']),
+                                pokemon[p.encounter_id] = {
+                                    'encounter_id': p.encounter_id,
                                     'spawnpoint_id': spawn_id,
                                     'pokemon_id': pokemon_id,
-                                    'latitude': p['latitude'],
-                                    'longitude': p['longitude'],
+                                    'latitude': p.latitude,
+                                    'longitude': p.longitude,
                                     'disappear_time': disappear_time,
                                     'individual_attack': None,
                                     'individual_defense': None,
@@ -1132,7 +1149,7 @@ class Pogom(Flask):
                                     'weather_boosted_condition': weather_boosted_condition
                                 }
 
-                                distance_m = geopy.distance.vincenty((deviceworker['latitude'], deviceworker['longitude']), (p['latitude'], p['longitude'])).meters
+                                distance_m = haversine_distance(deviceworker['latitude'], deviceworker['longitude'], p.latitude, p.longitude)
                                 if distance_m <= 150:
                                     monmaxdist = max(monmaxdist, distance_m)
 
@@ -1140,12 +1157,12 @@ class Pogom(Flask):
                                     if (pokemon_id in args.webhook_whitelist or
                                         (not args.webhook_whitelist and pokemon_id
                                          not in args.webhook_blacklist)):
-                                        wh_poke = pokemon[long(p['encounterId'])].copy()
+                                        wh_poke = pokemon[p.encounter_id].copy()
                                         wh_poke.update({
                                             'disappear_time': calendar.timegm(
                                                 disappear_time.timetuple()),
                                             'last_modified_time': now(),
-                                            'time_until_hidden_ms': expirationTimestampMs,
+                                            'time_until_hidden_ms': expiration_time_ms,
                                             'verified': SpawnPoint.tth_found(sp),
                                             'seconds_until_despawn': seconds_until_despawn,
                                             'spawn_start': start_end[0],
@@ -1171,31 +1188,23 @@ class Pogom(Flask):
 
                                         self.wh_update_queue.put(('pokemon', wh_poke))
 
-                        if "nearbyPokemons" in mapcell:
+                        if mapcell.nearby_pokemons:
                             last_scanned_times['pokemon'] = now_date
                             last_scanned_times['nearby_pokemon'] = now_date
 
-                            nearby_encounter_ids = [long(p['encounterId']) for p in mapcell["nearbyPokemons"]]
+                            nearby_encounter_ids = [p.encounter_id for p in mapcell.nearby_pokemons]
                             # For all the wild Pokemon we found check if an active Pokemon is in
                             # the database.
-                            with PokestopMember.database().execution_context():
-                                query = (PokestopMember
-                                         .select(PokestopMember.encounter_id, PokestopMember.pokestop_id)
-                                         .where((PokestopMember.disappear_time >= now_date) &
-                                                (PokestopMember.encounter_id << nearby_encounter_ids))
-                                         .dicts())
-
-                                # Store all encounter_ids and spawnpoint_ids for the Pokemon in
-                                # query.
-                                # All of that is needed to make sure it's unique.
-                                nearby_encountered_pokemon = [
-                                    (long(p['encounter_id']), p['pokestop_id']) for p in query]
-
-                            for p in mapcell["nearbyPokemons"]:
-                                pokestop_id = p.get('fortId')
+                            # All encounter_ids and pokestop_ids of active
+                            # nearby Pokemon are needed to make sure it's unique.
+                            nearby_encountered_pokemon = PokestopMember.get_encountered(
+                                nearby_encounter_ids, now_date)
+
+                            for p in mapcell.nearby_pokemons:
+                                pokestop_id = p.fort_id
                                 if not pokestop_id:
                                     continue
-                                encounter_id = p.get('encounterId')
+                                encounter_id = p.encounter_id
                                 if not encounter_id:
                                     continue
                                 if ((encounter_id, pokestop_id) in nearby_encountered_pokemon) or (encounter_id in nearby_pokemons):
@@ -1204,18 +1213,18 @@ class Pogom(Flask):
 
                                 disappear_time = now_date + timedelta(seconds=600)
 
-                                pokemon_id = _POKEMONID.values_by_name[p['pokemonId']].number
+                                pokemon_id = p.pokemon_id
 
-                                distance = round(p.get('distanceInMeters', 0), 5)
+                                distance = round(p.distance_in_meters, 5)
 
-                                gender = _GENDER.values_by_name[p["pokemonDisplay"].get('gender', 'GENDER_UNSET')].number
-                                costume = _COSTUME.values_by_name[p["pokemonDisplay"].get('costume', 'COSTUME_UNSET')].number
-                                form = _FORM.values_by_name[p["pokemonDisplay"].get('form', 'FORM_UNSET')].number
-                                weather_boosted_condition = _WEATHERCONDITION.values_by_name[p["pokemonDisplay"].get('weatherBoostedCondition', 'NONE')].number
+                                gender = p.pokemon_display.gender
+                                costume = p.pokemon_display.costume
+                                form = p.pokemon_display.form
+                                weather_boosted_condition = p.pokemon_display.weather_boosted_condition
 
-                                nearby_pokemons[long(encounter_id)] = {
-                                    'encounter_id': long(encounter_id),
-                                    'pokestop_id': p['fortId'],
+                                nearby_pokemons[encounter_id] = {
+                                    'encounter_id': encounter_id,
+                                    'pokestop_id': pokestop_id,
                                     'pokemon_id': pokemon_id,
                                     'disappear_time': disappear_time,
                                     'gender': gender,
@@ -1224,20 +1233,22 @@ class Pogom(Flask):
                                     'weather_boosted_condition': weather_boosted_condition,
                                     'distance': distance
                                 }
-                                if nearby_pokemons[long(encounter_id)]['costume'] < -1:
-                                    nearby_pokemons[long(encounter_id)]['costume'] = -1
-                                if nearby_pokemons[long(encounter_id)]['form'] < -1:
-                                    nearby_pokemons[long(encounter_id)]['form'] = -1
-
-                                pokestopdetails = pokestop_details.get(p['fortId'], Pokestop.get_pokestop_details(p['fortId']))
-                                pokestop_url = p.get('fortImageUrl', "").replace('http://', 'https://')
+                                if nearby_pokemons[encounter_id]['costume'] < -1:
+                                    nearby_pokemons[encounter_id]['costume'] = -1
+                                if nearby_pokemons[encounter_id]['form'] < -1:
+                                    nearby_pokemons[encounter_id]['form'] = -1
+
+                                pokestopdetails = pokestop_details.get(pokestop_id)
+                                if pokestopdetails is None:
+                                    pokestopdetails = Pokestop.get_pokestop_details(pokestop_id)
+                                pokestop_url = p.fort_image_url.replace('http://', 'https://')
                                 if pokestopdetails:
                                     pokestop_name = pokestopdetails.get("name")
                                     pokestop_description = pokestopdetails.get("description")
                                     pokestop_url = pokestop_url if pokestop_url != "" else pokestopdetails["url"]
 
-                                    pokestop_details[p['fortId']] = {
-                                        'pokestop_id': p['fortId'],
+                                    pokestop_details[pokestop_id] = {
+                                        'pokestop_id': pokestop_id,
                                         'name': pokestop_name,
                                         'description': pokestop_description,
                                         'url': pokestop_url
@@ -1247,10 +1258,14 @@ class Pogom(Flask):
                                     if (pokemon_id in args.webhook_whitelist or
                                         (not args.webhook_whitelist and pokemon_id
                                          not in args.webhook_blacklist)):
-                                        stop = Pokestop.get_stop(p['fortId'])
-                                        wh_poke = nearby_pokemons[long(encounter_id)].copy()
+                                        stop = pokestops.get(pokestop_id)
+                                        if stop is None:
+                                            location = Pokestop.get_location(pokestop_id)
+                                            stop = {'latitude': location[0],
+                                                    'longitude': location[1]}
+                                        wh_poke = nearby_pokemons[encounter_id].copy()
                                         wh_poke.update({
-                                            'encounter_id': str(p['fortId']) + '|' + str(p['encounterId']),
+                                            'encounter_id': str(pokestop_id) + '|' + str(encounter_id),
                                             'spawnpoint_id': 0,
                                             'disappear_time': calendar.timegm(
                                                 disappear_time.timetuple()),
@@ -1283,77 +1298,70 @@ class Pogom(Flask):
 
                                         self.wh_update_queue.put(('pokemon', wh_poke))
 
-                        if "forts" in mapcell:
+                        if mapcell.forts:
                             last_scanned_times['forts'] = now_date
 
-                            stop_ids = [f['id'] for f in mapcell["forts"]]
+                            stop_ids = [f.id for f in mapcell.forts]
                             if stop_ids:
-                                with Pokemon.database().execution_context():
-                                    query = (Pokestop.select(
-                                        Pokestop.pokestop_id, Pokestop.last_modified).where(
-                                            (Pokestop.pokestop_id << stop_ids)).dicts())
-                                    encountered_pokestops = [(f['pokestop_id'], int(
-                                        (f['last_modified'] - datetime(1970, 1, 1)).total_seconds()))
-                                        for f in query]
-                            for fort in mapcell["forts"]:
-                                if fort.get("type") == "CHECKPOINT":
+                                encountered_pokestops = set(
+                                    Pokestop.get_last_modified(stop_ids).items())
+                            for fort in mapcell.forts:
+                                if fort.type == CHECKPOINT:
                                     last_scanned_times['pokestops'] = now_date
 
-                                    activeFortModifier = fort.get('activeFortModifier', [])
-                                    if 'ITEM_TROY_DISK' in activeFortModifier:
-                                        lure_expiration = datetime.utcfromtimestamp(long(fort['lastModifiedTimestampMs']) / 1000) + timedelta(minutes=args.lure_duration)
-                                        lureInfo = fort.get('lureInfo')
-                                        if lureInfo is not None:
-                                            active_pokemon_id = _POKEMONID.values_by_name[lureInfo.get('activePokemonId', 'MISSINGNO')].number,
-                                            active_pokemon_expiration = datetime.utcfromtimestamp(long(lureInfo.get('lureExpiresTimestampMs')) / 1000)
-                                        else:
-                                            active_pokemon_id = None
-                                            active_pokemon_expiration = None
+                                    # FortData carries no lure info, so the lured
+                                    # Pokemon is never known from the map.
+                                    active_pokemon_id = None
+                                    active_pokemon_expiration = None
+                                    if ITEM_TROY_DISK in fort.active_fort_modifier:
+                                        lure_expiration = datetime.utcfromtimestamp(fort.last_modified_timestamp_ms / 1000) + timedelta(minutes=args.lure_duration)
                                     else:
                                         lure_expiration = None
-                                        active_pokemon_id = None
-                                        active_pokemon_expiration = None
-
-                                    pokestops[fort['id']] = {
-                                        'pokestop_id': fort['id'],
-                                        'enabled': fort.get('enabled', False),
-                                        'latitude': fort['latitude'],
-                                        'longitude': fort['longitude'],
+                                    active_fort_modifier = [_ITEMID.values_by_number[m].name
+                                                            for m in fort.active_fort_modifier]
+
+                                    pokestops[fort.id] = {
+                                        'pokestop_id': fort.id,
+                                        'enabled': fort.enabled,
+                                        'latitude': fort.latitude,
+                                        'longitude': fort.longitude,
                                         'last_modified': datetime.utcfromtimestamp(
-                                            float(fort['lastModifiedTimestampMs']) / 1000.0),
+                                            float(fort.last_modified_timestamp_ms) / 1000.0),
                                         'lure_expiration': lure_expiration,
-                                        'active_fort_modifier': json.dumps(activeFortModifier),
+                                        'active_fort_modifier': json.dumps(active_fort_modifier),
                                         'active_pokemon_id': active_pokemon_id,
                                         'active_pokemon_expiration': active_pokemon_expiration
                                     }
 
-                                    distance_m = geopy.distance.vincenty((deviceworker['latitude'], deviceworker['longitude']), (fort['latitude'], fort['longitude'])).meters
+                                    distance_m = haversine_distance(deviceworker['latitude'], deviceworker['longitude'], fort.latitude, fort.longitude)
                                     if distance_m <= 1500:
                                         fortmaxdist = max(fortmaxdist, distance_m)
 
-                                    pokestopdetails = self.pokestop_details.get(fort['id'], Pokestop.get_pokestop_details(fort['id']))
-                                    pokestop_name = str(fort['latitude']) + ',' + str(fort['longitude'])
+                                    pokestopdetails = self.pokestop_details.get(fort.id)
+                                    if pokestopdetails is None:
+                                        pokestopdetails = Pokestop.get_pokestop_details(fort.id)
+                                    pokestop_name = str(fort.latitude) + ',' + str(fort.longitude)
                                     pokestop_description = ""
-                                    pokestop_url = fort.get('imageUrl', "").replace('http://', 'https://')
+                                    pokestop_url = fort.image_url.replace('http://', 'https://')
                                     if pokestopdetails:
                                         pokestop_name = pokestopdetails.get("name", pokestop_name)
                                         pokestop_description = pokestopdetails.get("description", pokestop_description)
                                         pokestop_url = pokestop_url if pokestop_url != "" else pokestopdetails["url"]
 
-                                    pokestop_details[fort['id']] = {
-                                        'pokestop_id': fort['id'],
+                                    pokestop_details[fort.id] = {
+                                        'pokestop_id': fort.id,
                                         'name': pokestop_name,
                                         'description': pokestop_description,
                                         'url': pokestop_url
                                     }
-                                    self.pokestop_details[fort['id']] = {
-                                        'pokestop_id': fort['id'],
+                                    self.pokestop_details[fort.id] = {
+                                        'pokestop_id': fort.id,
                                         'name': pokestop_name,
                                         'description': pokestop_description,
                                         'url': pokestop_url
                                     }
 
-                                    if ((fort['id'], int(float(fort['lastModifiedTimestampMs']) / 1000.0))
+                                    if ((fort.id, int(float(fort.last_modified_timestamp_ms) / 1000.0))
                                             in encountered_pokestops):
                                         # If pokestop has been encountered before and hasn't
                                         # changed don't process it.
@@ -1365,57 +1373,57 @@ class Pogom(Flask):
                                         l_e = None
                                         if lure_expiration is not None:
                                             l_e = calendar.timegm(lure_expiration.timetuple())
-                                        wh_pokestop = pokestops[fort['id']].copy()
+                                        wh_pokestop = pokestops[fort.id].copy()
                                         wh_pokestop.update({
-                                            'pokestop_id': fort['id'],
-                                            'last_modified': float(fort['lastModifiedTimestampMs']),
+                                            'pokestop_id': fort.id,
+                                            'last_modified': float(fort.last_modified_timestamp_ms),
                                             'lure_expiration': l_e,
                                         })
                                         self.wh_update_queue.put(('pokestop', wh_pokestop))
                                 else:
                                     last_scanned_times['gyms'] = now_date
 
-                                    b64_gym_id = str(fort['id'])
-                                    park = Gym.get_gyms_park(fort['id'])
+                                    b64_gym_id = str(fort.id)
+                                    park = Gym.get_gyms_park(fort.id)
 
-                                    gyms[fort['id']] = {
+                                    gyms[fort.id] = {
                                         'gym_id':
-                                            fort['id'],
+                                            fort.id,
                                         'team_id':
-                                            _TEAMCOLOR.values_by_name[fort.get('ownedByTeam', 'NEUTRAL')].number,
+                                            fort.owned_by_team,
                                         'park':
                                             park,
                                         'guard_pokemon_id':
-                                            _POKEMONID.values_by_name[fort.get('guardPokemonId', 'MISSINGNO')].number,
+                                            fort.guard_pokemon_id,
                                         'slots_available':
-                                            fort["gymDisplay"].get('slotsAvailable', 0),
+                                            fort.gym_display.slots_available,
                                         'total_cp':
-                                            fort["gymDisplay"].get('totalGymCp', 0),
+                                            fort.gym_display.total_gym_cp,
                                         'enabled':
-                                            fort.get('enabled', False),
+                                            fort.enabled,
                                         'latitude':
-                                            fort['latitude'],
+                                            fort.latitude,
                                         'longitude':
-                                            fort['longitude'],
+                                            fort.longitude,
                                         'last_modified':
                                             datetime.utcfromtimestamp(
-                                                float(fort['lastModifiedTimestampMs']) / 1000.0),
+                                                float(fort.last_modified_timestamp_ms) / 1000.0),
                                         'is_in_battle':
-                                            fort.get('isInBattle', False),
+                                            fort.is_in_battle,
                                         'is_ex_raid_eligible':
-                                            fort.get('isExRaidEligible', False)
+                                            fort.is_ex_raid_eligible
                                     }
 
-                                    distance_m = geopy.distance.vincenty((deviceworker['latitude'], deviceworker['longitude']), (fort['latitude'], fort['longitude'])).meters
+                                    distance_m = haversine_distance(deviceworker['latitude'], deviceworker['longitude'], fort.latitude, fort.longitude)
                                     if distance_m <= 1500:
                                         fortmaxdist = max(fortmaxdist, distance_m)
 
-                                    gym_id = fort['id']
+                                    gym_id = fort.id
 
                                     gymdetails = self.gym_details.get(gym_id, Gym.get_gym_details(gym_id))
-                                    gym_name = str(fort['latitude']) + ',' + str(fort['longitude'])
+                                    gym_name = str(fort.latitude) + ',' + str(fort.longitude)
                                     gym_description = ""
-                                    gym_url = fort.get('imageUrl', "").replace('http://', 'https://')
+                                    gym_url = fort.image_url.replace('http://', 'https://')
                                     if gymdetails:
                                         gym_name = gymdetails.get("name", gym_name)
                                         gym_description = gymdetails.get("description", gym_description)
@@ -1436,9 +1444,9 @@ class Pogom(Flask):
 
                                     if 'gym' in args.wh_types:
                                         raid_active_until = 0
-                                        if 'raidInfo' in fort and not fort["raidInfo"].get('complete', False):
-                                            raid_battle_ms = float(fort['raidInfo']['raidBattleMs'])
-                                            raid_end_ms = float(fort['raidInfo']['raidEndMs'])
+                                        if fort.HasField('raid_info') and not fort.raid_info.complete:
+                                            raid_battle_ms = float(fort.raid_info.raid_battle_ms)
+                                            raid_end_ms = float(fort.raid_info.raid_end_ms)
 
                                             if raid_battle_ms / 1000 > time.time():
                                                 raid_active_until = raid_end_ms / 1000
@@ -1446,7 +1454,7 @@ class Pogom(Flask):
                                         # Explicitly set 'webhook_data', in case we want to change
                                         # the information pushed to webhooks.  Similar to above
                                         # and previous commits.
-                                        wh_gym = gyms[fort['id']].copy()
+                                        wh_gym = gyms[fort.id].copy()
 
                                         wh_gym.update({
                                             'gym_id':
@@ -1454,15 +1462,15 @@ class Pogom(Flask):
                                             'gym_name':
                                                 gym_name,
                                             'lowest_pokemon_motivation':
-                                                float(fort["gymDisplay"].get('lowestPokemonMotivation', 0)),
+                                                float(fort.gym_display.lowest_pokemon_motivation),
                                             'occupied_since':
-                                                float(fort["gymDisplay"].get('occupiedMillis', 0)),
+                                                float(fort.gym_display.occupied_millis),
                                             'last_modified':
-                                                float(fort['lastModifiedTimestampMs']),
+                                                float(fort.last_modified_timestamp_ms),
                                             'raid_active_until':
                                                 raid_active_until,
                                             'ex_raid_eligible':
-                                                fort.get('isExRaidEligible', False)
+                                                fort.is_ex_raid_eligible
                                         })
 
                                         self.wh_update_queue.put(('gym', wh_gym))
@@ -1470,9 +1478,9 @@ class Pogom(Flask):
                                     if 'gym-info' in args.wh_types:
                                         webhook_data = {
                                             'id': str(gym_id),
-                                            'latitude': fort['latitude'],
-                                            'longitude': fort['longitude'],
-                                            'team': _TEAMCOLOR.values_by_name[fort.get('ownedByTeam', 'NEUTRAL')].number,
+                                            'latitude': fort.latitude,
+                                            'longitude': fort.longitude,
+                                            'team': fort.owned_by_team,
                                             'name': gym_name,
                                             'description': gym_description,
                                             'url': gym_url,
@@ -1481,31 +1489,26 @@ class Pogom(Flask):
 
                                         self.wh_update_queue.put(('gym_details', webhook_data))
 
-                                    if 'raidInfo' in fort and not fort["raidInfo"].get('complete', False) and (args.include_ex_raids or not fort["raidInfo"].get('isExclusive', False)):
-                                        raidinfo = fort["raidInfo"]
-                                        raidpokemonid = raidinfo['raidPokemon']['pokemonId'] if 'raidPokemon' in raidinfo and 'pokemonId' in raidinfo['raidPokemon'] else None
-                                        if raidpokemonid:
-                                            raidpokemonid = _POKEMONID.values_by_name[raidpokemonid].number
-                                        if raidpokemonid is None and fort["raidInfo"].get('isExclusive', False) and args.current_ex_raid_boss > 0:
+                                    if fort.HasField('raid_info') and not fort.raid_info.complete and (args.include_ex_raids or not fort.raid_info.is_exclusive):
+                                        raidinfo = fort.raid_info
+                                        raidpokemon = raidinfo.raid_pokemon
+                                        raidpokemonid = raidpokemon.pokemon_id or None
+                                        if raidpokemonid is None and raidinfo.is_exclusive and args.current_ex_raid_boss > 0:
                                             raidpokemonid = args.current_ex_raid_boss
-                                        raidpokemoncp = raidinfo['raidPokemon']['cp'] if 'raidPokemon' in raidinfo and 'cp' in raidinfo['raidPokemon'] else None
-                                        raidpokemonmove1 = raidinfo['raidPokemon']['move1'] if 'raidPokemon' in raidinfo and 'move1' in raidinfo['raidPokemon'] else None
-                                        if raidpokemonmove1:
-                                            raidpokemonmove1 = _POKEMONMOVE.values_by_name[raidpokemonmove1].number
-                                        raidpokemonmove2 = raidinfo['raidPokemon']['move2'] if 'raidPokemon' in raidinfo and 'move2' in raidinfo['raidPokemon'] else None
-                                        if raidpokemonmove2:
-                                            raidpokemonmove2 = _POKEMONMOVE.values_by_name[raidpokemonmove2].number
-                                        raidpokemonform = _FORM.values_by_name[raidinfo.get('raidPokemon', {}).get("pokemonDisplay", {}).get('form', 'FORM_UNSET')].number
-
-                                        raids[fort['id']] = {
-                                            'gym_id': fort['id'],
-                                            'level': _RAIDLEVEL.values_by_name[raidinfo['raidLevel']].number,
+                                        raidpokemoncp = raidpokemon.cp or None
+                                        raidpokemonmove1 = raidpokemon.move_1 or None
+                                        raidpokemonmove2 = raidpokemon.move_2 or None
+                                        raidpokemonform = raidpokemon.pokemon_display.form
+
+                                        raids[fort.id] = {
+                                            'gym_id': fort.id,
+                                            'level': raidinfo.raid_level,
                                             'spawn': datetime.utcfromtimestamp(
-                                                float(raidinfo['raidSpawnMs']) / 1000.0),
+                                                float(raidinfo.raid_spawn_ms) / 1000.0),
                                             'start': datetime.utcfromtimestamp(
-                                                float(raidinfo['raidBattleMs']) / 1000.0),
+                                                float(raidinfo.raid_battle_ms) / 1000.0),
                                             'end': datetime.utcfromtimestamp(
-                                                float(raidinfo['raidEndMs']) / 1000.0),
+                                                float(raidinfo.raid_end_ms) / 1000.0),
                                             'pokemon_id': raidpokemonid,
                                             'cp': raidpokemoncp,
                                             'move_1': raidpokemonmove1,
@@ -1514,27 +1517,27 @@ class Pogom(Flask):
                                         }
 
                                         if ('egg' in args.wh_types and
-                                                ('raidPokemon' not in raidinfo or 'pokemonId' not in raidinfo['raidPokemon'])) or (
+                                                not raidpokemon.pokemon_id) or (
                                                     'raid' in args.wh_types and
-                                                    'raidPokemon' in raidinfo and 'pokemonId' in raidinfo['raidPokemon']):
-                                            wh_raid = raids[fort['id']].copy()
+                                                    raidpokemon.pokemon_id):
+                                            wh_raid = raids[fort.id].copy()
                                             wh_raid.update({
                                                 'gym_id': b64_gym_id,
-                                                'team_id': _TEAMCOLOR.values_by_name[fort.get('ownedByTeam', 'NEUTRAL')].number,
-                                                'spawn': float(raidinfo['raidSpawnMs']) / 1000,
-                                                'start': round(float(raidinfo['raidBattleMs']) / 1000),
-                                                'end': round(float(raidinfo['raidEndMs']) / 1000),
-                                                'latitude': fort['latitude'],
-                                                'longitude': fort['longitude'],
+                                                'team_id': fort.owned_by_team,
+                                                'spawn': float(raidinfo.raid_spawn_ms) / 1000,
+                                                'start': round(float(raidinfo.raid_battle_ms) / 1000),
+                                                'end': round(float(raidinfo.raid_end_ms) / 1000),
+                                                'latitude': fort.latitude,
+                                                'longitude': fort.longitude,
                                                 'cp': raidpokemoncp,
                                                 'move_1': raidpokemonmove1 if raidpokemonmove1 else 0,
                                                 'move_2': raidpokemonmove2 if raidpokemonmove2 else 0,
                                                 'is_ex_raid_eligible':
-                                                    fort.get('isExRaidEligible', False),
+                                                    fort.is_ex_raid_eligible,
                                                 'is_ex_eligible':
-                                                    fort.get('isExRaidEligible', False),
+                                                    fort.is_ex_raid_eligible,
                                                 'ex_raid_eligible':
-                                                    fort.get('isExRaidEligible', False),
+                                                    fort.is_ex_raid_eligible,
                                                 'name': gym_name,
                                                 'description': gym_description,
                                                 'url': gym_url,
@@ -1545,21 +1548,16 @@ class Pogom(Flask):
                         scan_location['monradius'] = round(monmaxdist)
                     if fortmaxdist > 0:
                         scan_location['fortradius'] = round(fortmaxdist)
-                if "timeOfDay" in gmo_response_json:
-                    time_of_day = gmo_response_json.get("timeOfDay", "NONE")
-                if "clientWeather" in gmo_response_json:
-                    clientWeather = gmo_response_json["clientWeather"]
-                    for cw in clientWeather:
+                if gmo.time_of_day:
+                    time_of_day = gmo.time_of_day
+                if gmo.client_weather:
+                    for cw in gmo.client_weather:
                         # Parse Map Weather Information
-                        s2_cell_id = cw.get("s2CellId")
-                        if not s2_cell_id:
+                        if not cw.s2_cell_id:
                             continue
+                        s2_cell_id = str(cw.s2_cell_id)
 
-                        display_weather = cw.get("displayWeather")
-                        gameplay_weather = cw.get("gameplayWeather")
-                        weather_alerts = cw.get("alerts")
-
-                        s2s_cell_id = s2sphere.CellId(long(s2_cell_id))
+                        s2s_cell_id = s2sphere.CellId(cw.s2_cell_id)
                         s2s_cell = s2sphere.Cell(s2s_cell_id)
                         s2s_center = s2sphere.LatLng.from_point(s2s_cell.get_center())
                         s2s_lat = s2s_center.lat().degrees
@@ -1569,36 +1567,31 @@ class Pogom(Flask):
                             's2_cell_id': s2_cell_id,
                             'latitude': s2s_lat,
                             'longitude': s2s_lng,
-                            'time_of_day': _GETMAPOBJECTSRESPONSE_TIMEOFDAY.values_by_name[time_of_day].number,
+                            'time_of_day': time_of_day,
                         }
 
-                        if display_weather:
+                        if cw.HasField('display_weather'):
+                            display_weather = cw.display_weather
                             weather[s2_cell_id].update({
-                                'cloud_level': _DISPLAYWEATHER_DISPLAYLEVEL.values_by_name[display_weather.get("cloudLevel", "LEVEL_0")].number,
-                                'rain_level': _DISPLAYWEATHER_DISPLAYLEVEL.values_by_name[display_weather.get("rainLevel", "LEVEL_0")].number,
-                                'wind_level': _DISPLAYWEATHER_DISPLAYLEVEL.values_by_name[display_weather.get("windLevel", "LEVEL_0")].number,
-                                'snow_level': _DISPLAYWEATHER_DISPLAYLEVEL.values_by_name[display_weather.get("snowLevel", "LEVEL_0")].number,
-                                'fog_level': _DISPLAYWEATHER_DISPLAYLEVEL.values_by_name[display_weather.get("fogLevel", "LEVEL_0")].number,
-                                'wind_direction': display_weather.get("windDirection", 0),
+                                'cloud_level': display_weather.cloud_level,
+                                'rain_level': display_weather.rain_level,
+                                'wind_level': display_weather.wind_level,
+                                'snow_level': display_weather.snow_level,
+                                'fog_level': display_weather.fog_level,
+                                'wind_direction': display_weather.wind_direction,
                             })
 
-                        if gameplay_weather:
-                            gameplay_weathercondition = gameplay_weather.get("gameplayCondition", "NONE")
+                        if cw.HasField('gameplay_weather'):
                             weather[s2_cell_id].update({
-                                'gameplay_weather': _GAMEPLAYWEATHER_WEATHERCONDITION.values_by_name[gameplay_weathercondition].number,
+                                'gameplay_weather': cw.gameplay_weather.gameplay_condition,
                             })
 
-                        if weather_alerts:
-                            severity = "NONE"
-                            warn_weather = False
-
-                            for wa in weather_alerts:
-                                severity = wa.get("severity", "NONE")
-                                warn_weather = wa.get("warnWeather", False)
-
+                        if cw.alerts:
+                            # The last alert wins, as before.
+                            wa = cw.alerts[-1]
                             weather[s2_cell_id].update({
-                                'severity': _WEATHERALERT_SEVERITY.values_by_name[severity].number,
-                                'warn_weather': warn_weather,
+                                'severity': wa.severity,
+                                'warn_weather': wa.warn_weather,
                             })
 
         for proto in protos_dict:
@@ -1609,11 +1602,10 @@ class Pogom(Flask):
 
                 try:
                     gpr.ParseFromString(get_player_response_string)
-                    get_player_response_json = json.loads(MessageToJson(gpr))
                 except:
                     continue
 
-                playernickname = get_player_response_json.get("playerData", {}).get("username", "")
+                playernickname = gpr.player_data.username
                 if playernickname != "" and playernickname != deviceworker["name"] and args.use_username and len(playernickname) < 16 and 'quest_' not in playernickname:
                     deviceworker["name"] = playernickname
                     self.save_device(deviceworker, True)
@@ -1625,58 +1617,57 @@ class Pogom(Flask):
 
                 try:
                     ggir.ParseFromString(gym_get_info_response_string)
-                    gym_get_info_response_json = json.loads(MessageToJson(ggir))
                 except:
                     continue
 
-                gymstatusdefenders = gym_get_info_response_json.get("gymStatusAndDefenders")
-                if not gymstatusdefenders:
+                if not ggir.HasField('gym_status_and_defenders'):
                     continue
+                gymstatusdefenders = ggir.gym_status_and_defenders
 
-                fort = gymstatusdefenders.get("pokemonFortProto")
-                if not fort:
+                if not gymstatusdefenders.HasField('pokemon_fort_proto'):
                     continue
+                fort = gymstatusdefenders.pokemon_fort_proto
 
-                gym_id = fort["id"]
+                gym_id = fort.id
 
-                gymdefenders = gymstatusdefenders.get('gymDefender', [])
+                gymdefenders = gymstatusdefenders.gym_defender
 
                 park = Gym.get_gyms_park(gym_id)
 
-                gyms[fort['id']] = {
+                gyms[fort.id] = {
                     'gym_id':
-                        fort['id'],
+                        fort.id,
                     'team_id':
-                        _TEAMCOLOR.values_by_name[fort.get('ownedByTeam', 'NEUTRAL')].number,
+                        fort.owned_by_team,
                     'park':
                         park,
                     'guard_pokemon_id':
-                        _POKEMONID.values_by_name[fort.get('guardPokemonId', 'MISSINGNO')].number,
+                        fort.guard_pokemon_id,
                     'slots_available':
                         6 - len(gymdefenders),
                     'total_cp':
-                        float(fort["gymDisplay"].get('totalGymCp', 0)),
+                        float(fort.gym_display.total_gym_cp),
                     'enabled':
-                        fort.get('enabled', False),
+                        fort.enabled,
                     'latitude':
-                        fort['latitude'],
+                        fort.latitude,
                     'longitude':
-                        fort['longitude'],
+                        fort.longitude,
                     'last_modified':
                         datetime.utcfromtimestamp(
-                            float(fort['lastModifiedTimestampMs']) / 1000.0),
+                            float(fort.last_modified_timestamp_ms) / 1000.0),
                     'is_in_battle':
-                        fort.get('isInBattle', False),
+                        fort.is_in_battle,
                     'is_ex_raid_eligible':
-                        fort.get('isExRaidEligible', False)
+                        fort.is_ex_raid_eligible
                 }
 
                 gym_encountered[gym_id] = gyms[gym_id].copy()
 
                 gymdetails = self.gym_details.get(gym_id, Gym.get_gym_details(gym_id))
-                gym_name = gym_get_info_response_json["name"]
-                gym_description = gym_get_info_response_json.get("description", "")
-                gym_url = gym_get_info_response_json.get("url", "").replace('http://', 'https://')
+                gym_name = ggir.name
+                gym_description = ggir.description
+                gym_url = ggir.url.replace('http://', 'https://')
 
                 gym_details[gym_id] = {
                     'gym_id': gym_id,
@@ -1692,7 +1683,7 @@ class Pogom(Flask):
                 }
 
                 if 'gym' in args.wh_types:
-                    wh_gym = gyms[fort['id']].copy()
+                    wh_gym = gyms[fort.id].copy()
 
                     wh_gym.update({
                         'gym_id':
@@ -1700,24 +1691,24 @@ class Pogom(Flask):
                         'gym_name':
                             gym_name,
                         'lowest_pokemon_motivation':
-                            float(fort["gymDisplay"].get('lowestPokemonMotivation', 0)),
+                            float(fort.gym_display.lowest_pokemon_motivation),
                         'occupied_since':
-                            float(fort["gymDisplay"].get('occupiedMillis', 0)),
+                            float(fort.gym_display.occupied_millis),
                         'last_modified':
-                            float(fort['lastModifiedTimestampMs']),
+                            float(fort.last_modified_timestamp_ms),
                         'ex_raid_eligible':
-                            fort.get('isExRaidEligible', False),
+                            fort.is_ex_raid_eligible,
                         'is_ex_eligible':
-                            fort.get('isExRaidEligible', False)
+                            fort.is_ex_raid_eligible
                     })
 
                     self.wh_update_queue.put(('gym', wh_gym))
 
                 webhook_data = {
                     'id': str(gym_id),
-                    'latitude': fort['latitude'],
-                    'longitude': fort['longitude'],
-                    'team': _TEAMCOLOR.values_by_name[fort.get('ownedByTeam', 'NEUTRAL')].number,
+                    'latitude': fort.latitude,
+                    'longitude': fort.longitude,
+                    'team': fort.owned_by_team,
                     'name': gym_name,
                     'description': gym_description,
                     'url': gym_url,
@@ -1726,40 +1717,40 @@ class Pogom(Flask):
 
                 i = 0
                 for member in gymdefenders:
-                    motivatedpokemon = member.get("motivatedPokemon")
-                    if not motivatedpokemon:
+                    if not member.HasField('motivated_pokemon'):
                         continue
-                    gympokemon = motivatedpokemon.get("pokemon")
+                    motivatedpokemon = member.motivated_pokemon
+                    gympokemon = motivatedpokemon.pokemon
                     gym_members[i] = {
                         'gym_id':
                             gym_id,
                         'pokemon_uid':
-                            gympokemon.get("id"),
+                            gympokemon.id,
                         'cp_decayed':
-                            int(motivatedpokemon.get('cpNow', 0)),
+                            motivatedpokemon.cp_now,
                         'deployment_time':
                             datetime.utcnow() -
-                            timedelta(milliseconds=float(member.get("deploymentTotals", {}).get("deploymentDurationMs", 0)))
+                            timedelta(milliseconds=member.deployment_totals.deployment_duration_ms)
                     }
                     gym_pokemon[i] = {
-                        'pokemon_uid': gympokemon.get("id"),
-                        'pokemon_id': _POKEMONID.values_by_name[gympokemon.get("pokemonId", 'MISSINGNO')].number,
-                        'cp': int(motivatedpokemon.get("cpWhenDeployed", 0)),
-                        'num_upgrades': int(gympokemon.get("numUpgrades", 0)),
-                        'move_1': _POKEMONMOVE.values_by_name[gympokemon.get("move1")].number,
-                        'move_2': _POKEMONMOVE.values_by_name[gympokemon.get("move2")].number,
-                        'height': float(gympokemon.get("heightM", 0)),
-                        'weight': float(gympokemon.get("weightKg", 0)),
-                        'stamina': int(gympokemon.get("stamina", 0)),
-                        'stamina_max': int(gympokemon.get("staminaMax", 0)),
-                        'cp_multiplier': float(gympokemon.get("cpMultiplier", 0)),
-                        'additional_cp_multiplier': float(gympokemon.get("additionalCpMultiplier", 0)),
-                        'iv_defense': int(gympokemon.get("individualDefense", 0)),
-                        'iv_stamina': int(gympokemon.get("individualStamina", 0)),
-                        'iv_attack': int(gympokemon.get("individualAttack", 0)),
-                        'costume': _COSTUME.values_by_name[gympokemon.get("pokemonDisplay", {}).get("costume", 'COSTUME_UNSET')].number,
-                        'form': _FORM.values_by_name[gympokemon.get("pokemonDisplay", {}).get("form", 'FORM_UNSET')].number,
-                        'shiny': gympokemon.get("pokemonDisplay", {}).get("shiny"),
+                        'pokemon_uid': gympokemon.id,
+                        'pokemon_id': gympokemon.pokemon_id,
+                        'cp': motivatedpokemon.cp_when_deployed,
+                        'num_upgrades': gympokemon.num_upgrades,
+                        'move_1': gympokemon.move_1,
+                        'move_2': gympokemon.move_2,
+                        'height': gympokemon.height_m,
+                        'weight': gympokemon.weight_kg,
+                        'stamina': gympokemon.stamina,
+                        'stamina_max': gympokemon.stamina_max,
+                        'cp_multiplier': gympokemon.cp_multiplier,
+                        'additional_cp_multiplier': gympokemon.additional_cp_multiplier,
+                        'iv_defense': gympokemon.individual_defense,
+                        'iv_stamina': gympokemon.individual_stamina,
+                        'iv_attack': gympokemon.individual_attack,
+                        'costume': gympokemon.pokemon_display.costume,
+                        'form': gympokemon.pokemon_display.form,
+                        'shiny': gympokemon.pokemon_display.shiny,
                         'last_seen': datetime.utcnow(),
                     }
 
@@ -1768,7 +1759,7 @@ class Pogom(Flask):
                         del wh_pokemon['last_seen']
                         wh_pokemon.update({
                             'cp_decayed':
-                                int(motivatedpokemon.get('cpNow', 0)),
+                                motivatedpokemon.cp_now,
                             'deployment_time': calendar.timegm(
                                 gym_members[i]['deployment_time'].timetuple())
                         })
@@ -1786,20 +1777,17 @@ class Pogom(Flask):
 
                 try:
                     fdr.ParseFromString(fort_details_response_string)
-                    fort_details_response_json = json.loads(MessageToJson(fdr))
                 except:
                     continue
 
-                fort_id = fort_details_response_json.get("fortId")
+                fort_id = fdr.fort_id
                 if not fort_id:
                     continue
 
-                fort_type = fort_details_response_json.get("type", "")
-
-                if fort_type == "CHECKPOINT":
-                    fort_name = fort_details_response_json.get("name", "")
-                    fort_description = fort_details_response_json.get("description", "")
-                    fort_imageurls = fort_details_response_json.get("imageUrls", [])
+                if fdr.type == CHECKPOINT:
+                    fort_name = fdr.name
+                    fort_description = fdr.description
+                    fort_imageurls = fdr.image_urls
                     fort_imageurl = fort_imageurls[0].replace('http://', 'https://') if len(fort_imageurls) else ""
 
                     pokestop_details[fort_id] = {
@@ -1822,11 +1810,10 @@ class Pogom(Flask):
 
                 try:
                     frs.ParseFromString(fort_search_response_string)
-                    fort_search_response_json = json.loads(MessageToJson(frs))
                 except:
                     continue
 
-                if fort_search_response_json['result'] == 'INVENTORY_FULL' and 'devices' in args.wh_types:
+                if frs.result == FortSearchResponse.INVENTORY_FULL and 'devices' in args.wh_types:
                     wh_worker = {
                         'uuid': deviceworker['deviceid'],
                         'name': deviceworker['name'],
@@ -1835,12 +1822,19 @@ class Pogom(Flask):
                     }
                     self.wh_update_queue.put(('devices', wh_worker))
 
-                elif 'challengeQuest' in fort_search_response_json:
+                elif frs.HasField('challenge_quest'):
                     utcnow_datetime = datetime.utcnow()
 
-                    quest_json = fort_search_response_json["challengeQuest"]["quest"]
+                    # The quest is stored and rendered in its JSON form, so
+                    # only this sub-message goes through json_format.
+                    quest = frs.challenge_quest.quest
+                    quest_json = MessageToDict(quest)
 
-                    quest_pokestop = pokestops.get(quest_json["fortId"], Pokestop.get_stop(quest_json["fortId"]))
+                    quest_pokestop = pokestops.get(quest_json["fortId"])
+                    if quest_pokestop is None:
+                        location = Pokestop.get_location(quest_json["fortId"])
+                        quest_pokestop = {'latitude': location[0],
+                                          'longitude': location[1]}
 
                     pokestop_timezone_offset = get_timezone_offset(quest_pokestop['latitude'], quest_pokestop['longitude'])
 
@@ -1872,9 +1866,8 @@ class Pogom(Flask):
                         quest_result[quest_json["fortId"]]["reward_item"] = quest_json["questRewards"][0]["item"]["item"]
 
                     if 'devices' in args.wh_types:
-                        for reward in quest_json["questRewards"]:
-                            rewardtype = _QUESTREWARD_TYPE.values_by_name[reward["type"]].number
-                            if rewardtype == 7 and reward["pokemonEncounter"].get("pokemonDisplay", {}).get("shiny", False):
+                        for reward in quest.quest_rewards:
+                            if reward.type == 7 and reward.pokemon_encounter.pokemon_display.shiny:
                                 wh_worker = {
                                     'uuid': deviceworker['deviceid'],
                                     'name': deviceworker['name'],
@@ -1887,7 +1880,9 @@ class Pogom(Flask):
                         try:
                             wh_quest = quest_result[quest_json["fortId"]].copy()
                             if quest_pokestop:
-                                pokestopdetails = pokestop_details.get(quest_json["fortId"], Pokestop.get_pokestop_details(quest_json["fortId"]))
+                                pokestopdetails = pokestop_details.get(quest_json["fortId"])
+                                if pokestopdetails is None:
+                                    pokestopdetails = Pokestop.get_pokestop_details(quest_json["fortId"])
 
                                 wh_quest.update(
                                     {
@@ -1900,8 +1895,8 @@ class Pogom(Flask):
 
                                 wh_quest.update(
                                     {
-                                        "type": _QUESTTYPE.values_by_name[quest_json['questType']].number,
-                                        "target": quest_json['goal']['target'],
+                                        "type": quest.quest_type,
+                                        "target": quest.goal.target,
                                         "pokestop_name": pokestopdetails["name"],
                                         "pokestop_url": pokestopdetails["url"],
                                         "updated": calendar.timegm(datetime.utcnow().timetuple()),
@@ -1911,25 +1906,26 @@ class Pogom(Flask):
                                 rewards = []
                                 conditions = []
 
-                                for reward in quest_json["questRewards"]:
-                                    rewardtype = _QUESTREWARD_TYPE.values_by_name[reward["type"]].number
+                                for reward in quest.quest_rewards:
+                                    rewardtype = reward.type
                                     info = {}
                                     if rewardtype == 2:
                                         info = {
-                                            "item_id": _ITEMID.values_by_name[reward["item"]["item"]].number,
-                                            "amount": reward["item"]["amount"],
+                                            "item_id": reward.item.item,
+                                            "amount": reward.item.amount,
                                         }
                                     elif rewardtype == 3:
                                         info = {
-                                            "amount": reward["stardust"],
+                                            "amount": reward.stardust,
                                         }
                                     elif rewardtype == 7:
+                                        encounter_display = reward.pokemon_encounter.pokemon_display
                                         info = {
-                                            "pokemon_id": _POKEMONID.values_by_name[reward["pokemonEncounter"]["pokemonId"]].number,
-                                            "costume_id": _COSTUME.values_by_name[reward["pokemonEncounter"].get("pokemonDisplay", {}).get("costume", 'COSTUME_UNSET')].number,
-                                            "form_id": _FORM.values_by_name[reward["pokemonEncounter"].get("pokemonDisplay", {}).get("form", 'FORM_UNSET')].number,
-                                            "gender_id": _GENDER.values_by_name[reward["pokemonEncounter"].get("pokemonDisplay", {}).get('gender', 'GENDER_UNSET')].number,
-                                            "shiny": reward["pokemonEncounter"].get("pokemonDisplay", {}).get("shiny", False),
+                                            "pokemon_id": reward.pokemon_encounter.pokemon_id,
+                                            "costume_id": encounter_display.costume,
+                                            "form_id": encounter_display.form,
+                                            "gender_id": encounter_display.gender,
+                                            "shiny": encounter_display.shiny,
                                         }
 
                                     rewards.append({
@@ -1941,8 +1937,8 @@ class Pogom(Flask):
                                     "rewards": rewards
                                 })
 
-                                for condition in quest_json.get('goal', {}).get('condition', []):
-                                    conditiontype = _QUESTCONDITION_CONDITIONTYPE.values_by_name[condition.get('type', "UNSET")].number
+                                for condition in quest.goal.condition:
+                                    conditiontype = condition.type
                                     condition_dict = {
                                         "type": conditiontype,
                                     }
@@ -1950,44 +1946,29 @@ class Pogom(Flask):
                                     info = {}
 
                                     if conditiontype == 1:
-                                        pokemontype = condition.get('withPokemonType', {}).get('pokemonType', ["POKEMON_TYPE_NONE"])
-                                        types = []
-                                        for poketype in pokemontype:
-                                            types.append(_POKEMONTYPE.values_by_name[poketype].number)
                                         info = {
-                                            "pokemon_type_ids": types
+                                            "pokemon_type_ids": list(condition.with_pokemon_type.pokemon_type) or [0]
                                         }
                                     elif conditiontype == 2:
-                                        pokemonids = condition.get('withPokemonCategory', {}).get('pokemonIds', ["MISSINGNO"])
-                                        ids = []
-                                        for pokemonid in pokemonids:
-                                            ids.append(_POKEMONID.values_by_name[pokemonid].number)
                                         info = {
-                                            "pokemon_ids": ids
+                                            "pokemon_ids": list(condition.with_pokemon_category.pokemon_ids) or [0]
                                         }
                                     elif conditiontype == 7:
-                                        raidLevel = condition.get('withRaidLevel', {}).get('raidLevel', ['RAID_LEVEL_UNSET'])
-                                        raidlevels = []
-                                        for level in raidLevel:
-                                            raidlevels.append(_RAIDLEVEL.values_by_name[level].number)
                                         info = {
-                                            "raid_levels": raidlevels
+                                            "raid_levels": list(condition.with_raid_level.raid_level) or [0]
                                         }
                                     elif conditiontype == 8:
-                                        throwType = condition.get('withThrowType', {}).get('throwType', 'ACTIVITY_UNKNOWN')
                                         info = {
-                                            "throw_type_id": _ACTIVITYTYPE.values_by_name[throwType].number
+                                            "throw_type_id": condition.with_throw_type.throw_type
                                         }
                                     elif conditiontype == 11:
-                                        item = condition.get('withItem', {})
-                                        if item:
+                                        if condition.with_item.item:
                                             info = {
-                                                "item_id": _ITEMID.values_by_name[item.get('item', 'ITEM_UNKNOWN')].number
+                                                "item_id": condition.with_item.item
                                             }
                                     elif conditiontype == 14:
-                                        throwType = condition.get('withThrowType', {}).get('throwType', 'ACTIVITY_UNKNOWN')
                                         info = {
-                                            "throw_type_id": _ACTIVITYTYPE.values_by_name[throwType].number
+                                            "throw_type_id": condition.with_throw_type.throw_type
                                         }
 
                                     if info:
@@ -2008,25 +1989,25 @@ class Pogom(Flask):
                 encounter = EncounterResponse()
                 try:
                     encounter.ParseFromString(encounter_response_string)
-                    encounter_response_json = json.loads(MessageToJson(encounter))
                 except:
                     continue
 
-                if "wildPokemon" in encounter_response_json:
-                    wildpokemon = encounter_response_json["wildPokemon"]
+                if encounter.HasField('wild_pokemon'):
+                    wildpokemon = encounter.wild_pokemon
 
-                    if "pokemonData" not in wildpokemon:
+                    if not wildpokemon.HasField('pokemon_data'):
                         continue
+                    pokemon_data = wildpokemon.pokemon_data
 
-                    spawn_id = wildpokemon['spawnPointId']
+                    spawn_id = wildpokemon.spawn_point_id
 
-                    sp = SpawnPoint.get_by_id(spawn_id, wildpokemon['latitude'], wildpokemon['longitude'])
+                    sp = SpawnPoint.get_by_id(spawn_id, wildpokemon.latitude, wildpokemon.longitude)
                     sp['last_scanned'] = datetime.utcnow()
                     spawn_points[spawn_id] = sp
                     sp['missed_count'] = 0
 
                     sighting = {
-                        'encounter_id': long(wildpokemon['encounterId']),
+                        'encounter_id': wildpokemon.encounter_id,
                         'spawnpoint_id': spawn_id,
                         'scan_time': now_date,
                         'tth_secs': None
@@ -2037,9 +2018,9 @@ class Pogom(Flask):
 
                     # time_till_hidden_ms was overflowing causing a negative integer.
                     # It was also returning a value above 3.6M ms.
-                    if 0 < long(wildpokemon.get('timeTillHiddenMs', -1)) < 3600000:
+                    if 0 < wildpokemon.time_till_hidden_ms < 3600000:
                         d_t_secs = date_secs(datetime.utcfromtimestamp(
-                            now() + long(wildpokemon['timeTillHiddenMs']) / 1000.0))
+                            now() + wildpokemon.time_till_hidden_ms / 1000.0))
 
                         # Cover all bases, make sure we're using values < 3600.
                         # Warning: python uses modulo as the least residue, not as
@@ -2068,7 +2049,7 @@ class Pogom(Flask):
                     if (not SpawnPoint.tth_found(sp) or sighting['tth_secs']):
                         SpawnpointDetectionData.classify(sp, scan_location, now_secs,
                                                          sighting)
-                        sightings[long(wildpokemon['encounterId'])] = sighting
+                        sightings[wildpokemon.encounter_id] = sighting
 
                     sp['last_scanned'] = datetime.utcnow()
 
@@ -2076,32 +2057,32 @@ class Pogom(Flask):
                     seconds_until_despawn = (start_end[1] - now_secs) % 3600
                     disappear_time = now_date + timedelta(seconds=seconds_until_despawn)
 
-                    pokemon_id = _POKEMONID.values_by_name[wildpokemon['pokemonData']['pokemonId']].number
+                    pokemon_id = pokemon_data.pokemon_id
 
-                    gender = _GENDER.values_by_name[wildpokemon['pokemonData']["pokemonDisplay"].get('gender', 'GENDER_UNSET')].number
-                    costume = _COSTUME.values_by_name[wildpokemon['pokemonData']["pokemonDisplay"].get('costume', 'COSTUME_UNSET')].number
-                    form = _FORM.values_by_name[wildpokemon['pokemonData']["pokemonDisplay"].get('form', 'FORM_UNSET')].number
-                    weather_boosted_condition = _WEATHERCONDITION.values_by_name[wildpokemon['pokemonData']["pokemonDisplay"].get('weatherBoostedCondition', 'NONE')].number
+                    gender = pokemon_data.pokemon_display.gender
+                    costume = pokemon_data.pokemon_display.costume
+                    form = pokemon_data.pokemon_display.form
+                    weather_boosted_condition = pokemon_data.pokemon_display.weather_boosted_condition
 
-                    printPokemon(pokemon_id, wildpokemon['latitude'], wildpokemon['longitude'],
+                    printPokemon(pokemon_id, wildpokemon.latitude, wildpokemon.longitude,
                                  disappear_time)
 
-                    pokemon[long(wildpokemon['encounterId'])] = {
-                        'encounter_id': long(wildpokemon['encounterId']),
+                    pokemon[wildpokemon.encounter_id] = {
+                        'encounter_id': wildpokemon.encounter_id,
                         'spawnpoint_id': spawn_id,
                         'pokemon_id': pokemon_id,
-                        'latitude': wildpokemon['latitude'],
-                        'longitude': wildpokemon['longitude'],
+                        'latitude': wildpokemon.latitude,
+                        'longitude': wildpokemon.longitude,
                         'disappear_time': disappear_time,
-                        'individual_attack': wildpokemon['pokemonData'].get('individualAttack', 0),
-                        'individual_defense': wildpokemon['pokemonData'].get('individualDefense', 0),
-                        'individual_stamina': wildpokemon['pokemonData'].get('individualStamina', 0),
-                        'move_1': _POKEMONMOVE.values_by_name[wildpokemon['pokemonData'].get('move1', 'MOVE_UNSET')].number,
-                        'move_2': _POKEMONMOVE.values_by_name[wildpokemon['pokemonData'].get('move2', 'MOVE_UNSET')].number,
-                        'cp': wildpokemon['pokemonData'].get('cp', None),
-                        'cp_multiplier': wildpokemon['pokemonData'].get('cpMultiplier', None),
-                        'height': wildpokemon['pokemonData'].get('heightM', None),
-                        'weight': wildpokemon['pokemonData'].get('weightKg', None),
+                        'individual_attack': pokemon_data.individual_attack,
+                        'individual_defense': pokemon_data.individual_defense,
+                        'individual_stamina': pokemon_data.individual_stamina,
+                        'move_1': pokemon_data.move_1,
+                        'move_2': pokemon_data.move_2,
+                        'cp': pokemon_data.cp or None,
+                        'cp_multiplier': pokemon_data.cp_multiplier or None,
+                        'height': pokemon_data.height_m or None,
+                        'weight': pokemon_data.weight_kg or None,
                         'gender': gender,
                         'costume': costume,
                         'form': form,
@@ -2109,12 +2090,12 @@ class Pogom(Flask):
                     }
 
                     if 'devices' in args.wh_types:
-                        if wildpokemon['pokemonData']["pokemonDisplay"].get("shiny", False):
+                        if pokemon_data.pokemon_display.shiny:
                             wh_worker = {
                                 'uuid': deviceworker['deviceid'],
                                 'name': deviceworker['name'],
                                 'type': 'shiny_pokemon',
-                                'message': 'A Shiny Pokemon was discovered for this device at (' + str(wildpokemon['latitude']) + ',' + str(wildpokemon['longitude']) + ').'
+                                'message': 'A Shiny Pokemon was discovered for this device at (' + str(wildpokemon.latitude) + ',' + str(wildpokemon.longitude) + ').'
                             }
                             self.wh_update_queue.put(('devices', wh_worker))
 
@@ -2122,27 +2103,27 @@ class Pogom(Flask):
                         if (pokemon_id in args.webhook_whitelist or
                             (not args.webhook_whitelist and pokemon_id
                              not in args.webhook_blacklist)):
-                            wh_poke = pokemon[long(wildpokemon['encounterId'])].copy()
+                            wh_poke = pokemon[wildpokemon.encounter_id].copy()
                             wh_poke.update({
                                 'disappear_time': calendar.timegm(
                                     disappear_time.timetuple()),
                                 'last_modified_time': now(),
-                                'time_until_hidden_ms': float(wildpokemon.get('timeTillHiddenMs', 0)),
+                                'time_until_hidden_ms': float(wildpokemon.time_till_hidden_ms),
                                 'verified': SpawnPoint.tth_found(sp),
                                 'seconds_until_despawn': seconds_until_despawn,
                                 'spawn_start': start_end[0],
                                 'spawn_end': start_end[1],
                                 'player_level': int(trainerlvl),
-                                'individual_attack': wildpokemon['pokemonData'].get('individualAttack', 0),
-                                'individual_defense': wildpokemon['pokemonData'].get('individualDefense', 0),
-                                'individual_stamina': wildpokemon['pokemonData'].get('individualStamina', 0),
-                                'move_1': _POKEMONMOVE.values_by_name[wildpokemon['pokemonData'].get('move1', 'MOVE_UNSET')].number,
-                                'move_2': _POKEMONMOVE.values_by_name[wildpokemon['pokemonData'].get('move2', 'MOVE_UNSET')].number,
-                                'cp': wildpokemon['pokemonData'].get('cp', 0),
-                                'cp_multiplier': wildpokemon['pokemonData'].get('cpMultiplier', 0),
-                                'height': wildpokemon['pokemonData'].get('heightM', 0),
-                                'weight': wildpokemon['pokemonData'].get('weightKg', 0),
-                                'pokemon_level': calc_pokemon_level(wildpokemon['pokemonData'].get('cpMultiplier', 0)),
+                                'individual_attack': pokemon_data.individual_attack,
+                                'individual_defense': pokemon_data.individual_defense,
+                                'individual_stamina': pokemon_data.individual_stamina,
+                                'move_1': pokemon_data.move_1,
+                                'move_2': pokemon_data.move_2,
+                                'cp': pokemon_data.cp,
+                                'cp_multiplier': pokemon_data.cp_multiplier,
+                                'height': pokemon_data.height_m,
+                                'weight': pokemon_data.weight_kg,
+                                'pokemon_level': calc_pokemon_level(pokemon_data.cp_multiplier),
                                 'weather_id': weather_boosted_condition,
                                 'expire_timestamp_verified': SpawnPoint.tth_found(sp)
                             })
@@ -2167,6 +2148,24 @@ class Pogom(Flask):
 
         self.db_update_queue.put((ScannedLocation, {0: scan_location}))
 
+        # Shared routes have to include new forts and skip new quests/raids.
+        if pokestops:
+            self.route_cache.note_forts('walk_pokestop', pokestops.keys())
+        if gyms:
+            self.route_cache.note_forts('teleport_gym', gyms.keys())
+        if quest_result:
+            self.route_cache.invalidate('walk_pokestop')
+        if raids:
+            self.route_cache.invalidate('teleport_gym')
+
+        # The next posts about the same objects shouldn't have to wait for
+        # the database writer to know about them.
+        for model, data in ((Pokemon, pokemon), (Pokestop, pokestops),
+                            (PokestopDetails, pokestop_details), (Gym, gyms),
+                            (PokestopMember, nearby_pokemons)):
+            remember_upserted(model, data.values())
+
+        add_geocells(pokemon, pokestops, gyms)
         if pokemon:
             self.db_update_queue.put((Pokemon, pokemon))
         if pokestops:
@@ -2254,6 +2253,17 @@ class Pogom(Flask):
 
         return start <= dottedQuadToNum(ip) <= end
 
+    # Make sure fingerprint isn't blacklisted.
+    def _check_fingerprint(self):
+        fingerprint_blacklisted = any([
+            fingerprints['no_referrer'](request),
+            fingerprints['iPokeGo'](request)
+        ])
+
+        if fingerprint_blacklisted:
+            log.debug('User denied access: blacklisted fingerprint.')
+            abort(403)
+
     def set_control_flags(self, control):
         self.control_flags = control
 
@@ -2415,15 +2425,7 @@ class Pogom(Flask):
                                )
 
     def raw_data(self):
-        # Make sure fingerprint isn't blacklisted.
-        fingerprint_blacklisted = any([
-            fingerprints['no_referrer'](request),
-            fingerprints['iPokeGo'](request)
-        ])
-
-        if fingerprint_blacklisted:
-            log.debug('User denied access: blacklisted fingerprint.')
-            abort(403)
+        self._check_fingerprint()
 
         self.heartbeat[0] = now()
         args = get_args()
@@ -2734,15 +2736,7 @@ class Pogom(Flask):
         return jsonify(d)
 
     def raw_raid(self):
-        # Make sure fingerprint isn't blacklisted.
-        fingerprint_blacklisted = any([
-            fingerprints['no_referrer'](request),
-            fingerprints['iPokeGo'](request)
-        ])
-
-        if fingerprint_blacklisted:
-            log.debug('User denied access: blacklisted fingerprint.')
-            abort(403)
+        self._check_fingerprint()
 
         self.heartbeat[0] = now()
         args = get_args()
@@ -2779,15 +2773,7 @@ class Pogom(Flask):
         return False
 
     def raw_devices(self):
-        # Make sure fingerprint isn't blacklisted.
-        fingerprint_blacklisted = any([
-            fingerprints['no_referrer'](request),
-            fingerprints['iPokeGo'](request)
-        ])
-
-        if fingerprint_blacklisted:
-            log.debug('User denied access: blacklisted fingerprint.')
-            abort(403)
+        self._check_fingerprint()
 
         self.heartbeat[0] = now()
         args = get_args()
@@ -2812,6 +2798,7 @@ class Pogom(Flask):
 
                 for deviceworker in active_devices:
                     if enteredusername == 'admin' or enteredusername == deviceworker['username']:
+                        deviceworker = deviceworker.copy()
                         d['devices'].append(deviceworker)
                         uuid = deviceworker['deviceid']
                         deviceworker['route'] = 0
@@ -2826,15 +2813,7 @@ class Pogom(Flask):
         return jsonify(d)
 
     def raw_quests(self):
-        # Make sure fingerprint isn't blacklisted.
-        fingerprint_blacklisted = any([
-            fingerprints['no_referrer'](request),
-            fingerprints['iPokeGo'](request)
-        ])
-
-        if fingerprint_blacklisted:
-            log.debug('User denied access: blacklisted fingerprint.')
-            abort(403)
+        self._check_fingerprint()
 
         self.heartbeat[0] = now()
         args = get_args()
@@ -2871,26 +2850,9 @@ class Pogom(Flask):
 
         return jsonify(d)
 
+    # The device's schedule along a GPX file, parsed once and shared.
     def get_gpx_route(self, routename):
-        result = []
-
-        gpx_file = open(routename, 'r')
-
-        gpx = gpxpy.parse(gpx_file)
-
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    result.append((round(point.latitude, 5), round(point.longitude, 5)))
-
-        for waypoint in gpx.waypoints:
-            result.append((round(waypoint.latitude, 5), round(waypoint.longitude, 5)))
-
-        for route in gpx.routes:
-            for point in route.points:
-                result.append((round(point.latitude, 5), round(point.longitude, 5)))
-
-        return result
+        return self.gpx_routes.schedule(routename)
 
     def changeDeviceLoc(self, lat, lon, uuid):
         canusedevice, devicename = self.trusted_device(uuid)
@@ -2904,9 +2866,10 @@ class Pogom(Flask):
 
         if uuid in self.deviceschedules:
             self.deviceschedules[uuid] = []
+        self.claims.release_all(uuid)
 
         if uuid in self.devicesscheduling:
-            self.devicesscheduling.remove(uuid)
+            self.devicesscheduling.discard(uuid)
 
         deviceworker['latitude'] = round(lat, 5)
         deviceworker['longitude'] = round(lon, 5)
@@ -2958,14 +2921,13 @@ class Pogom(Flask):
 
                 return jsonify(d)
             else:
-                self.devicesscheduling.remove(uuid)
+                self.devicesscheduling.discard(uuid)
 
         last_updated = deviceworker['last_updated']
         difference = (datetime.utcnow() - last_updated).total_seconds()
 
         scheduletimeout = request_json.get('scheduletimeout', args.scheduletimeout)
         maxradius = request_json.get('maxradius', args.maxradius)
-        stepsize = request_json.get('stepsize', args.stepsize)
         unknown_tth = request_json.get('unknown_tth', False)
         maxpoints = request_json.get('maxpoints', False)
         geofence = request_json.get('geofence', "")
@@ -2974,76 +2936,6 @@ class Pogom(Flask):
         speed = request_json.get('speed', args.speed)
         arrived_range = request_json.get('arrived_range', args.arrived_range)
 
-        if not isinstance(scheduletimeout, (int, long)):
-            try:
-                scheduletimeout = int(scheduletimeout)
-            except:
-                pass
-        if not isinstance(maxradius, (int, long)):
-            try:
-                maxradius = int(maxradius)
-            except:
-                pass
-        if not isinstance(stepsize, (float)):
-            try:
-                stepsize = int(stepsize)
-            except:
-                pass
-        if not isinstance(unknown_tth, (bool, int, long)):
-            try:
-                if unknown_tth.lower() == 'true':
-                    unknown_tth = True
-                elif unknown_tth.lower() == 'false':
-                    unknown_tth = False
-                else:
-                    unknown_tth = int(unknown_tth)
-            except:
-                pass
-        if not isinstance(maxpoints, (bool, int, long)):
-            try:
-                if maxpoints.lower() == 'true':
-                    maxpoints = True
-                elif maxpoints.lower() == 'false':
-                    maxpoints = False
-                else:
-                    maxpoints = int(maxpoints)
-            except:
-                pass
-        if not isinstance(routing_outside_geofences, bool):
-            try:
-                if routing_outside_geofences.lower() == 'true':
-                    routing_outside_geofences = True
-                else:
-                    routing_outside_geofences = False
-            except:
-                pass
-        if not isinstance(no_overlap, bool):
-            try:
-                if no_overlap.lower() == 'true':
-                    no_overlap = True
-                else:
-                    no_overlap = False
-            except:
-                pass
-        if not isinstance(mapcontrolled, bool):
-            try:
-                if mapcontrolled.lower() == 'true':
-                    mapcontrolled = True
-                else:
-                    mapcontrolled = False
-            except:
-                pass
-        if not isinstance(speed, (int, long)):
-            try:
-                speed = int(speed)
-            except:
-                pass
-        if not isinstance(arrived_range, (int, long)):
-            try:
-                arrived_range = int(arrived_range)
-            except:
-                pass
-
         deviceworker['no_overlap'] = no_overlap
         deviceworker['mapcontrolled'] = mapcontrolled
 
@@ -3053,26 +2945,25 @@ class Pogom(Flask):
         if len(self.deviceschedules[uuid]) > 0:
             nexttarget = self.deviceschedules[uuid][0]
 
-            distance_m = geopy.distance.vincenty((latitude, longitude), (nexttarget[0], nexttarget[1])).meters
+            distance_m = haversine_distance(latitude, longitude, nexttarget[0], nexttarget[1])
 
             if distance_m <= arrived_range:
                 if len(self.deviceschedules[uuid]) > 0:
+                    self.claims.release(uuid, self.deviceschedules[uuid][0][2])
                     del self.deviceschedules[uuid][0]
 
         if len(self.deviceschedules[uuid]) == 0:
             scheduled_points = []
             if no_overlap:
-                for dev in self.get_active_devices():
-                    if dev.get('no_overlap') and dev['fetching'] == 'walk_spawnpoint':
-                        if dev['deviceid'] in self.devicesscheduling:
-                            d = {}
-                            d['latitude'] = deviceworker['latitude']
-                            d['longitude'] = deviceworker['longitude']
-                            return jsonify(d)
+                if not self.claims.start_planning('walk_spawnpoint', uuid):
+                    d = {}
+                    d['latitude'] = deviceworker['latitude']
+                    d['longitude'] = deviceworker['longitude']
+                    return jsonify(d)
 
-                        scheduled_points += [item[2] for item in self.deviceschedules[dev['deviceid']]]
+                scheduled_points = self.claims.claimed('walk_spawnpoint')
 
-            self.devicesscheduling.append(uuid)
+            self.devicesscheduling.add(uuid)
 
             if not self.geofences:
                 from .geofence import Geofences
@@ -3083,6 +2974,8 @@ class Pogom(Flask):
             nextlongitude = longitude
             if unknown_tth and len(self.deviceschedules[uuid]) == 0:
                 self.deviceschedules[uuid] = SpawnPoint.get_nearby_spawnpoints(latitude, longitude, maxradius, False, maxpoints, geofence, scheduled_points, self.geofences, routing_outside_geofences)
+            if no_overlap:
+                self.claims.claim('walk_spawnpoint', uuid, self.deviceschedules[uuid])
             if len(self.deviceschedules[uuid]) == 0:
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
         else:
@@ -3094,7 +2987,7 @@ class Pogom(Flask):
         dlat = abs(nexttarget[0] - nextlatitude)
         dlong = abs(nexttarget[1] - nextlongitude)
 
-        distance_m = geopy.distance.vincenty((nextlatitude, nextlongitude), (nexttarget[0], nexttarget[1])).meters
+        distance_m = haversine_distance(nextlatitude, nextlongitude, nexttarget[0], nexttarget[1])
         num_seconds = distance_m / speed * 3.6  # 7.6 = 2x walk speed
         # log.info("{} - Distance to go: {} metres, Time until arrival: {} seconds".format(deviceworker['name'], distance_m, num_seconds))
 
@@ -3162,42 +3055,12 @@ class Pogom(Flask):
 
                 return jsonify(d)
             else:
-                self.devicesscheduling.remove(uuid)
+                self.devicesscheduling.discard(uuid)
 
         scheduletimeout = request_json.get('scheduletimeout', args.scheduletimeout)
-        stepsize = request_json.get('stepsize', args.stepsize)
         speed = request_json.get('speed', args.speed)
         arrived_range = request_json.get('arrived_range', args.arrived_range)
 
-        if not isinstance(scheduletimeout, (int, long)):
-            try:
-                scheduletimeout = int(scheduletimeout)
-            except:
-                pass
-        if not isinstance(stepsize, (float)):
-            try:
-                stepsize = int(stepsize)
-            except:
-                pass
-        if not isinstance(mapcontrolled, bool):
-            try:
-                if mapcontrolled.lower() == 'true':
-                    mapcontrolled = True
-                else:
-                    mapcontrolled = False
-            except:
-                pass
-        if not isinstance(speed, (int, long)):
-            try:
-                speed = int(speed)
-            except:
-                pass
-        if not isinstance(arrived_range, (int, long)):
-            try:
-                arrived_range = int(arrived_range)
-            except:
-                pass
-
         deviceworker['mapcontrolled'] = mapcontrolled
         deviceworker['no_overlap'] = False
 
@@ -3216,7 +3079,7 @@ class Pogom(Flask):
         if len(self.deviceschedules[uuid]) > 0:
             nexttarget = self.deviceschedules[uuid][0]
 
-            distance_m = geopy.distance.vincenty((latitude, longitude), (nexttarget[0], nexttarget[1])).meters
+            distance_m = haversine_distance(latitude, longitude, nexttarget[0], nexttarget[1])
 
             if distance_m <= arrived_range:
                 if len(self.deviceschedules[uuid]) > 0:
@@ -3233,7 +3096,7 @@ class Pogom(Flask):
                 log.warning("No or incorrect GPX supplied: {}".format(gpxfilename))
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
 
-            self.devicesscheduling.append(uuid)
+            self.devicesscheduling.add(uuid)
             self.deviceschedules[uuid] = self.get_gpx_route(gpxfilename)
             if len(self.deviceschedules[uuid]) == 0:
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
@@ -3248,7 +3111,7 @@ class Pogom(Flask):
         dlat = abs(nexttarget[0] - nextlatitude)
         dlong = abs(nexttarget[1] - nextlongitude)
 
-        distance_m = geopy.distance.vincenty((nextlatitude, nextlongitude), (nexttarget[0], nexttarget[1])).meters
+        distance_m = haversine_distance(nextlatitude, nextlongitude, nexttarget[0], nexttarget[1])
         num_seconds = distance_m / speed * 3.6  # 7.6 = 2x walk speed
         # log.info("{} - Distance to go: {} metres, Time until arrival: {} seconds".format(deviceworker['name'], distance_m, num_seconds))
 
@@ -3316,11 +3179,10 @@ class Pogom(Flask):
 
                 return jsonify(d)
             else:
-                self.devicesscheduling.remove(uuid)
+                self.devicesscheduling.discard(uuid)
 
         scheduletimeout = request_json.get('scheduletimeout', args.scheduletimeout)
         maxradius = request_json.get('maxradius', args.maxradius)
-        stepsize = request_json.get('stepsize', args.stepsize)
         questless = request_json.get('questless', False)
         maxpoints = request_json.get('maxpoints', False)
         geofence = request_json.get('geofence', "")
@@ -3329,68 +3191,6 @@ class Pogom(Flask):
         speed = request_json.get('speed', args.speed)
         arrived_range = request_json.get('arrived_range', args.arrived_range)
 
-        if not isinstance(scheduletimeout, (int, long)):
-            try:
-                scheduletimeout = int(scheduletimeout)
-            except:
-                pass
-        if not isinstance(maxradius, (int, long)):
-            try:
-                maxradius = int(maxradius)
-            except:
-                pass
-        if not isinstance(stepsize, (float)):
-            try:
-                stepsize = int(stepsize)
-            except:
-                pass
-        if not isinstance(questless, (bool, int, long)):
-            try:
-                if questless.lower() == 'true':
-                    questless = True
-                elif questless.lower() == 'false':
-                    questless = False
-                else:
-                    questless = int(questless)
-            except:
-                pass
-        if not isinstance(maxpoints, (bool, int, long)):
-            try:
-                if maxpoints.lower() == 'true':
-                    maxpoints = True
-                elif maxpoints.lower() == 'false':
-                    maxpoints = False
-                else:
-                    maxpoints = int(maxpoints)
-            except:
-                pass
-        if not isinstance(routing_outside_geofences, bool):
-            try:
-                if routing_outside_geofences.lower() == 'true':
-                    routing_outside_geofences = True
-                else:
-                    routing_outside_geofences = False
-            except:
-                pass
-        if not isinstance(no_overlap, bool):
-            try:
-                if no_overlap.lower() == 'true':
-                    no_overlap = True
-                else:
-                    no_overlap = False
-            except:
-                pass
-        if not isinstance(speed, (int, long)):
-            try:
-                speed = int(speed)
-            except:
-                pass
-        if not isinstance(arrived_range, (int, long)):
-            try:
-                arrived_range = int(arrived_range)
-            except:
-                pass
-
         deviceworker['no_overlap'] = no_overlap
         deviceworker['mapcontrolled'] = mapcontrolled
 
@@ -3402,26 +3202,46 @@ class Pogom(Flask):
         if len(self.deviceschedules[uuid]) > 0:
             nexttarget = self.deviceschedules[uuid][0]
 
-            distance_m = geopy.distance.vincenty((latitude, longitude), (nexttarget[0], nexttarget[1])).meters
+            distance_m = haversine_distance(latitude, longitude, nexttarget[0], nexttarget[1])
 
             if distance_m <= arrived_range:
                 if len(self.deviceschedules[uuid]) > 0:
+                    self.claims.release(uuid, self.deviceschedules[uuid][0][2])
                     del self.deviceschedules[uuid][0]
 
-        if len(self.deviceschedules[uuid]) == 0:
+        if len(self.deviceschedules[uuid]) == 0 and self.route_cache_usable(geofence, maxradius):
+            if not self.geofences:
+                from .geofence import Geofences
+                self.geofences = Geofences()
+
+            # Devices walking the same geofence share a cached route.
+            for quests in ([questless, False] if questless else [False]):
+                self.deviceschedules[uuid] = self.route_cache.get_route(
+                    ('walk_pokestop', geofence.lower(), bool(quests),
+                     routing_outside_geofences),
+                    uuid, latitude, longitude,
+                    self.geofence_route(Pokestop.get_nearby_pokestops, geofence, 0, bool(quests), False, geofence, [], self.geofences, routing_outside_geofences),
+                    no_overlap, route_limit(quests, maxpoints))
+                if len(self.deviceschedules[uuid]) > 0:
+                    break
+            if no_overlap:
+                self.claims.claim('walk_pokestop', uuid, self.deviceschedules[uuid])
+            nextlatitude = latitude
+            nextlongitude = longitude
+            if len(self.deviceschedules[uuid]) == 0:
+                return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
+        elif len(self.deviceschedules[uuid]) == 0:
             scheduled_points = []
             if no_overlap:
-                for dev in self.get_active_devices():
-                    if dev.get('no_overlap') and dev['fetching'] == 'walk_pokestop':
-                        if dev['deviceid'] in self.devicesscheduling:
-                            d = {}
-                            d['latitude'] = deviceworker['latitude']
-                            d['longitude'] = deviceworker['longitude']
-                            return jsonify(d)
+                if not self.claims.start_planning('walk_pokestop', uuid):
+                    d = {}
+                    d['latitude'] = deviceworker['latitude']
+                    d['longitude'] = deviceworker['longitude']
+                    return jsonify(d)
 
-                        scheduled_points += [item[2] for item in self.deviceschedules[dev['deviceid']]]
+                scheduled_points = self.claims.claimed('walk_pokestop')
 
-            self.devicesscheduling.append(uuid)
+            self.devicesscheduling.add(uuid)
 
             if not self.geofences:
                 from .geofence import Geofences
@@ -3432,6 +3252,8 @@ class Pogom(Flask):
             nextlongitude = longitude
             if questless and len(self.deviceschedules[uuid]) == 0:
                 self.deviceschedules[uuid] = Pokestop.get_nearby_pokestops(latitude, longitude, maxradius, False, maxpoints, geofence, scheduled_points, self.geofences, routing_outside_geofences)
+            if no_overlap:
+                self.claims.claim('walk_pokestop', uuid, self.deviceschedules[uuid])
             if len(self.deviceschedules[uuid]) == 0:
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
         else:
@@ -3443,7 +3265,7 @@ class Pogom(Flask):
         dlat = abs(nexttarget[0] - nextlatitude)
         dlong = abs(nexttarget[1] - nextlongitude)
 
-        distance_m = geopy.distance.vincenty((nextlatitude, nextlongitude), (nexttarget[0], nexttarget[1])).meters
+        distance_m = haversine_distance(nextlatitude, nextlongitude, nexttarget[0], nexttarget[1])
         num_seconds = distance_m / speed * 3.6  # 7.6 = 2x walk speed
         # log.info("{} - Distance to go: {} metres, Time until arrival: {} seconds".format(deviceworker['name'], distance_m, num_seconds))
 
@@ -3508,7 +3330,7 @@ class Pogom(Flask):
 
                 return jsonify(d)
             else:
-                self.devicesscheduling.remove(uuid)
+                self.devicesscheduling.discard(uuid)
 
         scheduletimeout = request_json.get('scheduletimeout', args.scheduletimeout)
         maxradius = request_json.get('maxradius', args.maxradius)
@@ -3522,87 +3344,6 @@ class Pogom(Flask):
         exraidonly = request_json.get('exraidonly', False)
         oldest_first = request_json.get('oldest_first', False)
 
-        if not isinstance(scheduletimeout, (int, long)):
-            try:
-                scheduletimeout = int(scheduletimeout)
-            except:
-                pass
-        if not isinstance(maxradius, (int, long)):
-            try:
-                maxradius = int(maxradius)
-            except:
-                pass
-        if not isinstance(teleport_interval, (int, long)):
-            try:
-                teleport_interval = int(teleport_interval)
-            except:
-                pass
-        if not isinstance(teleport_ignore, (int, long)):
-            try:
-                teleport_ignore = int(teleport_ignore)
-            except:
-                pass
-        if not isinstance(raidless, (bool, int, long)):
-            try:
-                if raidless.lower() == 'true':
-                    raidless = True
-                elif raidless.lower() == 'false':
-                    raidless = False
-                else:
-                    raidless = int(raidless)
-            except:
-                pass
-        if not isinstance(maxpoints, (bool, int, long)):
-            try:
-                if maxpoints.lower() == 'true':
-                    maxpoints = True
-                elif maxpoints.lower() == 'false':
-                    maxpoints = False
-                else:
-                    maxpoints = int(maxpoints)
-            except:
-                pass
-        if not isinstance(routing_outside_geofences, bool):
-            try:
-                if routing_outside_geofences.lower() == 'true':
-                    routing_outside_geofences = True
-                else:
-                    routing_outside_geofences = False
-            except:
-                pass
-        if not isinstance(no_overlap, bool):
-            try:
-                if no_overlap.lower() == 'true':
-                    no_overlap = True
-                else:
-                    no_overlap = False
-            except:
-                pass
-        if not isinstance(mapcontrolled, bool):
-            try:
-                if mapcontrolled.lower() == 'true':
-                    mapcontrolled = True
-                else:
-                    mapcontrolled = False
-            except:
-                pass
-        if not isinstance(exraidonly, bool):
-            try:
-                if exraidonly.lower() == 'true':
-                    exraidonly = True
-                else:
-                    exraidonly = False
-            except:
-                pass
-        if not isinstance(oldest_first, bool):
-            try:
-                if oldest_first.lower() == 'true':
-                    oldest_first = True
-                else:
-                    oldest_first = False
-            except:
-                pass
-
         deviceworker['no_overlap'] = no_overlap
         deviceworker['mapcontrolled'] = mapcontrolled
 
@@ -3646,24 +3387,46 @@ class Pogom(Flask):
 
         if teleportToNextLocation == True:
             if len(self.deviceschedules[uuid]) > 0:
+                self.claims.release(uuid, self.deviceschedules[uuid][0][2])
                 del self.deviceschedules[uuid][0]
             self.devices_last_teleport_time[uuid] = dt_now
             self.save_device(deviceworker)
 
-        if len(self.deviceschedules[uuid]) == 0:
+        if len(self.deviceschedules[uuid]) == 0 and not oldest_first and isinstance(raidless, bool) and self.route_cache_usable(geofence, maxradius):
+            if not self.geofences:
+                from .geofence import Geofences
+                self.geofences = Geofences()
+
+            # Devices teleporting through the same geofence share a cached
+            # route.
+            for raids in ([raidless, False] if raidless else [False]):
+                self.deviceschedules[uuid] = self.route_cache.get_route(
+                    ('teleport_gym', geofence.lower(), raids, exraidonly,
+                     teleport_ignore, routing_outside_geofences),
+                    uuid, latitude, longitude,
+                    self.geofence_route(Gym.get_nearby_gyms, geofence, 0, teleport_ignore, raids, False, geofence, [], self.geofences, exraidonly, False, routing_outside_geofences),
+                    no_overlap, route_limit(maxpoints))
+                if len(self.deviceschedules[uuid]) > 0:
+                    break
+            if no_overlap:
+                self.claims.claim('teleport_gym', uuid, self.deviceschedules[uuid])
+            if len(self.deviceschedules[uuid]) == 0:
+                return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
+
+            self.devices_last_teleport_time[uuid] = dt_now
+            self.save_device(deviceworker)
+        elif len(self.deviceschedules[uuid]) == 0:
             scheduled_points = []
             if no_overlap:
-                for dev in self.get_active_devices():
-                    if dev.get('no_overlap') and dev['fetching'] == 'teleport_gym':
-                        if dev['deviceid'] in self.devicesscheduling:
-                            d = {}
-                            d['latitude'] = deviceworker['latitude']
-                            d['longitude'] = deviceworker['longitude']
-                            return jsonify(d)
+                if not self.claims.start_planning('teleport_gym', uuid):
+                    d = {}
+                    d['latitude'] = deviceworker['latitude']
+                    d['longitude'] = deviceworker['longitude']
+                    return jsonify(d)
 
-                        scheduled_points += [item[2] for item in self.deviceschedules[dev['deviceid']]]
+                scheduled_points = self.claims.claimed('teleport_gym')
 
-            self.devicesscheduling.append(uuid)
+            self.devicesscheduling.add(uuid)
 
             if not self.geofences:
                 from .geofence import Geofences
@@ -3674,6 +3437,8 @@ class Pogom(Flask):
             self.deviceschedules[uuid] = Gym.get_nearby_gyms(latitude, longitude, maxradius, teleport_ignore, raidless, maxpoints, geofence, scheduled_points, self.geofences, exraidonly, oldest_first, routing_outside_geofences)
             if raidless and len(self.deviceschedules[uuid]) == 0:
                 self.deviceschedules[uuid] = Gym.get_nearby_gyms(latitude, longitude, maxradius, teleport_ignore, False, maxpoints, geofence, scheduled_points, self.geofences, exraidonly, oldest_first, routing_outside_geofences)
+            if no_overlap:
+                self.claims.claim('teleport_gym', uuid, self.deviceschedules[uuid])
             if len(self.deviceschedules[uuid]) == 0:
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
 
@@ -3738,32 +3503,13 @@ class Pogom(Flask):
 
                 return jsonify(d)
             else:
-                self.devicesscheduling.remove(uuid)
+                self.devicesscheduling.discard(uuid)
 
         scheduletimeout = args.scheduletimeout
         teleport_interval = args.teleport_interval
         scheduletimeout = request_json.get('scheduletimeout', scheduletimeout)
         teleport_interval = request_json.get('teleport_interval', teleport_interval)
 
-        if not isinstance(scheduletimeout, (int, long)):
-            try:
-                scheduletimeout = int(scheduletimeout)
-            except:
-                pass
-        if not isinstance(teleport_interval, (int, long)):
-            try:
-                teleport_interval = int(teleport_interval)
-            except:
-                pass
-        if not isinstance(mapcontrolled, bool):
-            try:
-                if mapcontrolled.lower() == 'true':
-                    mapcontrolled = True
-                else:
-                    mapcontrolled = False
-            except:
-                pass
-
         deviceworker['no_overlap'] = False
         deviceworker['mapcontrolled'] = mapcontrolled
 
@@ -3830,7 +3576,7 @@ class Pogom(Flask):
                 log.warning("No or incorrect GPX supplied: {}".format(gpxfilename))
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
 
-            self.devicesscheduling.append(uuid)
+            self.devicesscheduling.add(uuid)
             self.deviceschedules[uuid] = self.get_gpx_route(gpxfilename)
             if len(self.deviceschedules[uuid]) == 0:
                 return self.scan_loc(mapcontrolled, uuid, latitude, longitude, request_json)
@@ -3939,56 +3685,32 @@ class Pogom(Flask):
             deviceworker['name'] = devicename
             self.save_device(deviceworker, True)
 # Update deviceusername
-        requestedEndpoint = re.sub(r'((\?|\&)longitude=-?[0-9]*\.?[0-9]*)|((\?|\&)latitude=-?[0-9]*\.?[0-9]*)|((\?|\&)timestamp=[0-9]*\.[0-9]*)|((\?|\&)uuid=[A-F0-9-]{36})','',request.full_path)
+        requestedEndpoint = requested_endpoint(request.full_path)
         if requestedEndpoint != "" and requestedEndpoint != deviceworker['requestedEndpoint']:
             log.info('Device {} updating requestedEndpoint: {} => {}'.format(uuid, deviceworker['requestedEndpoint'], requestedEndpoint))
             deviceworker['requestedEndpoint'] = requestedEndpoint
             self.save_device(deviceworker, True)
 # Update PoGo version
-        pogoversion = re.sub(r'pokemongo/([^\ ]*).*', r'\1', request.headers.get('User-Agent','Unknown'))
+        pogoversion = pogo_version(request.headers.get('User-Agent', 'Unknown'))
         if pogoversion != "" and pogoversion != deviceworker['pogoversion']:
             log.info('Device {} updating pogoversion: {} => {}'.format(uuid, deviceworker['pogoversion'], pogoversion))
             deviceworker['pogoversion'] = pogoversion
             self.save_device(deviceworker, True)
 #MapControlled section
         if (endpoint.lower() == "mapcontrolled"):
-            endpoint_re = "(http[s]?://[^/]*/|/|)(?P<endpoint>[^\?]*)\??(?P<attributes>.*)"
-            endpointMC = str(deviceworker.get('endpoint', ''))
-            endpointMC_base = re.sub(endpoint_re, '\g<endpoint>',  endpointMC)
-            endpointMC_attribArray = re.split('&', re.sub(endpoint_re, '\g<attributes>',  endpointMC))
-            endpointMC_attribMD = MultiDict()
-            for pair in endpointMC_attribArray:
-                endpointMC_attribMD.add(re.sub("=.*","", pair),re.sub(".*=",'',pair))
-            if (endpointMC_base == "" or endpointMC.lower() == "scan_loc"):
-                return self.scan_loc(True, uuid, latitude, longitude, endpointMC_attribMD)
-            elif (endpointMC_base == "teleport_gym"):
-                return self.teleport_gym(True, uuid, latitude, longitude, endpointMC_attribMD)
-            elif (endpointMC_base.lower() == "teleport_gpx"):
-                return self.teleport_gpx(True, uuid, latitude, longitude, endpointMC_attribMD)
-            elif (endpointMC_base.lower() == "walk_pokestop"):
-                return self.walk_pokestop(True, uuid, latitude, longitude, endpointMC_attribMD)
-            elif (endpointMC_base.lower() == "walk_gpx"):
-                return self.walk_gpx(True, uuid, latitude, longitude, endpointMC_attribMD)
-            elif (endpointMC_base.lower() == "walk_spawnpoint"):
-                return self.walk_spawnpoint(True, uuid, latitude, longitude, endpointMC_attribMD)
-            return "Endpoint {} (mapcontrolled) not converted ".format(endpoint)
+            spec = get_endpoint_spec(str(deviceworker.get('endpoint', '')))
+            handler = self.endpoint_handlers.get(spec.name)
+            if handler is None:
+                return "Endpoint {} (mapcontrolled) not converted ".format(endpoint)
+            return handler(True, uuid, latitude, longitude, spec.params)
 
 #Device requiested endpoints
-        elif (endpoint.lower() == "teleport_gym"):
-            return self.teleport_gym(False, uuid, latitude, longitude, request_json)
-        elif (endpoint.lower() == "scan_loc"):
-            return self.scan_loc(False, uuid, latitude, longitude, request_json)
-        elif (endpoint.lower() == "teleport_gpx"):
-            return self.teleport_gpx(False, uuid, latitude, longitude, request_json)
-        elif (endpoint.lower() == "walk_pokestop"):
-            return self.walk_pokestop(False, uuid, latitude, longitude, request_json)
-        elif (endpoint.lower() == "walk_gpx"):
-            return self.walk_gpx(False, uuid, latitude, longitude, request_json)
-        elif (endpoint.lower() == "walk_spawnpoint"):
-            return self.walk_spawnpoint(False, uuid, latitude, longitude, request_json)
         elif (endpoint.lower() == "dummy"):
             return "Dummmy :D"
-        return "Endpoint {} not converted.".format(endpoint)
+        handler = self.endpoint_handlers.get(endpoint.lower())
+        if handler is None:
+            return "Endpoint {} not converted.".format(endpoint)
+        return handler(False, uuid, latitude, longitude, typed_params(request_json))
 
     def scan_loc(self, mapcontrolled, uuid, latitude, longitude, request_json):
         args = get_args()
@@ -4073,7 +3795,7 @@ class Pogom(Flask):
                 direction = "U"
                 currentlatitude += stepsize
 
-        if maxradius > 0 and geopy.distance.vincenty((currentlatitude, currentlongitude), (centerlatitude, centerlongitude)).km > maxradius:
+        if maxradius > 0 and haversine_distance(currentlatitude, currentlongitude, centerlatitude, centerlongitude) / 1000 > maxradius:
             currentlatitude = centerlatitude
             currentlongitude = centerlongitude
             radius = 0
@@ -4201,6 +3923,9 @@ class Pogom(Flask):
             endpoint = endpoint.replace('||', '?')
             endpoint = endpoint.replace('|', '&')
 
+            if get_endpoint_spec(endpoint).name not in self.endpoint_handlers:
+                log.warning('Device %s set to unknown endpoint: %s', uuid, endpoint)
+
             deviceworker = self.get_device(uuid, map_lat, map_lng)
             log.info("Device {} change endpoint: {} => {}".format(uuid, deviceworker['endpoint'], endpoint))
             deviceworker['endpoint'] = endpoint
@@ -4287,6 +4012,92 @@ class Pogom(Flask):
 
         return jsonify(pokestop)
 
+    def stream(self):
+        args = get_args()
+        if not args.map_stream:
+            abort(404)
+
+        self._check_fingerprint()
+
+        swLat = request.args.get('swLat')
+        swLng = request.args.get('swLng')
+        neLat = request.args.get('neLat')
+        neLng = request.args.get('neLng')
+        if not (swLat and swLng and neLat and neLng):
+            abort(400)
+
+        kinds = [kind for kind, switch, disabled in (
+            ('pokemons', 'pokemon', args.no_pokemon),
+            ('pokestops', 'pokestops', args.no_pokestops),
+            ('gyms', 'gyms', args.no_gyms))
+            if request.args.get(switch, 'true') == 'true' and not disabled]
+
+        eids = []
+        request_eids = request.args.get('eids')
+        if request_eids:
+            eids = [int(i) for i in request_eids.split(',')]
+
+        if not self.geofences:
+            from .geofence import Geofences
+            self.geofences = Geofences()
+
+        item_filter = None
+        geofencenames = request.args.get('geofencenames', '')
+        if ((not args.data_outside_geofences or geofencenames != "") and
+                self.geofences.is_enabled()):
+            def item_filter(kind, items):
+                return self.geofences.get_geofenced_results(items,
+                                                            geofencenames)
+
+        # An open stream keeps the map active, like its polls do. Events,
+        # keepalives included, are sent at least every 15 seconds.
+        def heartbeat():
+            self.heartbeat[0] = now()
+            if args.on_demand_timeout > 0:
+                self.control_flags['on_demand'].clear()
+
+        def events(subscriber):
+            stream = subscriber.events(
+                dumps=lambda data: json.dumps(data, cls=CustomJSONEncoder))
+            try:
+                for event in stream:
+                    heartbeat()
+                    yield event
+            finally:
+                # Unsubscribes the client.
+                stream.close()
+
+        heartbeat()
+        subscriber = map_stream.subscribe(swLat, swLng, neLat, neLng, kinds,
+                                          eids, item_filter)
+        response = Response(events(subscriber),
+                            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Don't let nginx hold back events.
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # Returns (id, item) of the map items of a kind that changed after
+    # since, for the map stream.
+    def stream_changes(self, kind, since):
+        timestamp = calendar.timegm(since.timetuple()) * 1000
+        with Pokemon.database().execution_context():
+            if kind == 'pokemons':
+                pokemon = convert_pokemon_list(
+                    Pokemon.get_active(-90, -180, 90, 180,
+                                       timestamp=timestamp))
+                return [(p['encounter_id'], p) for p in pokemon]
+            if kind == 'pokestops':
+                return Pokestop.get_stops(-90, -180, 90, 180,
+                                          timestamp=timestamp).items()
+            return Gym.get_gyms(-90, -180, 90, 180,
+                                timestamp=timestamp).items()
+
+    def ingest_stats(self):
+        if self.ingest_pool is None:
+            return jsonify({})
+        return jsonify(self.ingest_pool.get_stats())
+
     def get_deviceworkerdata(self):
         deviceworker_id = request.args.get('id')
         deviceworker = DeviceWorker.get_active_by_id(deviceworker_id)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class ClaimTable(object):
+    """Route targets claimed by no_overlap devices, so devices of the same
+    kind (walk_spawnpoint, walk_pokestop, teleport_gym) plan around each
+    other without collecting each other's schedules.
+
+    A device's claims are replaced when it plans a route, given back one by
+    one as it reaches them, and handed off all at once when
+    is_holder(uuid, kind) says it no longer counts, e.g. because it went
+    idle or switched endpoints.
+    """
+
+    # Seconds another device may plan before it's assumed to have failed.
+    PLANNING_TIMEOUT = 30
+
+    def __init__(self, is_holder):
+        self.is_holder = is_holder
+        # Kind -> {key: uuid}.
+        self.claims = {}
+        # Uuid -> (kind, set of keys, time claimed).
+        self.holders = {}
+        # Kind -> {uuid: time planning started}.
+        self.planning = {}
+        self.lock = Lock()
+
+    # Returns False while another device plans a route of the same kind.
+    # Otherwise gives back the device's claims, which it's replacing.
+    def start_planning(self, kind, uuid):
+        now_time = time.time()
+        with self.lock:
+            planning = self.planning.setdefault(kind, {})
+            for other, started in planning.items():
+                if now_time - started >= self.PLANNING_TIMEOUT:
+                    del planning[other]
+                elif other != uuid:
+                    return False
+            planning[uuid] = now_time
+            self._release_all(uuid)
+        return True
+
+    # Keys of a kind claimed by devices that still hold them. The result is
+    # kept up to date, so it's only for membership tests. Devices are saved
+    # after they claimed their route, so fresh claims are kept regardless.
+    def claimed(self, kind):
+        now_time = time.time()
+        with self.lock:
+            holders = [uuid for uuid, (k, _, claimed) in
+                       self.holders.iteritems() if k == kind and
+                       now_time - claimed >= self.PLANNING_TIMEOUT]
+        gone = [uuid for uuid in holders if not self.is_holder(uuid, kind)]
+        with self.lock:
+            for uuid in gone:
+                self._release_all(uuid)
+            return self.claims.setdefault(kind, {})
+
+    # Claims the keys of route points (latitude, longitude, key) for the
+    # device, instead of what it claimed before.
+    def claim(self, kind, uuid, points):
+        keys = set(point[2] for point in points)
+        with self.lock:
+            self._release_all(uuid)
+            claims = self.claims.setdefault(kind, {})
+            for key in keys:
+                claims[key] = uuid
+            self.holders[uuid] = (kind, keys, time.time())
+            self.planning.get(kind, {}).pop(uuid, None)
+
+    def release(self, uuid, key):
+        with self.lock:
+            holder = self.holders.get(uuid)
+            if holder is None or key not in holder[1]:
+                return
+            holder[1].discard(key)
+            claims = self.claims[holder[0]]
+            if claims.get(key) == uuid:
+                del claims[key]
+
+    def release_all(self, uuid):
+        with self.lock:
+            self._release_all(uuid)
+
+    def _release_all(self, uuid):
+        holder = self.holders.pop(uuid, None)
+        if holder is None:
+            return
+        kind, keys, _ = holder
+        claims = self.claims[kind]
+        for key in keys:
+            if claims.get(key) == uuid:
+                del claims[key]
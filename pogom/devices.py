@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class DeviceRegistry(object):
+    """Devices by uuid, shared by the web server's request threads.
+
+    A stored device is never changed in place, saving stores a new dict
+    under the next version. Readers can hold on to a device without copying
+    it, and copy it before changing it. Devices are spread over shards with
+    a lock each, so only writes of devices in the same shard wait for each
+    other, and reads don't lock at all.
+
+    Devices that were scanning or fetching when they were last saved are
+    also kept in an index, so listing the active devices only looks at
+    those instead of every device that ever posted.
+    """
+
+    SHARDS = 16
+    # Seconds after which a device that stopped posting counts as idle.
+    IDLE_AFTER = 300
+    # Seconds after which a device that stopped scanning counts as not
+    # scanning.
+    SCANNING_FOR = 60
+    # Seconds without posts after which a device is read again from the
+    # database, and between writes of a device to the database.
+    RELOAD_AFTER = 30
+    SAVE_EVERY = 30
+
+    def __init__(self, load):
+        # load(uuid, lat, lng) returns the device from the database.
+        self.load = load
+        # Per shard, uuid -> (version, device).
+        self.shards = [{} for _ in range(self.SHARDS)]
+        self.locks = [Lock() for _ in range(self.SHARDS)]
+        self.save_times = {}
+        self.active = {}
+        self.active_lock = Lock()
+
+    def _shard(self, uuid):
+        return hash(uuid) % self.SHARDS
+
+    def __contains__(self, uuid):
+        return uuid in self.shards[self._shard(uuid)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    # The stored device, which mustn't be changed.
+    def get(self, uuid, default=None):
+        entry = self.shards[self._shard(uuid)].get(uuid)
+        return entry[1] if entry is not None else default
+
+    def version(self, uuid):
+        entry = self.shards[self._shard(uuid)].get(uuid)
+        return entry[0] if entry is not None else 0
+
+    def _store(self, device):
+        uuid = device['deviceid']
+        i = self._shard(uuid)
+        active = self.is_active(device)
+        with self.locks[i]:
+            entry = self.shards[i].get(uuid)
+            version = entry[0] + 1 if entry is not None else 1
+            self.shards[i][uuid] = (version, device)
+
+            # Still under the shard's lock, so the index can't end up with
+            # an older save than the shard. Locks are always taken in
+            # shard, active order.
+            with self.active_lock:
+                if active:
+                    self.active[uuid] = device
+                else:
+                    self.active.pop(uuid, None)
+
+    # Copy of the device, loaded from the database if it's unknown or
+    # hasn't posted in a while.
+    def get_device(self, uuid, lat, lng):
+        device = self.get(uuid)
+        if device is None:
+            device = self.load(uuid, lat, lng)
+            device['route'] = ''
+            device['no_overlap'] = False
+            device['mapcontrolled'] = False
+            self._store(device)
+        elif self.is_stale(device):
+            stored = device
+            device = self.load(uuid, lat, lng)
+            device['route'] = stored.get('route', '')
+            device['no_overlap'] = stored.get('no_overlap', False)
+            device['mapcontrolled'] = stored.get('mapcontrolled', False)
+            self._store(device)
+
+        return device.copy()
+
+    def is_stale(self, device):
+        now_date = datetime.utcnow()
+        last_scanned = device['last_scanned']
+        return ((now_date - device['last_updated']).total_seconds() >
+                self.RELOAD_AFTER and
+                (last_scanned is None or
+                 (now_date - last_scanned).total_seconds() >
+                 self.RELOAD_AFTER))
+
+    # Stores a copy of the device.
+    def save(self, device):
+        self._store(device.copy())
+
+    # Returns True if it's time to write the device to the database, which
+    # is assumed to happen.
+    def save_due(self, uuid, force_save=False):
+        now_date = datetime.utcnow()
+        with self.locks[self._shard(uuid)]:
+            saved = self.save_times.get(uuid)
+            if (force_save or saved is None or
+                    (now_date - saved).total_seconds() > self.SAVE_EVERY):
+                self.save_times[uuid] = now_date
+                return True
+        return False
+
+    # Returns the device with its fetching and scanning state as of now.
+    # The device is only copied if its state changed.
+    def current_state(self, device, now_date=None):
+        now_date = now_date or datetime.utcnow()
+        fetching = device['fetching']
+        if ((now_date - device['last_updated']).total_seconds() >
+                self.IDLE_AFTER):
+            fetching = 'IDLE'
+        scanning = device['scanning']
+        last_scanned = device['last_scanned']
+        if last_scanned is None:
+            scanning = -1
+        elif ((now_date - last_scanned).total_seconds() > self.SCANNING_FOR and
+                scanning == 1):
+            scanning = 0
+
+        if fetching != device['fetching'] or scanning != device['scanning']:
+            device = device.copy()
+            device['fetching'] = fetching
+            device['scanning'] = scanning
+        return device
+
+    def is_active(self, device, now_date=None):
+        device = self.current_state(device, now_date)
+        return device['scanning'] == 1 or device['fetching'] != 'IDLE'
+
+    # Devices that are scanning or fetching, which mustn't be changed.
+    def get_active(self):
+        now_date = datetime.utcnow()
+        with self.active_lock:
+            candidates = self.active.items()
+
+        result = []
+        for uuid, device in candidates:
+            current = self.current_state(device, now_date)
+            if current['scanning'] == 1 or current['fetching'] != 'IDLE':
+                result.append(current)
+                continue
+            # Went idle since it was saved.
+            with self.active_lock:
+                if self.active.get(uuid) is device:
+                    del self.active[uuid]
+        return result
@@ -1,8 +1,14 @@
 import os
 import subprocess
+import hashlib
+import itertools
 
 import logging
 from string import join
+from threading import Event, Lock
+from multiprocessing.pool import ThreadPool
+
+from cachetools import LRUCache
 
 from pogom.utils import get_args
 
@@ -22,14 +28,92 @@ egg_images = {
     5: 'egg_legendary.png'
 }
 
+teams = ('Uncontested', 'Mystic', 'Valor', 'Instinct')
+
+# Icon file name -> (png bytes, etag). Icons are a few KB each.
+# cachetools isn't thread safe, so we add a lock.
+icon_cache = LRUCache(maxsize=2000)
+icon_cache_lock = Lock()
+# Icon file name -> Event, for icons being rendered. Requests for an icon
+# that is being rendered wait for it instead of rendering it again.
+icons_rendering = {}
+
 
+# Returns (png bytes, etag) of a gym icon, or None for an unknown team.
 def get_gym_icon(team, level, raidlevel, pkm, pkm_form, is_in_battle, is_ex_raid_eligible, is_unknown):
-    init_image_dir()
+    if team not in teams:
+        return None
+    out_filename, cmd = gym_icon_file(team, level, raidlevel, pkm, pkm_form,
+                                      is_in_battle, is_ex_raid_eligible,
+                                      is_unknown)
+
+    with icon_cache_lock:
+        icon = icon_cache.get(out_filename)
+        if icon is not None:
+            return icon
+        rendering = icons_rendering.get(out_filename)
+        if rendering is None:
+            icons_rendering[out_filename] = Event()
+
+    if rendering is not None:
+        rendering.wait()
+        with icon_cache_lock:
+            return icon_cache.get(out_filename)
+
+    icon = None
+    try:
+        icon = load_icon(out_filename, cmd)
+        with icon_cache_lock:
+            icon_cache[out_filename] = icon
+    except (IOError, OSError) as e:
+        log.warning('Failed to load gym icon %s: %s', out_filename, repr(e))
+    finally:
+        with icon_cache_lock:
+            icons_rendering.pop(out_filename).set()
+    return icon
+
+
+# Renders an icon if it isn't on disk yet and reads it.
+def load_icon(out_filename, cmd):
+    if cmd and not os.path.isfile(out_filename):
+        init_image_dir()
+        subprocess.call(cmd, shell=True)
+    with open(out_filename, 'rb') as f:
+        png = f.read()
+    return png, hashlib.sha1(png).hexdigest()
+
+
+# Renders and caches the icons of all gyms without a raid boss, in a pool
+# of threads.
+def prerender_gym_icons(threads):
+    combinations = list(itertools.product(
+        teams, range(0, 7), (None, 1, 2, 3, 4, 5), (False, True),
+        (False, True)))
+
+    def render(combination):
+        team, level, raidlevel, is_in_battle, is_ex_raid_eligible = \
+            combination
+        try:
+            get_gym_icon(team, level, raidlevel, None, None, is_in_battle,
+                         is_ex_raid_eligible, False)
+        except Exception as e:
+            log.warning('Failed to render gym icon %s: %s', combination,
+                        repr(e))
+
+    pool = ThreadPool(threads)
+    pool.map(render, combinations)
+    pool.close()
+    log.info('Rendered %d gym icons.', len(combinations))
+
+
+# Returns the icon's file name and the ImageMagick command that renders
+# it, or None if it's one of the default images.
+def gym_icon_file(team, level, raidlevel, pkm, pkm_form, is_in_battle, is_ex_raid_eligible, is_unknown):
     level = int(level)
 
     args = get_args()
     if not args.generate_images:
-        return default_gym_image(team, level, raidlevel, pkm)
+        return default_gym_image(team, level, raidlevel, pkm), None
 
     subject_lines = []
     badge_lines = []
@@ -80,16 +164,14 @@ def get_gym_icon(team, level, raidlevel, pkm, pkm_form, is_in_battle, is_ex_raid
             os.path.join(path_images, 'unknown.png')))
         out_filename = out_filename.replace('.png', '_Unknown.png')
 
-    if not os.path.isfile(out_filename):
-        gym_image = os.path.join('static', 'images', 'gym', '{}.png'.format(team))
-        font = os.path.join('static', 'Arial Black.ttf')
-        cmd = 'convert {} {} -gravity center -font "{}" -pointsize 25 {} {}'.format(gym_image, join(subject_lines),
-                                                                                    font, join(badge_lines),
-                                                                                    out_filename)
-        if os.name != 'nt':
-            cmd = cmd.replace(" ( ", " \( ").replace(" ) ", " \) ")
-        subprocess.call(cmd, shell=True)
-    return out_filename
+    gym_image = os.path.join('static', 'images', 'gym', '{}.png'.format(team))
+    font = os.path.join('static', 'Arial Black.ttf')
+    cmd = 'convert {} {} -gravity center -font "{}" -pointsize 25 {} {}'.format(gym_image, join(subject_lines),
+                                                                                font, join(badge_lines),
+                                                                                out_filename)
+    if os.name != 'nt':
+        cmd = cmd.replace(" ( ", " \( ").replace(" ) ", " \) ")
+    return out_filename, cmd
 
 
 def draw_egg(image, size, gravity='north'):
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+from threading import Lock
+
+from cachetools import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Parts of a device's request path that change with every request.
+REQUESTED_ENDPOINT_RE = re.compile(
+    r'((\?|\&)longitude=-?[0-9]*\.?[0-9]*)|'
+    r'((\?|\&)latitude=-?[0-9]*\.?[0-9]*)|'
+    r'((\?|\&)timestamp=[0-9]*\.[0-9]*)|'
+    r'((\?|\&)uuid=[A-F0-9-]{36})')
+POGO_VERSION_RE = re.compile(r'pokemongo/([^\ ]*).*')
+ENDPOINT_RE = re.compile(
+    r'(http[s]?://[^/]*/|/|)(?P<endpoint>[^\?]*)\??(?P<attributes>.*)')
+
+
+def requested_endpoint(full_path):
+    return REQUESTED_ENDPOINT_RE.sub('', full_path)
+
+
+def pogo_version(user_agent):
+    return POGO_VERSION_RE.sub(r'\1', user_agent)
+
+
+def to_bool(value):
+    return value.lower() == 'true'
+
+
+# Some parameters are either a flag or a number.
+def to_bool_or_int(value):
+    if value.lower() == 'true':
+        return True
+    if value.lower() == 'false':
+        return False
+    return int(value)
+
+
+# Types of the device endpoints' parameters, read from query strings.
+PARAM_TYPES = {
+    'scheduletimeout': int,
+    'maxradius': int,
+    'stepsize': float,
+    'speed': int,
+    'arrived_range': int,
+    'teleport_interval': int,
+    'teleport_ignore': int,
+    'teleport_factor': float,
+    'unknown_tth': to_bool_or_int,
+    'maxpoints': to_bool_or_int,
+    'questless': to_bool_or_int,
+    'raidless': to_bool_or_int,
+    'ignore_geofences': to_bool,
+    'no_overlap': to_bool,
+    'exraidonly': to_bool,
+    'oldest_first': to_bool
+}
+
+
+class EndpointParams(dict):
+    """Parameters of a device endpoint, typed by PARAM_TYPES.
+
+    get() takes a type like a MultiDict's does. Values that don't parse as
+    their type are kept as they were sent.
+    """
+
+    def get(self, key, default=None, type=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        if type is not None:
+            try:
+                value = type(value)
+            except ValueError:
+                value = default
+        return value
+
+
+def typed_params(params):
+    result = EndpointParams()
+    for key, value in params.items():
+        if isinstance(value, basestring) and key in PARAM_TYPES:
+            try:
+                value = PARAM_TYPES[key](value)
+            except ValueError:
+                pass
+        result[key] = value
+    return result
+
+
+class EndpointSpec(object):
+    """An endpoint set from the devices page for a map controlled device,
+    e.g. 'walk_pokestop?maxradius=2&questless=true'.
+    """
+
+    def __init__(self, endpoint):
+        match = ENDPOINT_RE.match(endpoint)
+        # An empty endpoint scans the device's location.
+        self.name = match.group('endpoint').lower() or 'scan_loc'
+        params = {}
+        for pair in match.group('attributes').split('&'):
+            params.setdefault(pair.split('=', 1)[0], pair.rsplit('=', 1)[-1])
+        self.params = typed_params(params)
+
+
+endpoint_specs = LRUCache(maxsize=1000)
+endpoint_specs_lock = Lock()
+
+
+# Endpoints are parsed once, and shared by the devices they're set for.
+def get_endpoint_spec(endpoint):
+    with endpoint_specs_lock:
+        spec = endpoint_specs.get(endpoint)
+    if spec is None:
+        spec = EndpointSpec(endpoint)
+        with endpoint_specs_lock:
+            endpoint_specs[endpoint] = spec
+    return spec
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Bits per axis, about 0.6m per step.
+GEOCELL_BITS = 26
+GEOCELL_SCALE = 1 << GEOCELL_BITS
+
+
+def _spread(v):
+    # Moves bit i of v to bit 2i.
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def _grid(lat, lng):
+    x = int((float(lng) + 180.0) / 360.0 * GEOCELL_SCALE)
+    y = int((float(lat) + 90.0) / 180.0 * GEOCELL_SCALE)
+    return (min(max(x, 0), GEOCELL_SCALE - 1),
+            min(max(y, 0), GEOCELL_SCALE - 1))
+
+
+def _key(x, y):
+    return _spread(x) | (_spread(y) << 1)
+
+
+# Z-order key of a location. Every cell of the quadtree over the lat/lng
+# plane is a contiguous range of keys, so a box can be fetched with a few
+# range scans on an index over the key.
+def geocell(lat, lng):
+    return _key(*_grid(lat, lng))
+
+
+# Returns (level, cells) with the fewest cells of one level, at most
+# max_cells, that cover the box. Cells are (x, y) at that level.
+def covering(swLat, swLng, neLat, neLng, max_cells=16):
+    swLat, swLng, neLat, neLng = map(float, (swLat, swLng, neLat, neLng))
+    x0, y0 = _grid(min(swLat, neLat), min(swLng, neLng))
+    x1, y1 = _grid(max(swLat, neLat), max(swLng, neLng))
+    for level in range(GEOCELL_BITS, -1, -1):
+        shift = GEOCELL_BITS - level
+        width = (x1 >> shift) - (x0 >> shift) + 1
+        height = (y1 >> shift) - (y0 >> shift) + 1
+        if width * height <= max_cells:
+            return level, [(x, y)
+                           for x in range(x0 >> shift, (x1 >> shift) + 1)
+                           for y in range(y0 >> shift, (y1 >> shift) + 1)]
+
+
+# Cells of a level that lie completely inside the box. Cells touching the
+# box's edges are left out, so this errs on the side of too few.
+def interior(level, cells, swLat, swLng, neLat, neLng):
+    swLat, swLng, neLat, neLng = map(float, (swLat, swLng, neLat, neLng))
+    x0, y0 = _grid(min(swLat, neLat), min(swLng, neLng))
+    x1, y1 = _grid(max(swLat, neLat), max(swLng, neLng))
+    shift = GEOCELL_BITS - level
+    return [(x, y) for x, y in cells
+            if x << shift > x0 and ((x + 1) << shift) - 1 < x1 and
+            y << shift > y0 and ((y + 1) << shift) - 1 < y1]
+
+
+# Merged (first, last) key ranges of cells of a level.
+def cell_ranges(level, cells):
+    shift = 2 * (GEOCELL_BITS - level)
+    ranges = []
+    for prefix in sorted(_key(x, y) for x, y in cells):
+        first = prefix << shift
+        last = ((prefix + 1) << shift) - 1
+        if ranges and ranges[-1][1] + 1 == first:
+            ranges[-1] = (ranges[-1][0], last)
+        else:
+            ranges.append((first, last))
+    return ranges
+
+
+# Key ranges holding everything in the box.
+def viewport_ranges(swLat, swLng, neLat, neLng):
+    return cell_ranges(*covering(swLat, swLng, neLat, neLng))
+
+
+# Key ranges holding everything in the new box that isn't in the old one:
+# the cells covering the new box that aren't inside the old box.
+def uncovered_ranges(swLat, swLng, neLat, neLng, oSwLat, oSwLng, oNeLat,
+                     oNeLng):
+    level, cells = covering(swLat, swLng, neLat, neLng)
+    inside = set(interior(level, cells, oSwLat, oSwLng, oNeLat, oNeLng))
+    return cell_ranges(level, [c for c in cells if c not in inside])
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import math
 import timeit
 import logging
 
@@ -21,11 +22,129 @@ except ImportError as e:
     pass
 
 
+# NumPy is optional as well, it's used to geofence whole result lists at once.
+try:
+    import numpy as np
+except ImportError as e:
+    pass
+
+
+class GeofencePolygon(object):
+    """A geofence with its bounding box and vertices prepared once, so
+    containment tests don't rebuild the polygon for every point."""
+
+    def __init__(self, area, use_matplotlib, use_numpy):
+        self.name = area['name']
+        self.vertices = [(c['lat'], c['lon']) for c in area['polygon']]
+        lats = [v[0] for v in self.vertices]
+        lons = [v[1] for v in self.vertices]
+        self.min_lat = min(lats)
+        self.max_lat = max(lats)
+        self.min_lon = min(lons)
+        self.max_lon = max(lons)
+
+        self.path = None
+        if use_matplotlib:
+            self.path = Path(self.vertices + [self.vertices[0]])
+
+        # Edges for the vectorized ray casting, skipping vertical ones
+        # since they can never be crossed.
+        self.edges = None
+        if use_numpy:
+            edges = [(lat1, lon1, lat2, lon2) for (lat1, lon1), (lat2, lon2)
+                     in zip(self.vertices, self.vertices[1:] +
+                            self.vertices[:1])
+                     if lon1 != lon2]
+            self.edges = np.array(edges, dtype=float).reshape(-1, 4)
+
+    def in_bbox(self, lat, lon):
+        return (self.min_lat <= lat <= self.max_lat and
+                self.min_lon <= lon <= self.max_lon)
+
+    def contains(self, lat, lon):
+        if not self.in_bbox(lat, lon):
+            return False
+        if self.path is not None:
+            return self.path.contains_point((lat, lon))
+
+        inside = False
+        lat1, lon1 = self.vertices[0]
+        N = len(self.vertices)
+        for n in range(1, N + 1):
+            lat2, lon2 = self.vertices[n % N]
+            if (min(lon1, lon2) < lon <= max(lon1, lon2) and
+                    lat <= max(lat1, lat2)):
+                if lat1 == lat2 or lat <= ((lon - lon1) * (lat2 - lat1) /
+                                           (lon2 - lon1) + lat1):
+                    inside = not inside
+            lat1, lon1 = lat2, lon2
+
+        return inside
+
+    # Returns a boolean array telling which of the points are inside.
+    def contains_many(self, lats, lons):
+        result = ((lats >= self.min_lat) & (lats <= self.max_lat) &
+                  (lons >= self.min_lon) & (lons <= self.max_lon))
+        candidates = np.flatnonzero(result)
+        if not len(candidates):
+            return result
+
+        if self.path is not None:
+            points = np.column_stack((lats[candidates], lons[candidates]))
+            result[candidates] = self.path.contains_points(points)
+            return result
+
+        lat = lats[candidates]
+        lon = lons[candidates]
+        inside = np.zeros(len(candidates), dtype=bool)
+        for lat1, lon1, lat2, lon2 in self.edges:
+            crossing = ((min(lon1, lon2) < lon) & (lon <= max(lon1, lon2)) &
+                        (lat <= max(lat1, lat2)))
+            if lat1 != lat2:
+                crossing &= lat <= ((lon - lon1) * (lat2 - lat1) /
+                                    (lon2 - lon1) + lat1)
+            inside ^= crossing
+        result[candidates] = inside
+
+        return result
+
+
+class GeofenceIndex(object):
+    """Uniform lat/lon grid over the polygons' bounding boxes, so a point is
+    only tested against the polygons that can contain it."""
+
+    def __init__(self, polygons):
+        self.polygons = polygons
+        self.cells = {}
+
+        # Size cells after the typical polygon, so each one covers a handful.
+        extents = sorted(max(p.max_lat - p.min_lat, p.max_lon - p.min_lon)
+                         for p in polygons)
+        self.cell_size = max(extents[len(extents) // 2] if extents else 0,
+                             0.01)
+
+        for i, p in enumerate(polygons):
+            min_x, min_y = self._cell(p.min_lat, p.min_lon)
+            max_x, max_y = self._cell(p.max_lat, p.max_lon)
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    self.cells.setdefault((x, y), []).append(i)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def candidates(self, lat, lon):
+        return [self.polygons[i] for i in self.cells.get(
+            self._cell(lat, lon), ())]
+
+
 class Geofences:
     def __init__(self):
         self.geofenced_areas = []
         self.excluded_areas = []
         self.use_matplotlib = 'matplotlib' in sys.modules
+        self.use_numpy = 'numpy' in sys.modules
 
         if args.geofence_file or args.geofence_excluded_file:
             log.info('Loading geofenced or excluded areas.')
@@ -37,6 +156,17 @@ class Geofences:
                      len(self.geofenced_areas),
                      len(self.excluded_areas))
 
+        self.geofenced_polygons = [
+            GeofencePolygon(a, self.use_matplotlib, self.use_numpy)
+            for a in self.geofenced_areas if a['polygon']]
+        self.excluded_polygons = [
+            GeofencePolygon(a, self.use_matplotlib, self.use_numpy)
+            for a in self.excluded_areas if a['polygon']]
+        self.geofenced_index = GeofenceIndex(self.geofenced_polygons)
+        self.excluded_index = GeofenceIndex(self.excluded_polygons)
+        log.debug('Using matplotlib: %s, numpy: %s.', self.use_matplotlib,
+                  self.use_numpy)
+
     def is_enabled(self):
         return (self.geofenced_areas or self.excluded_areas)
 
@@ -48,118 +178,114 @@ class Geofences:
 
         geofences_to_search_for = name.lower().split(",")
 
-        for va in self.geofenced_areas:
-            if (name == "" or va["name"].lower() in geofences_to_search_for):
-                va_swLat = va['polygon'][0]['lat']
-                va_swLng = va['polygon'][0]['lon']
-                va_neLat = va['polygon'][0]['lat']
-                va_neLng = va['polygon'][0]['lon']
-
-                for coords in va['polygon']:
-                    va_swLat = min(coords['lat'], va_swLat)
-                    va_swLng = min(coords['lon'], va_swLng)
-                    va_neLat = max(coords['lat'], va_neLat)
-                    va_neLng = max(coords['lon'], va_neLng)
-
+        for p in self.geofenced_polygons:
+            if (name == "" or p.name.lower() in geofences_to_search_for):
                 if swLat is None:
-                    swLat = va_swLat
-                    swLng = va_swLng
-                    neLat = va_neLat
-                    neLng = va_neLng
+                    swLat = p.min_lat
+                    swLng = p.min_lon
+                    neLat = p.max_lat
+                    neLng = p.max_lon
                 else:
-                    swLat = min(swLat, va_swLat)
-                    swLng = min(swLng, va_swLng)
-                    neLat = max(neLat, va_neLat)
-                    neLng = max(neLng, va_neLng)
+                    swLat = min(swLat, p.min_lat)
+                    swLng = min(swLng, p.min_lon)
+                    neLat = max(neLat, p.max_lat)
+                    neLng = max(neLng, p.max_lon)
 
         return swLat, swLng, neLat, neLng
 
     def get_geofenced_results(self, list_to_check, name=""):
-        log.info('Using matplotlib: %s.', self.use_matplotlib)
-        log.info('Found %d coordinates to geofence.', len(list_to_check))
-        geofences_to_search_for = name.lower().split(",")
+        startTime = timeit.default_timer()
         if name != "":
-            log.info('Requested number of geofences: %d, "%s"', len(geofences_to_search_for), name)
+            names = set(name.lower().split(","))
+            allowed = [p for p in self.geofenced_polygons
+                       if p.name.lower() in names]
+        else:
+            allowed = self.geofenced_polygons
 
         if isinstance(list_to_check, dict):
-            geofenced_coordinates = {}
-            startTime = timeit.default_timer()
-            for key, item in list_to_check.items():
-                c = (item.get("latitude", 0), item.get("longitude", 0), 0)
-                # Coordinate is not valid if in one excluded area.
-                if self._is_excluded(c):
-                    continue
-
-                # Coordinate is geofenced if in one geofenced area.
-                if self.geofenced_areas:
-                    for va in self.geofenced_areas:
-                        if (name == "" or va["name"].lower() in geofences_to_search_for) and self._in_area(c, va):
-                            geofenced_coordinates[key] = item
-                            break
-                else:
-                    geofenced_coordinates[key] = item
+            keys = list_to_check.keys()
+            items = list_to_check.values()
         else:
-            geofenced_coordinates = []
-            startTime = timeit.default_timer()
-            for item in list_to_check:
-                c = (item.get("latitude", 0), item.get("longitude", 0), 0)
-                # Coordinate is not valid if in one excluded area.
-                if self._is_excluded(c):
-                    continue
-
-                # Coordinate is geofenced if in one geofenced area.
-                if self.geofenced_areas:
-                    for va in self.geofenced_areas:
-                        if (name == "" or va["name"].lower() in geofences_to_search_for) and self._in_area(c, va):
-                            geofenced_coordinates.append(item)
-                            break
-                else:
-                    geofenced_coordinates.append(item)
+            items = list_to_check
+        coordinates = [(item.get("latitude", 0), item.get("longitude", 0))
+                       for item in items]
+        mask = self._geofence_mask(coordinates, allowed)
+
+        if isinstance(list_to_check, dict):
+            geofenced_coordinates = {
+                key: item for key, item, keep in zip(keys, items, mask)
+                if keep}
+        else:
+            geofenced_coordinates = [
+                item for item, keep in zip(items, mask) if keep]
 
-        elapsedTime = timeit.default_timer() - startTime
-        log.info('Geofenced to %s coordinates in %.2fs.',
-                 len(geofenced_coordinates), elapsedTime)
+        log.debug('Geofenced %d to %d coordinates in %.4fs.',
+                  len(list_to_check), len(geofenced_coordinates),
+                  timeit.default_timer() - startTime)
         return geofenced_coordinates
 
     def get_geofenced_coordinates(self, coordinates, name=""):
-        log.info('Using matplotlib: %s.', self.use_matplotlib)
-        log.info('Found %d coordinates to geofence.', len(coordinates))
-        geofenced_coordinates = []
         startTime = timeit.default_timer()
-        for c in coordinates:
-            # Coordinate is not valid if in one excluded area.
-            if self._is_excluded(c):
-                continue
-
-            # Coordinate is geofenced if in one geofenced area.
-            if self.geofenced_areas:
-                for va in self.geofenced_areas:
-                    if (name == "" or name == va["name"]) and self._in_area(c, va):
-                        geofenced_coordinates.append(c)
-                        break
-            else:
-                geofenced_coordinates.append(c)
+        if name != "":
+            allowed = [p for p in self.geofenced_polygons if p.name == name]
+        else:
+            allowed = self.geofenced_polygons
+
+        mask = self._geofence_mask([(c[0], c[1]) for c in coordinates],
+                                   allowed)
+        geofenced_coordinates = [
+            c for c, keep in zip(coordinates, mask) if keep]
 
-        elapsedTime = timeit.default_timer() - startTime
-        log.info('Geofenced to %s coordinates in %.2fs.',
-                 len(geofenced_coordinates), elapsedTime)
+        log.debug('Geofenced %d to %d coordinates in %.4fs.',
+                  len(coordinates), len(geofenced_coordinates),
+                  timeit.default_timer() - startTime)
         return geofenced_coordinates
 
+    # Tells for each (lat, lon) whether it's outside every excluded area and,
+    # if there are geofenced areas, inside one of the allowed ones.
+    def _geofence_mask(self, coordinates, allowed):
+        if self.use_numpy and len(coordinates) > 1:
+            return self._geofence_mask_numpy(coordinates, allowed)
+
+        allowed = set(allowed)
+        mask = []
+        for lat, lon in coordinates:
+            if self._is_excluded((lat, lon)):
+                mask.append(False)
+            elif self.geofenced_polygons:
+                mask.append(any(
+                    p in allowed and p.contains(lat, lon)
+                    for p in self.geofenced_index.candidates(lat, lon)))
+            else:
+                mask.append(True)
+
+        return mask
+
+    def _geofence_mask_numpy(self, coordinates, allowed):
+        points = np.array(coordinates, dtype=float).reshape(-1, 2)
+        lats = points[:, 0]
+        lons = points[:, 1]
+
+        if self.geofenced_polygons:
+            mask = np.zeros(len(points), dtype=bool)
+            for p in allowed:
+                mask |= p.contains_many(lats, lons)
+        else:
+            mask = np.ones(len(points), dtype=bool)
+
+        for p in self.excluded_polygons:
+            mask &= ~p.contains_many(lats, lons)
+
+        return mask.tolist()
+
     def _is_excluded(self, coordinate):
-        for ea in self.excluded_areas:
-            if self._in_area(coordinate, ea):
+        lat, lon = coordinate[0], coordinate[1]
+        for p in self.excluded_index.candidates(lat, lon):
+            if p.contains(lat, lon):
                 return True
 
         return False
 
-    def _in_area(self, coordinate, area):
-        point = {'lat': coordinate[0], 'lon': coordinate[1]}
-        polygon = area['polygon']
-        if self.use_matplotlib:
-            return self.is_point_in_polygon_matplotlib(point, polygon)
-        else:
-            return self.is_point_in_polygon_custom(point, polygon)
-
     @staticmethod
     def parse_geofences_file(geofence_file, excluded):
         geofences = []
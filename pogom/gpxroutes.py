@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+from array import array
+from threading import Lock
+
+import gpxpy
+
+log = logging.getLogger(__name__)
+
+
+class GpxRoutes(object):
+    """Parsed GPX files by path, shared by the devices walking or
+    teleporting along them.
+
+    A file is parsed once into a flat array of latitudes and longitudes,
+    and again only when its mtime changes. Devices get a RouteSchedule,
+    their own position in the shared array.
+    """
+
+    def __init__(self):
+        # Path -> (mtime, points).
+        self.routes = {}
+        self.lock = Lock()
+
+    def get_points(self, path):
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            entry = self.routes.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        points = self.parse(path)
+        with self.lock:
+            self.routes[path] = (mtime, points)
+        log.debug('Parsed GPX route %s, %d points.', path, len(points) // 2)
+        return points
+
+    def schedule(self, path):
+        return RouteSchedule(self.get_points(path))
+
+    @staticmethod
+    def parse(path):
+        with open(path, 'r') as gpx_file:
+            gpx = gpxpy.parse(gpx_file)
+
+        points = array('d')
+        for track in gpx.tracks:
+            for segment in track.segments:
+                for point in segment.points:
+                    points.extend((round(point.latitude, 5),
+                                   round(point.longitude, 5)))
+
+        for waypoint in gpx.waypoints:
+            points.extend((round(waypoint.latitude, 5),
+                           round(waypoint.longitude, 5)))
+
+        for route in gpx.routes:
+            for point in route.points:
+                points.extend((round(point.latitude, 5),
+                               round(point.longitude, 5)))
+
+        return points
+
+
+class RouteSchedule(object):
+    """What's left of a GPX route for one device.
+
+    Behaves like the lists of (latitude, longitude) used as schedules
+    elsewhere, as far as devices use them: reaching the next point deletes
+    item 0, which only moves this schedule's offset into the shared points.
+    """
+
+    def __init__(self, points, start=0):
+        self.points = points
+        self.start = start
+
+    def __len__(self):
+        return len(self.points) // 2 - self.start
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('route index out of range')
+        i = 2 * (self.start + index)
+        return (self.points[i], self.points[i + 1])
+
+    def __delitem__(self, index):
+        if index != 0:
+            raise IndexError('only the next point can be deleted')
+        if len(self) == 0:
+            raise IndexError('route is empty')
+        self.start += 1
+
+    def __iter__(self):
+        points = self.points
+        for i in xrange(2 * self.start, len(points) - 1, 2):
+            yield (points[i], points[i + 1])
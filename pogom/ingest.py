@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import itertools
+import zlib
+
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from threading import Condition, Event, Lock, Thread
+from timeit import default_timer
+
+from . import models
+from .models import init_database
+
+log = logging.getLogger(__name__)
+
+
+class IngestPool(object):
+    """Worker processes that run Pogom.parse_map_protos for device posts, so
+    parsing scales with cores instead of sharing the web server's GIL.
+
+    Device state (devices, deviceschedules, devicesscheduling, ...) stays in
+    the web server process. A post is handed to a worker together with its
+    device, and by default the web server thread waits for the result, so
+    endpoints see the same state as when parsing in process. With wait=False
+    posts are only queued and acknowledged right away.
+
+    Posts of a device always go to the same worker, in order, which keeps
+    that worker's caches warm for it. Every worker has a queue of at most
+    queue_size posts; when it's full, new posts either wait or push out the
+    oldest one. Database, webhook and route cache updates made while parsing
+    are sent back and applied in the web server.
+    """
+
+    def __init__(self, app, processes, queue_size=100, drop_oldest=False,
+                 wait=True, timeout=60):
+        self.app = app
+        self.queue_size = queue_size
+        self.drop_oldest = drop_oldest
+        self.wait = wait
+        self.timeout = timeout
+        self.job_ids = itertools.count()
+        self.waiting = {}
+        self.lock = Lock()
+        self.results = multiprocessing.Queue()
+        # Posts waiting for a worker, and the few handed to it already.
+        self.pending = [deque() for _ in range(processes)]
+        self.conditions = [Condition() for _ in range(processes)]
+        self.jobs = [multiprocessing.Queue(maxsize=2)
+                     for _ in range(processes)]
+        self.queued = {}
+        self.dropped = 0
+        self.parse_times = Histogram()
+        self.latencies = Histogram()
+
+    # Forks the workers, before the web server starts any threads. The
+    # pool's own threads are only started once all workers are forked.
+    def start(self):
+        for i, jobs in enumerate(self.jobs):
+            p = multiprocessing.Process(target=ingest_worker,
+                                        name='ingest-{}'.format(i),
+                                        args=(self.app, jobs, self.results))
+            p.daemon = True
+            p.start()
+
+        for i in range(len(self.jobs)):
+            t = Thread(target=self.feed, name='ingest-feed-{}'.format(i),
+                       args=(i,))
+            t.daemon = True
+            t.start()
+
+        t = Thread(target=self.collect_results, name='ingest-results')
+        t.daemon = True
+        t.start()
+        log.info('Parsing device posts in %d processes%s.', len(self.jobs),
+                 '' if self.wait else ', acknowledging them right away')
+
+    def parse(self, protos, trainerlvl, deviceworker):
+        uuid = deviceworker['deviceid']
+        job_id = next(self.job_ids)
+        waiter = {'event': Event(), 'result': ''}
+        with self.lock:
+            self.queued[job_id] = default_timer()
+            if self.wait:
+                self.waiting[job_id] = waiter
+
+        worker = zlib.crc32(uuid.encode('utf-8')) % len(self.jobs)
+        self.enqueue(worker, (job_id, protos, trainerlvl, deviceworker,
+                              self.app.devices_last_scanned_times.get(uuid)))
+        if not self.wait:
+            return 'ok'
+
+        if not waiter['event'].wait(self.timeout):
+            log.warning('Parsing the post of %s took over %d seconds.',
+                        uuid, self.timeout)
+        with self.lock:
+            self.waiting.pop(job_id, None)
+        return waiter['result']
+
+    def enqueue(self, worker, job):
+        condition = self.conditions[worker]
+        pending = self.pending[worker]
+        with condition:
+            while len(pending) >= self.queue_size:
+                if not self.drop_oldest:
+                    condition.wait()
+                    continue
+                dropped = pending.popleft()
+                with self.lock:
+                    self.dropped += 1
+                self.release(dropped[0], '')
+                log.warning('Ingest queue %d is full, dropped the oldest '
+                            'post of %s.', worker, dropped[3]['deviceid'])
+            pending.append(job)
+            condition.notify_all()
+
+    # Moves posts from a worker's pending queue to the worker.
+    def feed(self, worker):
+        condition = self.conditions[worker]
+        pending = self.pending[worker]
+        while True:
+            with condition:
+                while not pending:
+                    condition.wait()
+                job = pending.popleft()
+                condition.notify_all()
+            self.jobs[worker].put(job)
+
+    def collect_results(self):
+        while True:
+            try:
+                kind, item = self.results.get()
+                if kind == 'db':
+                    self.app.db_update_queue.put(item)
+                elif kind == 'wh':
+                    self.app.wh_update_queue.put(item)
+                elif kind == 'route_cache':
+                    getattr(self.app.route_cache, item[0])(*item[1:])
+                elif kind == 'done':
+                    self.finish(*item)
+            except Exception as e:
+                log.exception('Exception in ingest results: %s', repr(e))
+
+    def finish(self, job_id, result, deviceworker, last_scanned_times,
+               parse_time):
+        uuid = deviceworker['deviceid']
+        if last_scanned_times is not None:
+            self.app.devices_last_scanned_times[uuid] = last_scanned_times
+
+        # The player name is the only device field parsing changes.
+        device = self.app.devices.get(uuid)
+        if device and device['name'] != deviceworker['name']:
+            device = device.copy()
+            device['name'] = deviceworker['name']
+            self.app.save_device(device, True)
+
+        self.parse_times.add(parse_time)
+        self.release(job_id, result)
+
+    # Forgets a post that was parsed or dropped, and wakes up its request.
+    def release(self, job_id, result):
+        with self.lock:
+            queued = self.queued.pop(job_id, None)
+            waiter = self.waiting.get(job_id)
+        if queued is not None:
+            self.latencies.add(default_timer() - queued)
+        if waiter:
+            waiter['result'] = result
+            waiter['event'].set()
+
+    def get_stats(self):
+        depths = []
+        for condition, pending in zip(self.conditions, self.pending):
+            with condition:
+                depths.append(len(pending))
+        with self.lock:
+            in_progress = len(self.queued)
+            dropped = self.dropped
+        return {
+            'processes': len(self.jobs),
+            'queue_depths': depths,
+            'in_progress': in_progress,
+            'dropped': dropped,
+            'parse_time': self.parse_times.to_dict(),
+            'latency': self.latencies.to_dict()
+        }
+
+
+class Histogram(object):
+    """Counts of durations in fixed millisecond buckets."""
+
+    BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.total_ms = 0.0
+        self.lock = Lock()
+
+    def add(self, secs):
+        ms = secs * 1000
+        with self.lock:
+            self.counts[bisect_left(self.BOUNDS_MS, ms)] += 1
+            self.total_ms += ms
+
+    def to_dict(self):
+        with self.lock:
+            counts = list(self.counts)
+            total_ms = self.total_ms
+        buckets = OrderedDict(
+            ('<={}ms'.format(b), c) for b, c in zip(self.BOUNDS_MS, counts))
+        buckets['>{}ms'.format(self.BOUNDS_MS[-1])] = counts[-1]
+        count = sum(counts)
+        return {
+            'count': count,
+            'mean_ms': round(total_ms / count, 3) if count else 0,
+            'buckets': buckets
+        }
+
+
+class ForwardQueue(object):
+    """Stands in for a queue of the web server inside a worker."""
+
+    def __init__(self, results, kind):
+        self.results = results
+        self.kind = kind
+
+    def put(self, item):
+        self.results.put((self.kind, item))
+
+
+class ForwardRouteCache(object):
+    """Stands in for the web server's RouteCache inside a worker."""
+
+    def __init__(self, results):
+        self.results = results
+
+    def note_forts(self, kind, fort_ids):
+        self.results.put(('route_cache', ('note_forts', kind, list(fort_ids))))
+
+    def invalidate(self, kind):
+        self.results.put(('route_cache', ('invalidate', kind)))
+
+
+def ingest_worker(app, jobs, results):
+    # Connections opened by the web server can't be shared with it.
+    init_database(None)
+    # Spawnpoints are only updated in the web server's cache when it writes
+    # them, and other workers write the same spawnpoints, so a worker's
+    # cache would go stale. Workers read them from the db instead.
+    models.spawnpoint_cache = None
+
+    app.db_update_queue = ForwardQueue(results, 'db')
+    app.wh_update_queue = ForwardQueue(results, 'wh')
+    app.route_cache = ForwardRouteCache(results)
+    # Devices are saved by the web server when the result comes back.
+    app.save_device = lambda device, force_save=False: None
+
+    while True:
+        job_id, protos, trainerlvl, deviceworker, last_scanned_times = \
+            jobs.get()
+        uuid = deviceworker['deviceid']
+        result = ''
+        start = default_timer()
+        try:
+            # Only this worker parses the device's posts, so its own last
+            # scanned times are the latest.
+            if last_scanned_times is not None:
+                app.devices_last_scanned_times.setdefault(
+                    uuid, last_scanned_times)
+            result = app.parse_map_protos(protos, trainerlvl, deviceworker)
+        except Exception as e:
+            log.exception('Exception parsing the post of %s: %s', uuid,
+                          repr(e))
+        finally:
+            results.put(('done', (job_id, result, deviceworker,
+                                  app.devices_last_scanned_times.get(uuid),
+                                  default_timer() - start)))
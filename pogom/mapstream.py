@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import time
+
+from collections import deque
+from datetime import datetime, timedelta
+from threading import Condition, Lock
+
+from flask import json
+
+log = logging.getLogger(__name__)
+
+# Kinds of map items that are streamed, as named in /raw_data responses,
+# with the field that changes whenever an item is written.
+STREAM_KINDS = {
+    'pokemons': 'last_modified',
+    'pokestops': 'last_updated',
+    'gyms': 'last_scanned'
+}
+
+
+class MapStream(object):
+    """Pushes new and changed map items to subscribed map clients.
+
+    The db updater marks the kinds of items it wrote. The publisher then
+    loads everything of those kinds that changed since its last look, once
+    for all clients, and hands each client the items in its viewport.
+    Items written by other processes aren't marked, so when nothing was
+    marked for a while the publisher looks at all kinds anyway.
+    Clients are indexed by the grid cells their viewport overlaps, so an
+    item is only checked against the clients that can see it.
+    """
+
+    # Degrees per grid cell of the subscriber index.
+    GRID = 0.25
+    # Viewports overlapping more cells are checked for every item.
+    MAX_CELLS = 64
+    # Rows can reach the database a while after they were last modified,
+    # so every look goes back this far. Items seen already are skipped.
+    OVERLAP = timedelta(seconds=10)
+
+    def __init__(self, queue_size=20):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.cells = {}
+        self.wide = set()
+        self.lock = Lock()
+        self.changed = set()
+        self.condition = Condition()
+        # Kind -> {id: version} of items sent during the overlap.
+        self.versions = dict((kind, {}) for kind in STREAM_KINDS)
+
+    def subscribe(self, swLat, swLng, neLat, neLng, kinds, exclude=None,
+                  item_filter=None):
+        subscriber = Subscriber(self, (float(swLat), float(swLng),
+                                       float(neLat), float(neLng)),
+                                kinds, exclude, item_filter)
+        cells = self.box_cells(subscriber.box)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if cells is None:
+                self.wide.add(subscriber)
+            else:
+                for cell in cells:
+                    self.cells.setdefault(cell, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        cells = self.box_cells(subscriber.box)
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            self.wide.discard(subscriber)
+            for cell in cells or []:
+                subscribers = self.cells.get(cell)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.cells[cell]
+
+    def has_subscribers(self):
+        return bool(self.subscribers)
+
+    def cell(self, lat, lng):
+        return (int(math.floor(lat / self.GRID)),
+                int(math.floor(lng / self.GRID)))
+
+    # Grid cells overlapped by a box, None if there are too many.
+    def box_cells(self, box):
+        y0, x0 = self.cell(box[0], box[1])
+        y1, x1 = self.cell(box[2], box[3])
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > self.MAX_CELLS:
+            return None
+        return [(y, x) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    # Called by the db updater with the kinds of items it wrote.
+    def mark_changed(self, kind):
+        if not self.subscribers:
+            return
+        with self.condition:
+            self.changed.add(kind)
+            self.condition.notify()
+
+    # Waits until something changed, returns the changed kinds.
+    def wait_changed(self, timeout):
+        with self.condition:
+            if not self.changed:
+                self.condition.wait(timeout)
+            changed = self.changed
+            self.changed = set()
+        return changed
+
+    # Drops items that were already sent, and remembers the others.
+    def unseen(self, kind, items, since):
+        field = STREAM_KINDS[kind]
+        versions = self.versions[kind]
+        new = []
+        for key, item in items:
+            version = item.get(field)
+            if key in versions and versions[key] == version:
+                continue
+            versions[key] = version
+            new.append(item)
+        for key in [k for k, v in versions.iteritems()
+                    if v is None or v < since]:
+            del versions[key]
+        return new
+
+    # Hands the items of a kind to the subscribers that can see them.
+    def publish(self, kind, items):
+        with self.lock:
+            cells = self.cells
+            wide = list(self.wide)
+            batches = {}
+            for item in items:
+                lat = item['latitude']
+                lng = item['longitude']
+                candidates = cells.get(self.cell(lat, lng), ())
+                for subscriber in wide + list(candidates):
+                    if subscriber.accepts(kind, item):
+                        batches.setdefault(subscriber, []).append(item)
+
+        for subscriber, batch in batches.iteritems():
+            subscriber.send(kind, batch)
+
+
+class Subscriber(object):
+    """A map client's viewport and filters, and the updates queued for it.
+
+    Updates that don't fit the queue push out the oldest ones, after which
+    the client is asked to reload the map instead.
+    """
+
+    def __init__(self, stream, box, kinds, exclude, item_filter):
+        self.stream = stream
+        self.box = box
+        self.kinds = set(kinds)
+        self.exclude = set(exclude or ())
+        self.item_filter = item_filter
+        self.queue = deque()
+        self.lagged = False
+        self.condition = Condition()
+
+    def accepts(self, kind, item):
+        if kind not in self.kinds:
+            return False
+        if not (self.box[0] <= item['latitude'] <= self.box[2] and
+                self.box[1] <= item['longitude'] <= self.box[3]):
+            return False
+        return kind != 'pokemons' or item['pokemon_id'] not in self.exclude
+
+    def send(self, kind, items):
+        if self.item_filter is not None:
+            items = self.item_filter(kind, items)
+            if not items:
+                return
+        with self.condition:
+            if len(self.queue) >= self.stream.queue_size:
+                self.queue.popleft()
+                self.lagged = True
+            self.queue.append((kind, items))
+            self.condition.notify()
+
+    # Server-Sent Events for the client, with a comment now and then so
+    # proxies keep the connection open.
+    def events(self, dumps=json.dumps, keepalive=15):
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                with self.condition:
+                    if not self.queue and not self.lagged:
+                        self.condition.wait(keepalive)
+                    lagged = self.lagged
+                    updates = list(self.queue)
+                    self.queue.clear()
+                    self.lagged = False
+
+                if lagged:
+                    yield 'event: reload\ndata: {}\n\n'
+                    continue
+                if not updates:
+                    yield ': keepalive\n\n'
+                    continue
+
+                data = {}
+                for kind, items in updates:
+                    data.setdefault(kind, []).extend(items)
+                yield 'event: update\ndata: {}\n\n'.format(dumps(data))
+        finally:
+            self.stream.unsubscribe(self)
+
+
+# Loads what changed and publishes it. fetch(kind, since) returns a list
+# of (id, item) of that kind modified after since.
+def map_stream_publisher(stream, fetch, interval=1.0):
+    last_look = {}
+    while True:
+        try:
+            # Without local writes, e.g. on a map only instance, poll as
+            # often as the map did before it streamed.
+            changed = stream.wait_changed(interval * 5) or set(STREAM_KINDS)
+            if not stream.has_subscribers():
+                # New subscribers load the map first, so only later
+                # changes are sent to them.
+                last_look = dict((kind, datetime.utcnow())
+                                 for kind in STREAM_KINDS)
+                continue
+
+            for kind in changed:
+                start = datetime.utcnow()
+                since = last_look.get(kind, start) - stream.OVERLAP
+                items = stream.unseen(kind, fetch(kind, since), since)
+                last_look[kind] = start
+                if items:
+                    stream.publish(kind, items)
+
+            # Batch up what's written in the meantime.
+            time.sleep(interval)
+        except Exception as e:
+            log.exception('Exception in map stream publisher: %s', repr(e))
+            time.sleep(5)
+
+
+# Map items of all subscribers go through this one stream.
+map_stream = MapStream()
@@ -19,11 +19,14 @@ from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError, case
 from playhouse.migrate import migrate, MySQLMigrator
 from datetime import datetime, timedelta
-from cachetools import TTLCache
+from cachetools import TTLCache, LRUCache
 from cachetools import cached
 from timeit import default_timer
-import geopy
+from threading import Lock
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter, or_
+from Queue import Empty
 from flask import json
 
 from .utils import (get_pokemon_name, get_pokemon_types,
@@ -31,9 +34,16 @@ from .utils import (get_pokemon_name, get_pokemon_types,
                     get_move_name, get_move_damage, get_move_energy,
                     get_move_type, calc_pokemon_level, peewee_attr_to_col,
                     get_quest_icon, get_quest_quest_text, get_quest_reward_text,
-                    get_timezone_offset, point_is_scheduled)
-from .transform import transform_from_wgs_to_gcj, get_new_coords
+                    get_timezone_offset)
+from .transform import (transform_from_wgs_to_gcj, get_new_coords,
+                        haversine_distances)
 from .customLog import printPokemon
+from .activepokemon import ActivePokemonIndex
+from . import recentlyseen
+from .spawncounts import SpawnCounts, hour_bucket, EPOCH
+from .geocell import geocell, viewport_ranges, uncovered_ranges
+from .mapstream import map_stream
+from .routing import plan_route
 
 from .account import check_login, setup_api, pokestop_spinnable, spin_pokestop
 from .proxy import get_new_proxy
@@ -48,7 +58,31 @@ args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
 
-db_schema_version = 62
+# Spawnpoint rows by id, filled on read and by the db updater on write.
+# cachetools in Python2.7 isn't thread safe, so we add a lock.
+spawnpoint_cache = (LRUCache(maxsize=args.spawnpoint_cache_size)
+                    if args.spawnpoint_cache_size > 0 else None)
+spawnpoint_cache_lock = Lock()
+
+# Sightings per hour for dynamic rarity.
+spawn_counts = SpawnCounts()
+
+# Active Pokemon served to the map, fed by the db updater. Only complete
+# when this process writes all Pokemon, which a map only instance doesn't.
+active_pokemon = (ActivePokemonIndex()
+                  if not (args.no_pokemon_index or args.map_only) else None)
+
+# Parsed quest JSON with its quest and reward texts, by quest_json and
+# locale. Quests don't change for a whole day.
+quest_text_cache = TTLCache(maxsize=20000, ttl=24 * 60 * 60)
+quest_text_cache_lock = Lock()
+
+# Threads for the lookups that fill in the forts on the map, started on
+# first use.
+lookup_pool = None
+lookup_pool_lock = Lock()
+
+db_schema_version = 63
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
@@ -110,6 +144,50 @@ class LatLongModel(BaseModel):
                         result['latitude'], result['longitude'])
         return results
 
+    @classmethod
+    def in_box(cls, swLat, swLng, neLat, neLng):
+        return ((cls.latitude >= swLat) &
+                (cls.longitude >= swLng) &
+                (cls.latitude <= neLat) &
+                (cls.longitude <= neLng))
+
+    # Rows in the box, for models with a geocell field. The geocell ranges
+    # let MySQL read a few short ranges of the geocell index instead of the
+    # whole latitude band of the box. The map's queries still use the
+    # latitude/longitude boxes until tools/bench_viewport_query.py shows
+    # MySQL picks the geocell index for these.
+    @classmethod
+    def in_viewport(cls, swLat, swLng, neLat, neLng):
+        ranges = viewport_ranges(swLat, swLng, neLat, neLng)
+        return (geocell_clause(cls.geocell, ranges) &
+                cls.in_box(swLat, swLng, neLat, neLng))
+
+    # Rows in the new box that aren't in the old one. Unlike a NOT over the
+    # old box, the geocell ranges of the uncovered cells can use an index.
+    @classmethod
+    def in_uncovered_area(cls, swLat, swLng, neLat, neLng, oSwLat, oSwLng,
+                          oNeLat, oNeLng):
+        ranges = uncovered_ranges(swLat, swLng, neLat, neLng,
+                                  oSwLat, oSwLng, oNeLat, oNeLng)
+        return (geocell_clause(cls.geocell, ranges) &
+                cls.in_box(swLat, swLng, neLat, neLng) &
+                ~cls.in_box(oSwLat, oSwLng, oNeLat, oNeLng))
+
+
+# Matches rows whose geocell is in one of the (first, last) ranges.
+def geocell_clause(field, ranges):
+    if not ranges:
+        return SQL('0')
+    return reduce(or_, [field.between(first, last) for first, last in ranges])
+
+
+# Fills in the geocells of parsed map objects. That's done by the parsers,
+# which run in the ingest workers, so the db writer doesn't have to.
+def add_geocells(*batches):
+    for rows in batches:
+        for row in rows.itervalues():
+            row['geocell'] = geocell(row['latitude'], row['longitude'])
+
 
 class Pokemon(LatLongModel):
     # We are base64 encoding the ids delivered by the api
@@ -135,6 +213,7 @@ class Pokemon(LatLongModel):
     weather_boosted_condition = SmallIntegerField(null=True)
     last_modified = DateTimeField(
         null=True, index=True, default=datetime.utcnow)
+    geocell = BigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = (
@@ -145,6 +224,11 @@ class Pokemon(LatLongModel):
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                    oSwLng=None, oNeLat=None, oNeLng=None, exclude=None):
+        if active_pokemon is not None:
+            return Pokemon.active_index().get_active(
+                swLat, swLng, neLat, neLng, timestamp, oSwLat, oSwLng,
+                oNeLat, oNeLng, exclude)
+
         now_date = datetime.utcnow()
         query = Pokemon.select()
 
@@ -193,8 +277,36 @@ class Pokemon(LatLongModel):
                      .dicts())
         return list(query)
 
+    # Returns the (encounter_id, spawnpoint_id) pairs of the given encounter
+    # ids that are still active. Only ids that weren't recently seen are
+    # looked up in the database.
+    @staticmethod
+    def get_encountered(encounter_ids, now_date):
+        known = recentlyseen.seen_pokemon.get_many(encounter_ids)
+        missing = [e for e in encounter_ids if e not in known]
+        if missing:
+            with Pokemon.database().execution_context():
+                query = (Pokemon
+                         .select(Pokemon.encounter_id, Pokemon.spawnpoint_id,
+                                 Pokemon.disappear_time)
+                         .where((Pokemon.disappear_time >= now_date) &
+                                (Pokemon.encounter_id << missing))
+                         .dicts())
+                for p in query:
+                    encounter_id = long(p['encounter_id'])
+                    known[encounter_id] = p['spawnpoint_id']
+                    recentlyseen.seen_pokemon.set(
+                        encounter_id, p['spawnpoint_id'],
+                        p['disappear_time'])
+
+        return set(known.items())
+
     @staticmethod
     def get_active_by_id(ids, swLat, swLng, neLat, neLng):
+        if active_pokemon is not None:
+            return Pokemon.active_index().get_active_by_id(
+                ids, swLat, swLng, neLat, neLng)
+
         if not (swLat and swLng and neLat and neLng):
             query = (Pokemon
                      .select()
@@ -214,29 +326,50 @@ class Pokemon(LatLongModel):
 
         return list(query)
 
+    # Fill the in-memory index from the database on first use, the db
+    # updater keeps it current afterwards.
+    @staticmethod
+    def active_index():
+        if not active_pokemon.loaded:
+            with Pokemon.database().execution_context():
+                query = (Pokemon
+                         .select()
+                         .where(Pokemon.disappear_time > datetime.utcnow())
+                         .dicts())
+                active_pokemon.load(list(query))
+
+        return active_pokemon
+
     # Get all Pokémon spawn counts based on the last x hours.
     # More efficient than get_seen(): we don't do any unnecessary mojo.
     # Returns a dict:
     #   { 'pokemon': [ {'pokemon_id': '', 'count': 1} ], 'total': 1 }.
     @staticmethod
     def get_spawn_counts(hours):
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id,
-                         fn.Count(Pokemon.pokemon_id).alias('count')))
-
         # Allow 0 to query everything.
+        since = None
         if hours:
-            hours = datetime.utcnow() - timedelta(hours=hours)
-            # Not using WHERE speeds up the query.
-            query = query.where(Pokemon.disappear_time > hours)
-
-        query = query.group_by(Pokemon.pokemon_id).dicts()
+            since = hour_bucket(datetime.utcnow() - timedelta(hours=hours))
 
-        # We need a total count. Use reduce() instead of sum() for O(n)
-        # instead of O(2n) caused by list comprehension.
-        total = reduce(lambda x, y: x + y['count'], query, 0)
+        # Only read the database the first time, new sightings are counted
+        # as they are written.
+        if not spawn_counts.covers(since):
+            hour = fn.TIMESTAMPDIFF(SQL('HOUR'), '1970-01-01 00:00:00',
+                                    Pokemon.disappear_time)
+            query = (Pokemon
+                     .select(hour.alias('hour'), Pokemon.pokemon_id,
+                             fn.Count(Pokemon.pokemon_id).alias('count')))
+            if since is not None:
+                query = query.where(Pokemon.disappear_time >=
+                                    EPOCH + timedelta(hours=since))
+            query = query.group_by(SQL('hour'), Pokemon.pokemon_id).tuples()
+            spawn_counts.load(query, since)
+
+        counts, total = spawn_counts.get(since)
+        pokemon = [{'pokemon_id': pokemon_id, 'count': count}
+                   for pokemon_id, count in counts.items()]
 
-        return {'pokemon': query, 'total': total}
+        return {'pokemon': pokemon, 'total': total}
 
     @staticmethod
     @cached(cache)
@@ -392,11 +525,9 @@ class Quest(BaseModel):
                      .dicts())
 
         for q in query:
-            if q['quest_json'] is not None:
-                q['quest_json'] = json.loads(q['quest_json'])
+            q['quest_json'], q['quest_text'], q['reward_text'] = \
+                render_quest(q['quest_json'])
             q['icon'] = get_quest_icon(q['reward_type'], q['reward_item'])
-            q['quest_text'] = get_quest_quest_text(q['quest_json'])
-            q['reward_text'] = get_quest_reward_text(q['quest_json'])
             q['url'] = q.get('url', '').replace('http://', 'https://')
 #        quests = {}
 #        for quest in query:
@@ -420,6 +551,7 @@ class Pokestop(LatLongModel):
     active_pokemon_expiration = DateTimeField(null=True, index=True)
     last_updated = DateTimeField(
         null=True, index=True, default=datetime.utcnow)
+    geocell = BigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -514,62 +646,65 @@ class Pokestop(LatLongModel):
             pokestop_ids.append(p['pokestop_id'])
 
         if len(pokestop_ids) > 0:
-            pokemon = (PokestopMember
-                       .select(
-                           PokestopMember.encounter_id,
-                           PokestopMember.pokestop_id,
-                           PokestopMember.pokemon_id,
-                           PokestopMember.disappear_time,
-                           PokestopMember.gender,
-                           PokestopMember.costume,
-                           PokestopMember.form,
-                           PokestopMember.weather_boosted_condition,
-                           PokestopMember.last_modified,
-                           PokestopMember.distance)
-                       .where(PokestopMember.pokestop_id << pokestop_ids)
-                       .where(PokestopMember.last_modified <= now_date)
-                       .where(PokestopMember.disappear_time > now_date)
-                       .distinct()
-                       .dicts())
+            def pokemon_lookup(ids):
+                return (PokestopMember
+                        .select(
+                            PokestopMember.encounter_id,
+                            PokestopMember.pokestop_id,
+                            PokestopMember.pokemon_id,
+                            PokestopMember.disappear_time,
+                            PokestopMember.gender,
+                            PokestopMember.costume,
+                            PokestopMember.form,
+                            PokestopMember.weather_boosted_condition,
+                            PokestopMember.last_modified,
+                            PokestopMember.distance)
+                        .where(PokestopMember.pokestop_id << ids)
+                        .where(PokestopMember.last_modified <= now_date)
+                        .where(PokestopMember.disappear_time > now_date)
+                        .distinct()
+                        .dicts())
+
+            def quest_lookup(ids):
+                return (Quest
+                        .select(
+                            Quest.pokestop_id,
+                            Quest.quest_type,
+                            Quest.reward_type,
+                            Quest.reward_item,
+                            Quest.quest_json)
+                        .where((Quest.pokestop_id << ids) &
+                               (Quest.expiration >= now_date))
+                        .dicts())
+
+            details, missing = pokestop_details_cache.get_many(pokestop_ids)
+            pokemon, quests, found = lookup_forts(
+                (pokemon_lookup, pokestop_ids),
+                (quest_lookup, pokestop_ids),
+                (pokestop_details_cache.lookup, missing))
+            details.update(pokestop_details_cache.add(missing, found))
 
             for p in pokemon:
                 p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
                 pokestops[p['pokestop_id']]['pokemon'].append(p)
 
-            details = (PokestopDetails
-                       .select(
-                           PokestopDetails.pokestop_id,
-                           PokestopDetails.name,
-                           PokestopDetails.url)
-                       .where(PokestopDetails.pokestop_id << pokestop_ids)
-                       .dicts())
-
-            for d in details:
-                pokestops[d['pokestop_id']]['name'] = d['name']
-                pokestops[d['pokestop_id']]['url'] = d.get('url', '').replace('http://', 'https://')
-
-            quests = (Quest
-                      .select(
-                          Quest.pokestop_id,
-                          Quest.quest_type,
-                          Quest.reward_type,
-                          Quest.reward_item,
-                          Quest.quest_json)
-                      .where((Quest.pokestop_id << pokestop_ids) &
-                             (Quest.expiration >= now_date))
-                      .dicts())
+            for pokestop_id, d in details.iteritems():
+                if d:
+                    pokestops[pokestop_id]['name'] = d['name']
+                    pokestops[pokestop_id]['url'] = d['url']
 
             for q in quests:
-                if q['quest_json'] is not None:
-                    q['quest_json'] = json.loads(q['quest_json'])
+                q['quest_json'], quest_text, reward_text = render_quest(
+                    q['quest_json'])
 
                 pokestops[q['pokestop_id']]['quest']['text'] = q['quest_type']
                 pokestops[q['pokestop_id']]['quest']['type'] = q['reward_type']
                 pokestops[q['pokestop_id']]['quest']['item'] = q['reward_item']
                 pokestops[q['pokestop_id']]['quest']['icon'] = get_quest_icon(q['reward_type'], q['reward_item'])
                 pokestops[q['pokestop_id']]['quest']['quest_json'] = q['quest_json']
-                pokestops[q['pokestop_id']]['quest']['quest_text'] = get_quest_quest_text(q['quest_json'])
-                pokestops[q['pokestop_id']]['quest']['reward_text'] = get_quest_reward_text(q['quest_json'])
+                quest = pokestops[q['pokestop_id']]['quest']
+                quest['quest_text'] = quest_text
+                quest['reward_text'] = reward_text
 
         # Re-enable the GC.
         gc.enable()
@@ -578,22 +713,57 @@ class Pokestop(LatLongModel):
 
     @staticmethod
     def get_pokestop_details(id):
-        try:
-            details = (PokestopDetails
-                       .select(
-                           PokestopDetails.pokestop_id,
-                           PokestopDetails.name,
-                           PokestopDetails.description,
-                           PokestopDetails.url)
-                       .where(PokestopDetails.pokestop_id == id)
-                       .dicts()
-                       .get())
-        except PokestopDetails.DoesNotExist:
-            return None
+        return pokestop_details_cache.get(id)
 
-        details['url'] = details.get('url', '').replace('http://', 'https://')
+    # Returns {pokestop_id: last_modified epoch seconds} for the given ids
+    # that are known. Only ids that weren't recently seen are looked up in
+    # the database.
+    @staticmethod
+    def get_last_modified(pokestop_ids):
+        known = recentlyseen.pokestop_last_modified.get_many(pokestop_ids)
+        missing = [p for p in pokestop_ids if p not in known]
+        if missing:
+            with Pokestop.database().execution_context():
+                query = (Pokestop
+                         .select(Pokestop.pokestop_id, Pokestop.last_modified,
+                                 Pokestop.latitude, Pokestop.longitude)
+                         .where(Pokestop.pokestop_id << missing)
+                         .dicts())
+                for p in query:
+                    Pokestop.remember(p)
+                    known[p['pokestop_id']] = int(
+                        (p['last_modified'] -
+                         datetime(1970, 1, 1)).total_seconds())
 
-        return details
+        return known
+
+    # Returns (latitude, longitude) of a pokestop, or None if it's unknown.
+    @staticmethod
+    def get_location(id):
+        location = recentlyseen.pokestop_locations.get(id)
+        if location is None:
+            with Pokestop.database().execution_context():
+                query = list(Pokestop
+                             .select(Pokestop.pokestop_id,
+                                     Pokestop.last_modified,
+                                     Pokestop.latitude, Pokestop.longitude)
+                             .where(Pokestop.pokestop_id == id)
+                             .dicts())
+            if query:
+                Pokestop.remember(query[0])
+                location = (query[0]['latitude'], query[0]['longitude'])
+        return location
+
+    # Keeps the last_modified and location of a pokestop row in memory.
+    @staticmethod
+    def remember(row):
+        pokestop_id = row['pokestop_id']
+        if row.get('last_modified') is not None:
+            recentlyseen.pokestop_last_modified.set(pokestop_id, int(
+                (row['last_modified'] - datetime(1970, 1, 1)).total_seconds()))
+        if row.get('latitude') is not None:
+            recentlyseen.pokestop_locations.set(
+                pokestop_id, (row['latitude'], row['longitude']))
 
     @staticmethod
     def get_stop(id):
@@ -666,16 +836,16 @@ class Pokestop(LatLongModel):
                  .dicts())
 
         for q in quest:
-            if q['quest_json'] is not None:
-                q['quest_json'] = json.loads(q['quest_json'])
+            q['quest_json'], quest_text, reward_text = render_quest(
+                q['quest_json'])
 
             result['quest']['text'] = q['quest_type']
             result['quest']['type'] = q['reward_type']
             result['quest']['item'] = q['reward_item']
             result['quest']['icon'] = get_quest_icon(q['reward_type'], q['reward_item'])
             result['quest']['quest_json'] = q['quest_json']
-            result['quest']['quest_text'] = get_quest_quest_text(q['quest_json'])
-            result['quest']['reward_text'] = get_quest_reward_text(q['quest_json'])
+            result['quest']['quest_text'] = quest_text
+            result['quest']['reward_text'] = reward_text
 
         return result
 
@@ -707,12 +877,10 @@ class Pokestop(LatLongModel):
                                   (Pokestop.longitude <= maxlng))))
                          .dicts())
 
-            if len(scheduled_points) > 0:
-                query = (query
-                         .where(Pokestop.pokestop_id.not_in(scheduled_points))
-                         .dicts())
-
-            queryDict = query.dicts()
+            # Claimed by other devices, excluded here rather than by a huge
+            # NOT IN.
+            queryDict = [p for p in query.dicts()
+                         if p['pokestop_id'] not in scheduled_points]
 
             pokestop_quest_ids = []
 
@@ -740,11 +908,15 @@ class Pokestop(LatLongModel):
             if len(queryDict) > 0 and geofences.is_enabled() and not routing_outside_geofences:
                 queryDict = geofences.get_geofenced_results(queryDict, geofence_name)
 
-            for p in queryDict:
+            queryDict = list(queryDict)
+            distances = haversine_distances(
+                lat, lng, [round(p['latitude'], 5) for p in queryDict],
+                [round(p['longitude'], 5) for p in queryDict])
+            for p, distance in zip(queryDict, distances):
                 key = p['pokestop_id']
                 latitude = round(p['latitude'], 5)
                 longitude = round(p['longitude'], 5)
-                distance = geopy.distance.vincenty((lat, lng), (latitude, longitude)).km
+                distance /= 1000
                 if (not questless or p['pokestop_id'] not in pokestop_quest_ids) and (dist == 0 or distance <= dist):
                     pokestops[key] = {
                         'latitude': latitude,
@@ -764,14 +936,10 @@ class Pokestop(LatLongModel):
             while len(orderedpokestops) > maxlength:
                 orderedpokestops.popitem()
 
-            result = []
-            while len(orderedpokestops) > 0:
-                value = orderedpokestops.items()[0][1]
-                result.append((value['latitude'], value['longitude'], value['key']))
-                newlat = value['latitude']
-                newlong = value['longitude']
-                orderedpokestops.popitem(last=False)
-                orderedpokestops = OrderedDict(sorted(orderedpokestops.items(), key=lambda x: geopy.distance.vincenty((newlat, newlong), (x[1]['latitude'], x[1]['longitude'])).km))
+            result = plan_route(
+                [(v['latitude'], v['longitude'], v['key'])
+                 for v in orderedpokestops.values()],
+                lat, lng, improve=args.route_two_opt)
 
         return result
 
@@ -790,6 +958,7 @@ class Gym(LatLongModel):
     last_scanned = DateTimeField(default=datetime.utcnow, index=True)
     is_in_battle = BooleanField(default=False)
     is_ex_raid_eligible = BooleanField(default=False)
+    geocell = BigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -853,45 +1022,47 @@ class Gym(LatLongModel):
             gym_ids.append(g['gym_id'])
 
         if len(gym_ids) > 0:
-            pokemon = (GymMember
-                       .select(
-                           GymMember.gym_id,
-                           GymPokemon.cp.alias('pokemon_cp'),
-                           GymMember.cp_decayed,
-                           GymMember.deployment_time,
-                           GymMember.last_scanned,
-                           GymPokemon.pokemon_id,
-                           GymPokemon.costume,
-                           GymPokemon.form,
-                           GymPokemon.shiny)
-                       .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
-                       .join(GymPokemon, on=(GymMember.pokemon_uid ==
-                                             GymPokemon.pokemon_uid))
-                       .where(GymMember.gym_id << gym_ids)
-                       .where(GymMember.last_scanned > Gym.last_modified)
-                       .distinct()
-                       .dicts())
+            def pokemon_lookup(ids):
+                return (GymMember
+                        .select(
+                            GymMember.gym_id,
+                            GymPokemon.cp.alias('pokemon_cp'),
+                            GymMember.cp_decayed,
+                            GymMember.deployment_time,
+                            GymMember.last_scanned,
+                            GymPokemon.pokemon_id,
+                            GymPokemon.costume,
+                            GymPokemon.form,
+                            GymPokemon.shiny)
+                        .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
+                        .join(GymPokemon, on=(GymMember.pokemon_uid ==
+                                              GymPokemon.pokemon_uid))
+                        .where(GymMember.gym_id << ids)
+                        .where(GymMember.last_scanned > Gym.last_modified)
+                        .distinct()
+                        .dicts())
+
+            def raid_lookup(ids):
+                return (Raid
+                        .select()
+                        .where(Raid.gym_id << ids)
+                        .dicts())
+
+            details, missing = gym_details_cache.get_many(gym_ids)
+            pokemon, raids, found = lookup_forts(
+                (pokemon_lookup, gym_ids),
+                (raid_lookup, gym_ids),
+                (gym_details_cache.lookup, missing))
+            details.update(gym_details_cache.add(missing, found))
 
             for p in pokemon:
                 p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
                 gyms[p['gym_id']]['pokemon'].append(p)
 
-            details = (GymDetails
-                       .select(
-                           GymDetails.gym_id,
-                           GymDetails.name,
-                           GymDetails.url)
-                       .where(GymDetails.gym_id << gym_ids)
-                       .dicts())
-
-            for d in details:
-                gyms[d['gym_id']]['name'] = d['name']
-                gyms[d['gym_id']]['url'] = d['url'].replace('http://', 'https://')
-
-            raids = (Raid
-                     .select()
-                     .where(Raid.gym_id << gym_ids)
-                     .dicts())
+            for gym_id, d in details.iteritems():
+                if d:
+                    gyms[gym_id]['name'] = d['name']
+                    gyms[gym_id]['url'] = d['url']
 
             for r in raids:
                 if r['pokemon_id']:
@@ -932,22 +1103,7 @@ class Gym(LatLongModel):
 
     @staticmethod
     def get_gym_details(id):
-        try:
-            details = (GymDetails
-                       .select(
-                           GymDetails.gym_id,
-                           GymDetails.name,
-                           GymDetails.description,
-                           GymDetails.url)
-                       .where(GymDetails.gym_id == id)
-                       .dicts()
-                       .get())
-        except GymDetails.DoesNotExist:
-            return None
-
-        details['url'] = details.get('url', '').replace('http://', 'https://')
-
-        return details
+        return gym_details_cache.get(id)
 
     @staticmethod
     def get_gym(id):
@@ -1037,15 +1193,23 @@ class Gym(LatLongModel):
     def set_gyms_in_park(gyms, park):
         gym_ids = [gym['gym_id'] for gym in gyms]
         Gym.update(park=park).where(Gym.gym_id << gym_ids).execute()
+        for gym_id in gym_ids:
+            recentlyseen.gym_parks.set(gym_id, park)
 
     @staticmethod
     def get_gyms_park(id):
+        park = recentlyseen.gym_parks.get(id)
+        if park is not None:
+            return park
+
+        park = False
         with Gym.database().execution_context():
             gym_by_id = Gym.select(Gym.park).where(
                 Gym.gym_id == id).dicts()
             if gym_by_id:
-                return gym_by_id[0]['park']
-        return False
+                park = gym_by_id[0]['park']
+                recentlyseen.gym_parks.set(id, park)
+        return park
 
     @staticmethod
     def get_nearby_gyms(lat, lng, dist, teleport_ignore, raidless, maxpoints, geofence_name, scheduled_points, geofences, exraidonly, oldest_first, routing_outside_geofences):
@@ -1072,11 +1236,6 @@ class Gym(LatLongModel):
             else:
                 query = (query.where(Gym.last_scanned < datetime.utcnow() - timedelta(seconds=60)).dicts())
 
-            if len(scheduled_points) > 0:
-                query = (query
-                         .where(Gym.gym_id.not_in(scheduled_points))
-                         .dicts())
-
             if exraidonly:
                 query = (query
                          .where(Gym.is_ex_raid_eligible)
@@ -1084,12 +1243,18 @@ class Gym(LatLongModel):
 
             query = query.order_by(Gym.last_scanned.asc()).dicts()
 
+            limit = None
             if oldest_first and not isinstance(maxpoints, (bool)):
+                limit = maxpoints
+            if limit is not None and not scheduled_points:
                 query = (query
-                         .limit(maxpoints)
+                         .limit(limit)
                          .dicts())
 
-            queryDict = query.dicts()
+            # Claimed by other devices, excluded here rather than by a huge
+            # NOT IN.
+            queryDict = [g for g in query.dicts()
+                         if g['gym_id'] not in scheduled_points][:limit]
 
             gym_ids = []
             egg_todo = []
@@ -1119,11 +1284,15 @@ class Gym(LatLongModel):
             if len(queryDict) > 0 and geofences.is_enabled() and not routing_outside_geofences:
                 queryDict = geofences.get_geofenced_results(queryDict, geofence_name)
 
-            for g in queryDict:
+            queryDict = list(queryDict)
+            distances = haversine_distances(
+                lat, lng, [round(g['latitude'], 5) for g in queryDict],
+                [round(g['longitude'], 5) for g in queryDict])
+            for g, distance in zip(queryDict, distances):
                 key = g['gym_id']
                 latitude = round(g['latitude'], 5)
                 longitude = round(g['longitude'], 5)
-                distance = geopy.distance.vincenty((lat, lng), (latitude, longitude)).km
+                distance /= 1000
                 if g['gym_id'] in gym_ids and (dist == 0 or distance <= dist):
                     gyms[key] = {
                         'latitude': latitude,
@@ -1137,9 +1306,6 @@ class Gym(LatLongModel):
             else:
                 orderedgyms = OrderedDict(sorted(gyms.items(), key=lambda x: x[1]['distance']))
 
-            newlat = 0
-            newlong = 0
-
             maxlength = len(orderedgyms)
             if (not isinstance(raidless, (bool)) and maxlength > raidless):
                 maxlength = raidless
@@ -1150,16 +1316,11 @@ class Gym(LatLongModel):
             while len(orderedgyms) > maxlength:
                 orderedgyms.popitem()
 
-            result = []
-            while len(orderedgyms) > 0:
-                value = orderedgyms.items()[0][1]
-                orderedgyms.popitem(last=False)
-                if len(result) == 0 or geopy.distance.vincenty((newlat, newlong), (value['latitude'], value['longitude'])).km * 1000 > teleport_ignore:
-                    result.append((value['latitude'], value['longitude'], value['key']))
-                    newlat = value['latitude']
-                    newlong = value['longitude']
-                if not oldest_first:
-                    orderedgyms = OrderedDict(sorted(orderedgyms.items(), key=lambda x: geopy.distance.vincenty((newlat, newlong), (x[1]['latitude'], x[1]['longitude'])).km))
+            result = plan_route(
+                [(v['latitude'], v['longitude'], v['key'])
+                 for v in orderedgyms.values()],
+                lat, lng, min_hop_km=teleport_ignore / 1000.0,
+                keep_order=oldest_first, improve=args.route_two_opt)
 
         return result
 
@@ -1403,6 +1564,7 @@ class ScannedLocation(LatLongModel):
     fortradius = UBigIntegerField(default=450)
     monradius = UBigIntegerField(default=70)
     scanningforts = SmallIntegerField(default=0)
+    geocell = BigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -1468,6 +1630,7 @@ class ScannedLocation(LatLongModel):
         return {'cellid': cellid(loc),
                 'latitude': loc[0],
                 'longitude': loc[1],
+                'geocell': geocell(loc[0], loc[1]),
                 'done': False,
                 'band1': -1,
                 'band2': -1,
@@ -1875,6 +2038,7 @@ class SpawnPoint(LatLongModel):
     # Seconds after the hour of the earliest time Pokemon wasn't seen after an
     # appearance.
     earliest_unseen = SmallIntegerField()
+    geocell = BigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -1883,28 +2047,89 @@ class SpawnPoint(LatLongModel):
                        Check('latest_seen >= 0'),
                        Check('latest_seen <= 3600')]
 
+    # Returns a new spawnpoint dict, for IDs not in the database yet.
+    @staticmethod
+    def new_spawnpoint(id, latitude=0, longitude=0):
+        return {
+            'id': id,
+            'latitude': latitude,
+            'longitude': longitude,
+            'geocell': geocell(latitude, longitude),
+            'last_scanned': None,  # Null value used as new flag.
+            'kind': 'hhhs',
+            'links': '????',
+            'missed_count': 0,
+            'latest_seen': 0,
+            'earliest_unseen': 0
+        }
+
     # Returns the spawnpoint dict from ID, or a new dict if not found.
     @staticmethod
     def get_by_id(id, latitude=0, longitude=0):
+        result = SpawnPoint.get_by_ids([id])
+        if result:
+            return result.popitem()[1]
+        return SpawnPoint.new_spawnpoint(id, latitude, longitude)
+
+    # Returns a dict of spawnpoint dicts by ID for all IDs that exist.
+    # Cached spawnpoints are served from memory, the rest is fetched in
+    # as few queries as possible. Callers get their own copies.
+    @staticmethod
+    def get_by_ids(ids):
+        # Maximum number of variables to include in a single query.
+        step = 500
+        result = {}
+        missing = []
+
+        if spawnpoint_cache is not None:
+            with spawnpoint_cache_lock:
+                for id in set(ids):
+                    sp = spawnpoint_cache.get(id)
+                    if sp is None:
+                        missing.append(id)
+                    else:
+                        result[id] = sp.copy()
+        else:
+            missing = list(set(ids))
+
+        if not missing:
+            return result
+
+        found = []
         with SpawnPoint.database().execution_context():
-            query = (SpawnPoint
-                     .select()
-                     .where(SpawnPoint.id == id)
-                     .dicts())
+            for i in range(0, len(missing), step):
+                query = (SpawnPoint
+                         .select()
+                         .where(SpawnPoint.id << missing[i:i + step])
+                         .dicts())
+                found.extend(query)
+
+        SpawnPoint.update_cache(found)
+        for sp in found:
+            result[sp['id']] = sp
 
-            result = query[0] if query else {
-                'id': id,
-                'latitude': latitude,
-                'longitude': longitude,
-                'last_scanned': None,  # Null value used as new flag.
-                'kind': 'hhhs',
-                'links': '????',
-                'missed_count': 0,
-                'latest_seen': 0,
-                'earliest_unseen': 0
-            }
         return result
 
+    # Stores spawnpoint dicts as written to the database in the cache.
+    @staticmethod
+    def update_cache(spawnpoints):
+        if spawnpoint_cache is None:
+            return
+
+        with spawnpoint_cache_lock:
+            for sp in spawnpoints:
+                spawnpoint_cache[sp['id']] = sp.copy()
+
+    # Drops spawnpoints removed from the database from the cache.
+    @staticmethod
+    def remove_from_cache(ids):
+        if spawnpoint_cache is None:
+            return
+
+        with spawnpoint_cache_lock:
+            for id in ids:
+                spawnpoint_cache.pop(id, None)
+
     @staticmethod
     def get_spawnpoints(swLat, swLng, neLat, neLng, timestamp=0,
                         oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
@@ -2000,21 +2225,23 @@ class SpawnPoint(LatLongModel):
                                   (SpawnPoint.longitude <= maxlng))))
                          .dicts())
 
-            if len(scheduled_points) > 0:
-                query = (query
-                         .where(SpawnPoint.id.not_in(scheduled_points))
-                         .dicts())
-
-            queryDict = query.dicts()
+            # Claimed by other devices, excluded here rather than by a huge
+            # NOT IN.
+            queryDict = [sp for sp in query.dicts()
+                         if sp['id'] not in scheduled_points]
 
             if len(queryDict) > 0 and geofences.is_enabled() and not routing_outside_geofences:
                 queryDict = geofences.get_geofenced_results(queryDict, geofence_name)
 
-            for sp in queryDict:
+            queryDict = list(queryDict)
+            distances = haversine_distances(
+                lat, lng, [round(sp['latitude'], 5) for sp in queryDict],
+                [round(sp['longitude'], 5) for sp in queryDict])
+            for sp, distance in zip(queryDict, distances):
                 key = sp['id']
                 latitude = round(sp['latitude'], 5)
                 longitude = round(sp['longitude'], 5)
-                distance = geopy.distance.vincenty((lat, lng), (latitude, longitude)).km
+                distance /= 1000
                 if (not unknown_tth or SpawnPoint.tth_found(sp)) and (dist == 0 or distance <= dist):
                     spawnpoints[key] = {
                         'latitude': latitude,
@@ -2034,14 +2261,10 @@ class SpawnPoint(LatLongModel):
             while len(orderedspawnpoints) > maxlength:
                 orderedspawnpoints.popitem()
 
-            result = []
-            while len(orderedspawnpoints) > 0:
-                value = orderedspawnpoints.items()[0][1]
-                result.append((value['latitude'], value['longitude'], value['key']))
-                newlat = value['latitude']
-                newlong = value['longitude']
-                orderedspawnpoints.popitem(last=False)
-                orderedspawnpoints = OrderedDict(sorted(orderedspawnpoints.items(), key=lambda x: geopy.distance.vincenty((newlat, newlong), (x[1]['latitude'], x[1]['longitude'])).km))
+            result = plan_route(
+                [(v['latitude'], v['longitude'], v['key'])
+                 for v in orderedspawnpoints.values()],
+                lat, lng, improve=args.route_two_opt)
 
         return result
 
@@ -2482,6 +2705,30 @@ class PokestopMember(BaseModel):
         null=True, index=True, default=datetime.utcnow)
     distance = DoubleField()
 
+    # Returns the (encounter_id, pokestop_id) pairs of the given encounter
+    # ids that are still active. Only ids that weren't recently seen are
+    # looked up in the database.
+    @staticmethod
+    def get_encountered(encounter_ids, now_date):
+        known = recentlyseen.seen_nearby_pokemon.get_many(encounter_ids)
+        missing = [e for e in encounter_ids if e not in known]
+        if missing:
+            with PokestopMember.database().execution_context():
+                query = (PokestopMember
+                         .select(PokestopMember.encounter_id,
+                                 PokestopMember.pokestop_id,
+                                 PokestopMember.disappear_time)
+                         .where((PokestopMember.disappear_time >= now_date) &
+                                (PokestopMember.encounter_id << missing))
+                         .dicts())
+                for p in query:
+                    known[p['encounter_id']] = p['pokestop_id']
+                    recentlyseen.seen_nearby_pokemon.set(
+                        p['encounter_id'], p['pokestop_id'],
+                        p['disappear_time'])
+
+        return set(known.items())
+
 
 class GymPokemon(BaseModel):
     pokemon_uid = UBigIntegerField(primary_key=True)
@@ -2521,6 +2768,101 @@ class PokestopDetails(BaseModel):
     last_scanned = DateTimeField(default=datetime.utcnow)
 
 
+class FortDetailsCache(object):
+    """Names, descriptions and urls of forts by id.
+
+    Kept in a recentlyseen store and updated by the db updater when details
+    are upserted, so the map only reads details of forts it didn't show in
+    the last hour.
+    """
+
+    def __init__(self, model, store):
+        self.model = model
+        self.store = store
+        self.key = model._meta.primary_key
+
+    def entry(self, row):
+        return {
+            self.key.name: row[self.key.name],
+            'name': row.get('name'),
+            'description': row.get('description', ''),
+            'url': (row.get('url') or '').replace('http://', 'https://')
+        }
+
+    # Returns ({id: details or None} of the known ids, unknown ids).
+    def get_many(self, ids):
+        known = self.store.get_many(ids)
+        return known, [i for i in ids if i not in known]
+
+    def lookup(self, ids):
+        return (self.model
+                .select(self.key, self.model.name, self.model.description,
+                        self.model.url)
+                .where(self.key << ids)
+                .dicts())
+
+    # Remembers the rows found for the looked up ids, and that the other
+    # ids have no details. Returns {id: details or None} of the ids.
+    def add(self, ids, rows):
+        found = dict.fromkeys(ids)
+        for row in rows:
+            found[row[self.key.name]] = self.entry(row)
+        for key, details in found.iteritems():
+            self.store.set(key, details)
+        return found
+
+    # Copy of the details of a fort, None if there are none.
+    def get(self, id):
+        details = self.store.get(id, False)
+        if details is False:
+            details = self.add([id], self.lookup([id]))[id]
+        return dict(details) if details else None
+
+    def remember(self, rows):
+        for row in rows:
+            self.store.set(row[self.key.name], self.entry(row))
+
+
+gym_details_cache = FortDetailsCache(GymDetails, recentlyseen.gym_details)
+pokestop_details_cache = FortDetailsCache(PokestopDetails,
+                                          recentlyseen.pokestop_details)
+
+
+def lookup_chunk(task):
+    n, lookup, ids = task
+    return n, list(lookup(ids))
+
+
+def pooled_lookup_chunk(task):
+    with flaskDb.database.execution_context():
+        return lookup_chunk(task)
+
+
+# Runs (lookup, ids) pairs, where lookup takes a list of ids and returns
+# rows, and returns the rows of each. Ids are split into chunks so zoomed
+# out maps don't build huge IN (...) lists, and the chunks run in parallel
+# on their own pooled connections.
+def lookup_forts(*lookups):
+    size = args.db_lookup_chunk
+    tasks = [(n, lookup, ids[i:i + size])
+             for n, (lookup, ids) in enumerate(lookups)
+             for i in range(0, len(ids), size)]
+
+    global lookup_pool
+    if args.db_lookup_threads > 0 and len(tasks) > 1:
+        with lookup_pool_lock:
+            if lookup_pool is None:
+                lookup_pool = ThreadPool(args.db_lookup_threads)
+        results = lookup_pool.map(pooled_lookup_chunk, tasks)
+    else:
+        results = map(lookup_chunk, tasks)
+
+    rows = [[] for _ in lookups]
+    for n, result in results:
+        rows[n].extend(result)
+    return rows
+
+
 class Token(BaseModel):
     token = TextField()
     last_updated = DateTimeField(default=datetime.utcnow, index=True)
@@ -3151,6 +3493,7 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
 
     db_update_queue.put((ScannedLocation, {0: scan_location}))
 
+    add_geocells(pokemon, pokestops, gyms)
     if pokemon:
         db_update_queue.put((Pokemon, pokemon))
     if pokestops:
@@ -3432,28 +3775,51 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
              len(gym_members))
 
 
+# Kinds of map items pushed to map clients when a model is written.
+stream_kinds = {
+    Pokemon: 'pokemons',
+    Pokestop: 'pokestops',
+    Gym: 'gyms'
+}
+
+
 def db_updater(q, db):
     # The forever loop.
     while True:
         try:
             # Loop the queue.
             while True:
-                model, data = q.get()
+                batches = [q.get()]
 
-                start_timer = default_timer()
-                bulk_upsert(model, data, db)
-                q.task_done()
+                # Whatever else is already queued goes into the same
+                # transaction.
+                while len(batches) < 10:
+                    try:
+                        batches.append(q.get_nowait())
+                    except Empty:
+                        break
 
-                log.debug('Upserted to %s, %d records (upsert queue '
+                start_timer = default_timer()
+                bulk_upsert_many(batches, db)
+                for model, data in batches:
+                    if model is SpawnPoint:
+                        SpawnPoint.update_cache(data.values())
+                    elif model is Pokemon and active_pokemon is not None:
+                        active_pokemon.update(data.values())
+                    remember_upserted(model, data.values())
+                    if model in stream_kinds:
+                        map_stream.mark_changed(stream_kinds[model])
+                    q.task_done()
+
+                log.debug('Upserted %d records in %d batches (upsert queue '
                           'remaining: %d) in %.6f seconds.',
-                          model.__name__,
-                          len(data),
+                          sum(len(data) for model, data in batches),
+                          len(batches),
                           q.qsize(),
                           default_timer() - start_timer)
 
                 # Helping out the GC.
-                del model
-                del data
+                del batches
 
                 if q.qsize() > 50:
                     log.warning(
@@ -3465,6 +3831,135 @@ def db_updater(q, db):
             time.sleep(5)
 
 
+# Returns (quest_json, quest_text, reward_text) for the quest_json column
+# of a quest. The parsed dict is shared, callers mustn't modify it.
+def render_quest(quest_json):
+    if quest_json is None:
+        return None, '', ''
+
+    key = (quest_json, args.locale)
+    with quest_text_cache_lock:
+        rendered = quest_text_cache.get(key)
+    if rendered is None:
+        parsed = json.loads(quest_json)
+        rendered = (parsed, get_quest_quest_text(parsed),
+                    get_quest_reward_text(parsed))
+        with quest_text_cache_lock:
+            quest_text_cache[key] = rendered
+    return rendered
+
+
+# Keeps what was just written in the recently seen store, so parsing the
+# next posts doesn't have to ask the database about it.
+def remember_upserted(model, rows):
+    if model is Pokemon:
+        sightings = []
+        for row in rows:
+            if 'spawnpoint_id' not in row or 'disappear_time' not in row:
+                continue
+            if recentlyseen.seen_pokemon.set(
+                    long(row['encounter_id']), row['spawnpoint_id'],
+                    row['disappear_time']):
+                sightings.append(row)
+        spawn_counts.add(sightings)
+    elif model is PokestopMember:
+        for row in rows:
+            recentlyseen.seen_nearby_pokemon.set(
+                row['encounter_id'], row['pokestop_id'],
+                row['disappear_time'])
+    elif model is Pokestop:
+        for row in rows:
+            Pokestop.remember(row)
+    elif model is Gym:
+        for row in rows:
+            if 'park' in row:
+                recentlyseen.gym_parks.set(row['gym_id'], row['park'])
+    elif model is Quest:
+        # Render new quests once, before the map asks for them.
+        for row in rows:
+            render_quest(row.get('quest_json'))
+    elif model is PokestopDetails:
+        pokestop_details_cache.remember(rows)
+    elif model is GymDetails:
+        gym_details_cache.remember(rows)
+
+
+# Primary key field names of a model, or None if rows can't be merged
+# because the model has no key or the database assigns it.
+def upsert_key_fields(cls):
+    pk = cls._meta.primary_key
+    if isinstance(pk, CompositeKey):
+        return pk.field_names
+    if not pk or isinstance(pk, PrimaryKeyField):
+        return None
+    return (pk.name,)
+
+
+# Merges queued (model, data) updates by primary key before they reach the
+# db updaters, so bursts of small upserts become a few large ones. A model
+# is flushed once it has max_rows pending rows or its oldest pending row
+# waited max_wait seconds.
+def db_write_buffer(in_q, out_q, max_rows, max_wait):
+    pending = {}
+    started = {}
+
+    def flush(model):
+        rows = pending.pop(model)
+        del started[model]
+
+        # Rows with different fields get their own upsert, so no column
+        # is overwritten with a default.
+        batches = OrderedDict()
+        for row in rows.itervalues():
+            data = batches.setdefault(frozenset(row), {})
+            data[len(data)] = row
+        for data in batches.itervalues():
+            out_q.put((model, data))
+
+    while True:
+        try:
+            timeout = None
+            if started:
+                timeout = max(0, min(started.values()) + max_wait -
+                              default_timer())
+
+            try:
+                model, data = in_q.get(timeout=timeout)
+            except Empty:
+                model = None
+            else:
+                key_fields = upsert_key_fields(model)
+                if key_fields is None:
+                    out_q.put((model, data))
+                else:
+                    rows = pending.setdefault(model, OrderedDict())
+                    started.setdefault(model, default_timer())
+                    for row in data.itervalues():
+                        try:
+                            key = tuple(row[f] for f in key_fields)
+                        except KeyError:
+                            key = object()
+                        # Last write wins, field by field.
+                        if key in rows:
+                            merged = rows[key].copy()
+                            merged.update(row)
+                            row = merged
+                        rows[key] = row
+                in_q.task_done()
+
+            if model in pending and len(pending[model]) >= max_rows:
+                flush(model)
+
+            now_timer = default_timer()
+            for model in [m for m, t in started.items()
+                          if now_timer - t >= max_wait]:
+                flush(model)
+
+        except Exception as e:
+            log.exception('Exception in db_write_buffer: %s', repr(e))
+            time.sleep(5)
+
+
 def clean_db_loop(args):
     # Run regular database cleanup once every minute.
     regular_cleanup_secs = 60
@@ -3697,6 +4192,7 @@ def db_clean_spawnpoints(age_hours, missed=5):
                      .where((SpawnPoint.id <<
                              old_sp[i:min(i + step, num_records)])))
             num_rows += query.execute()
+        SpawnPoint.remove_from_cache(old_sp)
         log.debug('Deleted %d old SpawnPoint entries.', num_rows)
 
         sl_delete = list(sl_delete)
@@ -3757,54 +4253,65 @@ def db_clean_forts(age_hours):
               time_diff)
 
 
-def bulk_upsert(cls, data, db):
-    rows = data.values()
-    num_rows = len(rows)
-    i = 0
+# Upsert plans by (model, fields of the first row), see get_upsert_plan().
+upsert_plans = {}
+upsert_plans_lock = Lock()
 
-    # This shouldn't happen, ever, but anyways...
-    if num_rows < 1:
-        return
 
-    # We used to support SQLite and it has a default max 999 parameters,
-    # so we limited how many rows we insert for it.
-    # Oracle: 64000
-    # MySQL: 65535
-    # PostgreSQL: 34464
-    # Sqlite: 999
-    step = 500
+class UpsertPlan(object):
 
-    if db.is_closed():
-        log.debug("Database connection is closed, connect again")
-        db = MyRetryDB(
-            args.db_name,
-            user=args.db_user,
-            password=args.db_pass,
-            host=args.db_host,
-            port=args.db_port,
-            stale_timeout=30,
-            max_connections=None,
-            charset='utf8mb4')
+    def __init__(self, fields, query_string, defaults, filled):
+        self.fields = fields
+        self.query_string = query_string
+        self.defaults = defaults
+        # Fields that the first row didn't have, usually all rows lack them.
+        self.filled = [(f, defaults.get(f, None)) for f in filled]
+        self.getter = itemgetter(*fields)
 
-    # Prepare for our query.
-    conn = db.get_conn()
-    cursor = db.get_cursor()
+    # Convert a row to a tuple of values for executemany(), and fall back
+    # to defaults if necessary. Defaults are written back into the row.
+    def row_values(self, row):
+        for field, default in self.filled:
+            if field not in row:
+                # peewee's defaults can be callable, e.g. current time.
+                # We only call when needed to insert.
+                row[field] = default() if callable(default) else default
+
+        try:
+            values = self.getter(row)
+        except KeyError:
+            for field in self.fields:
+                if field not in row:
+                    default = self.defaults.get(field, None)
+                    row[field] = default() if callable(default) else default
+            values = self.getter(row)
+
+        if len(self.fields) == 1:
+            values = (values,)
+
+        return values
+
+
+def get_upsert_plan(cls, row, conn):
+    key = (cls, frozenset(row))
+    plan = upsert_plans.get(key)
+    if plan is not None:
+        return plan
 
     # We build our own INSERT INTO ... ON DUPLICATE KEY UPDATE x=VALUES(x)
     # query, making sure all data is properly escaped. We use
     # placeholders for VALUES(%s, %s, ...) so we can use executemany().
     # We use peewee's InsertQuery to retrieve the fields because it
     # takes care of peewee's internals (e.g. required default fields).
-    query = InsertQuery(cls, rows=[rows[0]])
+    query = InsertQuery(cls, rows=[row])
     # Take the first row. We need to call _iter_rows() for peewee internals.
     # Using next() for a single item is not considered "pythonic".
     first_row = {}
-    for row in query._iter_rows():
-        first_row = row
+    for first_row in query._iter_rows():
         break
     # Convert the row to its fields, sorted by peewee.
     row_fields = sorted(first_row.keys(), key=lambda x: x._sort_key)
-    row_fields = map(lambda x: x.name, row_fields)
+    row_fields = [x.name for x in row_fields]
     # Translate to proper column name, e.g. foreign keys.
     db_columns = [peewee_attr_to_col(cls, f) for f in row_fields]
 
@@ -3813,13 +4320,8 @@ def bulk_upsert(cls, data, db):
     defaults = {}
 
     for f in cls._meta.fields.values():
-        # Use DB column name as key.
-        field_name = f.name
-        field_default = cls._meta.defaults.get(f, None)
-        defaults[field_name] = field_default
+        defaults[f.name] = cls._meta.defaults.get(f, None)
 
-    # Assign fields, placeholders and assignments after defaults
-    # so our lists/keys stay in order.
     table = '`'+conn.escape_string(cls._meta.db_table)+'`'
     escaped_fields = ['`'+conn.escape_string(f)+'`' for f in db_columns]
     placeholders = ['%s' for escaped_field in escaped_fields]
@@ -3832,85 +4334,123 @@ def bulk_upsert(cls, data, db):
     # adding the new one, giving a serious performance hit.
     query_string = ('INSERT INTO {table} ({fields}) VALUES'
                     + ' ({placeholders}) ON DUPLICATE KEY UPDATE'
-                    + ' {assignments}')
+                    + ' {assignments}').format(
+                        table=table,
+                        fields=', '.join(escaped_fields),
+                        placeholders=', '.join(placeholders),
+                        assignments=', '.join(assignments))
 
-    # Prepare transaction.
-    with db.atomic():
-        while i < num_rows:
-            start = i
-            end = min(i + step, num_rows)
-            name = cls.__name__
+    filled = [f for f in row_fields if f not in row]
+    plan = UpsertPlan(row_fields, query_string, defaults, filled)
+    with upsert_plans_lock:
+        upsert_plans[key] = plan
 
-            log.debug('Inserting items %d to %d for %s.', start, end, name)
+    return plan
 
-            try:
-                # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
-                # unable to recognize strings to update unicode keys for
-                # foreign key fields, thus giving lots of foreign key
-                # constraint errors.
+
+def bulk_upsert(cls, data, db):
+    bulk_upsert_many([(cls, data)], db)
+
+
+# Upsert several (model, data) batches in a single transaction.
+def bulk_upsert_many(batches, db):
+    batches = [(cls, data) for cls, data in batches if data]
+
+    # This shouldn't happen, ever, but anyways...
+    if not batches:
+        return
+
+    # We used to support SQLite and it has a default max 999 parameters,
+    # so we limited how many rows we insert for it.
+    # Oracle: 64000
+    # MySQL: 65535
+    # PostgreSQL: 34464
+    # Sqlite: 999
+    step = 500
+
+    if db.is_closed():
+        log.debug("Database connection is closed, connect again")
+        db = MyRetryDB(
+            args.db_name,
+            user=args.db_user,
+            password=args.db_pass,
+            host=args.db_host,
+            port=args.db_port,
+            stale_timeout=30,
+            max_connections=None,
+            charset='utf8mb4')
+
+    # Rows are built with their geocell. Those that weren't, e.g. read from
+    # the database before it was filled in, get it here, outside of the
+    # transaction.
+    for cls, data in batches:
+        if 'geocell' in cls._meta.fields:
+            for row in data.itervalues():
+                if row.get('geocell') is None and 'latitude' in row:
+                    row['geocell'] = geocell(row['latitude'],
+                                             row['longitude'])
+
+    # A failed transaction is rolled back as a whole, so retrying has to
+    # start over with the first batch.
+    while True:
+        try:
+            # Prepare for our query.
+            conn = db.get_conn()
+            cursor = db.get_cursor()
+
+            # Prepare transaction.
+            with db.atomic():
+                # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently
+                # it's unable to recognize strings to update unicode keys
+                # for foreign key fields, thus giving lots of foreign key
+                # constraint errors. It's a session variable, so once per
+                # transaction is enough.
                 db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+                try:
+                    for cls, data in batches:
+                        upsert_rows(cls, data, conn, cursor, step)
+                finally:
+                    db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+            return
+        except Exception as e:
+            log.warning('%s... Retrying...', repr(e))
+            time.sleep(1)
 
-                # Time to bulk upsert our data. Convert objects to a list of
-                # values for executemany(), and fall back to defaults if
-                # necessary.
-                batch = []
-                batch_rows = rows[i:min(i + step, num_rows)]
-
-                # We pop them off one by one so we can gradually release
-                # memory as we pass each item. No duplicate memory usage.
-                while len(batch_rows) > 0:
-                    row = batch_rows.pop()
-                    row_data = []
-
-                    # Parse rows, build arrays of values sorted via row_fields.
-                    for field in row_fields:
-                        # Take a default if we need it.
-                        if field not in row:
-                            default = defaults.get(field, None)
-
-                            # peewee's defaults can be callable, e.g. current
-                            # time. We only call when needed to insert.
-                            if callable(default):
-                                default = default()
-
-                            row[field] = default
-
-                        # Append to keep the exact order, and only these
-                        # fields.
-                        row_data.append(row[field])
-                    # Done preparing, add it to the batch.
-                    batch.append(row_data)
-
-                # Format query and go.
-                formatted_query = query_string.format(
-                    table=table,
-                    fields=', '.join(escaped_fields),
-                    placeholders=', '.join(placeholders),
-                    assignments=', '.join(assignments)
-                )
-
-                cursor.executemany(formatted_query, batch)
-
-                db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
-
-            except Exception as e:
-                # If there is a DB table constraint error, dump the data and
-                # don't retry.
-                #
-                # Unrecoverable error strings:
-                unrecoverable = ['constraint', 'has no attribute',
-                                 'peewee.IntegerField object at']
-                has_unrecoverable = filter(
-                    lambda x: x in str(e), unrecoverable)
-                if has_unrecoverable:
-                    log.exception('%s. Data is:', repr(e))
-                    log.warning(data.items())
-                else:
-                    log.warning('%s... Retrying...', repr(e))
-                    time.sleep(1)
-                    continue
 
-            i += step
+def upsert_rows(cls, data, conn, cursor, step):
+    rows = data.values()
+    num_rows = len(rows)
+    name = cls.__name__
+    plan = get_upsert_plan(cls, rows[0], conn)
+    i = 0
+
+    while i < num_rows:
+        end = min(i + step, num_rows)
+
+        log.debug('Inserting items %d to %d for %s.', i, end, name)
+
+        try:
+            # Time to bulk upsert our data.
+            batch = [plan.row_values(row) for row in rows[i:end]]
+            cursor.executemany(plan.query_string, batch)
+            del batch
+
+        except Exception as e:
+            # If there is a DB table constraint error, dump the data and
+            # don't retry. Other errors are retried by bulk_upsert_many,
+            # with the whole transaction.
+            #
+            # Unrecoverable error strings:
+            unrecoverable = ['constraint', 'has no attribute',
+                             'peewee.IntegerField object at']
+            has_unrecoverable = filter(
+                lambda x: x in str(e), unrecoverable)
+            if not has_unrecoverable:
+                raise
+            log.exception('%s. Data is:', repr(e))
+            log.warning(data.items())
+
+        i += step
 
 
 def create_tables(db):
@@ -4009,6 +4549,26 @@ def verify_database_schema(db):
     db.close()
 
 
+# Fills in the geocell of existing rows, in chunks.
+def fill_geocells(model, where=None, step=5000):
+    log.info('Filling in geocells of table %s.', model._meta.db_table)
+    pk = model._meta.primary_key
+    query = (model
+             .select(pk, model.latitude, model.longitude)
+             .where(model.geocell.is_null()))
+    if where is not None:
+        query = query.where(where)
+    while True:
+        rows = list(query.limit(step).tuples())
+        if not rows:
+            break
+        cells = [(key, geocell(lat, lng)) for key, lat, lng in rows]
+        (model
+         .update(geocell=case(pk, cells))
+         .where(pk << [key for key, _ in cells])
+         .execute())
+
+
 def database_migrate(db, old_ver):
     # Update database schema version.
     Versions.update(val=db_schema_version).where(
@@ -4301,6 +4861,18 @@ def database_migrate(db, old_ver):
             migrator.add_column('deviceworker', 'requestedEndpoint', Utf8mb4CharField(max_length=100, default="")),
             migrator.add_column('deviceworker', 'pogoversion', Utf8mb4CharField(max_length=10, default=""))
         )
+    if old_ver < 63:
+        for model in (Pokemon, Pokestop, Gym, SpawnPoint, ScannedLocation):
+            table = model._meta.db_table
+            migrate(
+                migrator.add_column(table, 'geocell',
+                                    BigIntegerField(null=True)),
+                migrator.add_index(table, ('geocell',), False)
+            )
+        # Expired Pokemon are never shown on the map again.
+        fill_geocells(Pokemon, Pokemon.disappear_time > datetime.utcnow())
+        for model in (Pokestop, Gym, SpawnPoint, ScannedLocation):
+            fill_geocells(model)
 
     # Always log that we're done.
     log.info('Schema upgrade complete.')
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+
+from datetime import datetime, timedelta
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class ExpiringStore(object):
+    """Values kept in memory until their own expiry time.
+
+    Used to remember what was recently written to the database, so parsing
+    a device post doesn't have to ask the database whether it already knows
+    about each Pokemon and fort. Once maxsize is reached, the entries that
+    expire first are dropped.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = {}
+        self.expiry = []
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        now_date = datetime.utcnow()
+        with self.lock:
+            entry = self.data.get(key)
+        if entry is None or entry[1] <= now_date:
+            return default
+        return entry[0]
+
+    # Returns a dict with the keys that are known and not expired.
+    def get_many(self, keys):
+        now_date = datetime.utcnow()
+        result = {}
+        with self.lock:
+            for key in keys:
+                entry = self.data.get(key)
+                if entry is not None and entry[1] > now_date:
+                    result[key] = entry[0]
+        return result
+
+    # Returns True if the key wasn't known yet.
+    def set(self, key, value, expires=None):
+        now_date = datetime.utcnow()
+        if expires is None:
+            expires = now_date + self.ttl
+        if expires <= now_date:
+            return False
+
+        with self.lock:
+            old = self.data.get(key)
+            self.data[key] = (value, expires)
+            # Updated keys leave their old heap entry behind, which is
+            # skipped when popped.
+            if old is None or old[1] != expires:
+                heapq.heappush(self.expiry, (expires, key))
+            self._evict(now_date)
+        return old is None or old[1] <= now_date
+
+    def _evict(self, now_date):
+        while self.expiry and (self.expiry[0][0] <= now_date or
+                               len(self.data) > self.maxsize):
+            expires, key = heapq.heappop(self.expiry)
+            entry = self.data.get(key)
+            if entry is not None and entry[1] == expires:
+                del self.data[key]
+
+        # Keys set over and over pile up stale heap entries, rebuild.
+        if len(self.expiry) > 2 * len(self.data) + 1000:
+            self.expiry = [(value[1], k)
+                           for k, value in self.data.iteritems()]
+            heapq.heapify(self.expiry)
+
+
+# Forts rarely change, so their entries live for a fixed time.
+FORT_TTL = timedelta(hours=1)
+
+# Encounter id -> spawnpoint id of active Pokemon, until they disappear.
+seen_pokemon = ExpiringStore(200000)
+# Encounter id -> pokestop id of nearby Pokemon, until they disappear.
+seen_nearby_pokemon = ExpiringStore(200000)
+# Pokestop id -> last_modified in epoch seconds.
+pokestop_last_modified = ExpiringStore(100000, FORT_TTL)
+# Pokestop id -> (latitude, longitude).
+pokestop_locations = ExpiringStore(100000, FORT_TTL)
+# Pokestop id -> details dict, or None if there are none.
+pokestop_details = ExpiringStore(100000, FORT_TTL)
+# Gym id -> details dict, or None if there are none.
+gym_details = ExpiringStore(100000, FORT_TTL)
+# Gym id -> park flag.
+gym_parks = ExpiringStore(100000, FORT_TTL)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from threading import Event, Lock
+
+from .transform import haversine_distance
+
+log = logging.getLogger(__name__)
+
+
+class RouteCache(object):
+    """Routes through a whole geofence, shared by the devices that walk or
+    teleport through it with the same parameters.
+
+    Keys are tuples starting with the route kind, e.g. ('walk_pokestop',
+    geofence, questless, ...). A route is computed by the first request for
+    its key, and recomputed in the background by route_cache_refresher()
+    once it has been invalidated by new forts, quests or raids. Only one
+    thread computes a key at a time, the others wait for its route or keep
+    using the stale one.
+    """
+
+    def __init__(self, refresh_interval=60, member_timeout=300):
+        self.refresh_interval = refresh_interval
+        self.member_timeout = member_timeout
+        self.routes = {}
+        self.members = {}
+        self.known_forts = {}
+        # Key -> Event set when the route being computed is stored.
+        self.computing = {}
+        self.lock = Lock()
+
+    def get_route(self, key, uuid, latitude, longitude, compute,
+                  no_overlap=False, limit=None):
+        now_time = time.time()
+        with self.lock:
+            self.members.setdefault(key, {})[uuid] = now_time
+            entry = self.routes.get(key)
+
+        # Nobody computed this route yet, or the refresher fell behind.
+        if entry is None or (entry['stale'] and now_time - entry['computed'] >
+                             2 * self.refresh_interval):
+            entry = self._compute(key, compute, entry)
+
+        if entry is None or not entry['route']:
+            return []
+        route = entry['route']
+
+        if no_overlap:
+            # Every device sharing the route gets its own part of it.
+            with self.lock:
+                uuids = sorted(u for u, seen in self.members[key].items()
+                               if now_time - seen < self.member_timeout)
+            index = uuids.index(uuid)
+            start = len(route) * index // len(uuids)
+            end = len(route) * (index + 1) // len(uuids)
+            route = route[start:end]
+            if route and (self._distance(latitude, longitude, route[-1]) <
+                          self._distance(latitude, longitude, route[0])):
+                route = route[::-1]
+        else:
+            # Start at the closest point and go round.
+            closest = min(range(len(route)), key=lambda i: self._distance(
+                latitude, longitude, route[i]))
+            route = route[closest:] + route[:closest]
+
+        if limit is not None:
+            route = route[:limit]
+
+        return list(route)
+
+    def invalidate(self, kind):
+        with self.lock:
+            for key, entry in self.routes.items():
+                if key[0] == kind:
+                    entry['stale'] = True
+
+    # Invalidates the routes of a kind when one of the fort ids wasn't seen
+    # before.
+    def note_forts(self, kind, fort_ids):
+        with self.lock:
+            known = self.known_forts.setdefault(kind, set())
+            new = [f for f in fort_ids if f not in known]
+            if not new:
+                return
+            known.update(new)
+        self.invalidate(kind)
+
+    # Recomputes stale routes, at most once per refresh interval each, and
+    # forgets routes no device asked for in a while.
+    def refresh(self):
+        now_time = time.time()
+        with self.lock:
+            for key in self.routes.keys():
+                seen = self.members.get(key, {}).values()
+                if not seen or now_time - max(seen) > self.member_timeout:
+                    del self.routes[key]
+                    self.members.pop(key, None)
+            due = [(key, entry) for key, entry in self.routes.items()
+                   if entry['stale'] and
+                   now_time - entry['computed'] >= self.refresh_interval]
+
+        for key, entry in due:
+            self._compute(key, entry['compute'], entry)
+
+    # Computes the route of a key, unless another thread already does. Then
+    # returns the stale entry if there is one, or waits for the new one.
+    def _compute(self, key, compute, stale=None):
+        with self.lock:
+            done = self.computing.get(key)
+            if done is None:
+                done = self.computing[key] = Event()
+                computing = True
+            else:
+                computing = False
+
+        if not computing:
+            if stale is not None:
+                return stale
+            done.wait()
+            with self.lock:
+                return self.routes.get(key)
+
+        try:
+            start = time.time()
+            entry = {
+                'route': compute(),
+                'computed': start,
+                'stale': False,
+                'compute': compute
+            }
+            with self.lock:
+                self.routes[key] = entry
+            log.debug('Computed %d point route for %s in %.2fs.',
+                      len(entry['route']), key, time.time() - start)
+            return entry
+        finally:
+            with self.lock:
+                del self.computing[key]
+            done.set()
+
+    @staticmethod
+    def _distance(latitude, longitude, point):
+        return haversine_distance(latitude, longitude, point[0], point[1])
+
+
+def route_cache_refresher(route_cache):
+    while True:
+        try:
+            route_cache.refresh()
+        except Exception as e:
+            log.exception('Exception in route_cache_refresher: %s', repr(e))
+        time.sleep(5)
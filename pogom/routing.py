@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+
+from .transform import EARTH_RADIUS_M, haversine_distance
+
+log = logging.getLogger(__name__)
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180 / 1000
+
+
+class PointGrid(object):
+    """Points projected to km around a reference latitude and bucketed on a
+    uniform grid, for nearest neighbour lookups that shrink as points are
+    removed."""
+
+    def __init__(self, points, ref_lat):
+        self.lng_scale = KM_PER_DEGREE * math.cos(math.radians(ref_lat))
+        self.xy = [self.project(p[0], p[1]) for p in points]
+        self.remaining = set(range(len(points)))
+
+        # Aim for a couple of points per cell.
+        if self.xy:
+            xs = [x for x, y in self.xy]
+            ys = [y for x, y in self.xy]
+            area = max(max(xs) - min(xs), 0.01) * max(max(ys) - min(ys), 0.01)
+            self.cell_size = max(math.sqrt(2 * area / len(self.xy)), 0.01)
+        else:
+            self.cell_size = 1.0
+
+        self.cells = {}
+        for i, xy in enumerate(self.xy):
+            self.cells.setdefault(self._cell(xy), set()).add(i)
+
+    def __len__(self):
+        return len(self.remaining)
+
+    def project(self, lat, lng):
+        return (lng * self.lng_scale, lat * KM_PER_DEGREE)
+
+    def _cell(self, xy):
+        return (int(math.floor(xy[0] / self.cell_size)),
+                int(math.floor(xy[1] / self.cell_size)))
+
+    def remove(self, i):
+        self.remaining.discard(i)
+        cell = self._cell(self.xy[i])
+        members = self.cells[cell]
+        members.discard(i)
+        if not members:
+            del self.cells[cell]
+
+    def distance(self, xy, i):
+        x, y = self.xy[i]
+        return math.hypot(x - xy[0], y - xy[1])
+
+    # Returns the indices of the k nearest remaining points, closest first.
+    def nearest(self, xy, k=1, exclude=None):
+        cx, cy = self._cell(xy)
+        found = []
+        ring = 0
+        while True:
+            # Few points spread over many cells, scanning them is cheaper.
+            if (2 * ring + 1) ** 2 > 4 * len(self.cells):
+                found = [(self.distance(xy, i), i) for i in self.remaining
+                         if i != exclude]
+                break
+
+            if ring == 0:
+                ring_cells = [(cx, cy)]
+            else:
+                edge = range(-ring, ring + 1)
+                ring_cells = ([(cx + dx, cy + d) for dx in edge
+                               for d in (-ring, ring)] +
+                              [(cx + d, cy + dy) for d in (-ring, ring)
+                               for dy in edge[1:-1]])
+            for cell in ring_cells:
+                for i in self.cells.get(cell, ()):
+                    if i != exclude:
+                        found.append((self.distance(xy, i), i))
+
+            # Points in further rings are at least ring * cell_size away.
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= ring * self.cell_size:
+                    break
+            ring += 1
+
+        found.sort()
+        return [i for d, i in found[:k]]
+
+
+# Orders points (lat, lng, key) by repeatedly visiting the closest remaining
+# point, starting from (lat, lng). Points closer than min_hop_km to the last
+# visited point are dropped.
+def nearest_neighbour_route(points, lat, lng, min_hop_km=0):
+    grid = PointGrid(points, lat)
+    position = grid.project(lat, lng)
+    route = []
+    while len(grid):
+        i = grid.nearest(position)[0]
+        grid.remove(i)
+        if route and min_hop_km and grid.distance(position, i) <= min_hop_km:
+            continue
+        route.append(points[i])
+        position = grid.xy[i]
+
+    return route
+
+
+# Improves an open route from (lat, lng) by reversing segments while that
+# shortens it. Only moves towards the k nearest neighbours of each point are
+# tried, so a pass is O(n * k) distance evaluations plus the reversals.
+def two_opt(route, lat, lng, neighbours=8, max_passes=5):
+    if len(route) < 3:
+        return route
+
+    grid = PointGrid(route, lat)
+    xy = [grid.project(lat, lng)] + grid.xy
+    nodes = list(range(len(xy)))
+    # Node 0 is the start, node i + 1 is route[i].
+    candidates = [[]]
+    for i in range(len(route)):
+        candidates.append([j + 1 for j in grid.nearest(
+            grid.xy[i], neighbours, exclude=i)])
+
+    def d(a, b):
+        return math.hypot(xy[a][0] - xy[b][0], xy[a][1] - xy[b][1])
+
+    for _ in range(max_passes):
+        improved = False
+        position = {node: n for n, node in enumerate(nodes)}
+        for n in range(len(nodes) - 1):
+            a, b = nodes[n], nodes[n + 1]
+            for c in candidates[a]:
+                m = position[c]
+                if m <= n + 1:
+                    continue
+                # Connect a-c and b-d, d is None past the end of the route.
+                d_node = nodes[m + 1] if m + 1 < len(nodes) else None
+                delta = d(a, c) - d(a, b)
+                if d_node is not None:
+                    delta += d(b, d_node) - d(c, d_node)
+                if delta < -1e-9:
+                    nodes[n + 1:m + 1] = nodes[n + 1:m + 1][::-1]
+                    for p in range(n + 1, m + 1):
+                        position[nodes[p]] = p
+                    improved = True
+                    break
+        if not improved:
+            break
+
+    return [route[node - 1] for node in nodes[1:]]
+
+
+# Builds the route for a device at (lat, lng) through points, a list of
+# (lat, lng, key). With keep_order the given order is kept and only the
+# min_hop_km filter applies.
+def plan_route(points, lat, lng, min_hop_km=0, keep_order=False,
+               improve=False):
+    if keep_order:
+        route = []
+        for p in points:
+            if (not route or not min_hop_km or
+                    haversine_distance(route[-1][0], route[-1][1],
+                                       p[0], p[1]) > min_hop_km * 1000):
+                route.append(p)
+        return route
+
+    route = nearest_neighbour_route(points, lat, lng, min_hop_km)
+    if improve:
+        route = two_opt(route, lat, lng)
+
+    return route
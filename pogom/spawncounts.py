@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def hour_bucket(date):
+    return int((date - EPOCH).total_seconds() // 3600)
+
+
+class SpawnCounts(object):
+    """Pokemon sightings counted per hour of their disappear_time.
+
+    Loaded once from the database by Pokemon.get_spawn_counts() and then
+    kept up to date with new sightings, so dynamic rarity doesn't need a
+    GROUP BY over the whole pokemon table on every refresh. Windows are
+    rounded to whole hours.
+    """
+
+    def __init__(self):
+        # Hour since the epoch -> {pokemon_id: count}.
+        self.buckets = {}
+        # First hour loaded from the database, 0 for everything, None if
+        # nothing was loaded yet.
+        self.loaded_since = None
+        self.lock = Lock()
+
+    # Whether the counts since the given hour (None for everything) are
+    # available without reading the database.
+    def covers(self, since):
+        with self.lock:
+            if self.loaded_since is None:
+                return False
+            return self.loaded_since == 0 or (since is not None and
+                                              since >= self.loaded_since)
+
+    # Replaces the counts with rows of (hour, pokemon_id, count).
+    def load(self, rows, since):
+        buckets = {}
+        for hour, pokemon_id, count in rows:
+            bucket = buckets.setdefault(int(hour), {})
+            bucket[pokemon_id] = bucket.get(pokemon_id, 0) + count
+        with self.lock:
+            self.buckets = buckets
+            self.loaded_since = since or 0
+
+    # Counts new sightings, rows are upserted pokemon dicts.
+    def add(self, rows):
+        with self.lock:
+            if self.loaded_since is None:
+                return
+            for row in rows:
+                bucket = self.buckets.setdefault(
+                    hour_bucket(row['disappear_time']), {})
+                bucket[row['pokemon_id']] = bucket.get(
+                    row['pokemon_id'], 0) + 1
+
+    # Returns ({pokemon_id: count}, total) since the given hour, None for
+    # everything. Older hours are dropped, they aren't asked for again.
+    def get(self, since):
+        counts = {}
+        with self.lock:
+            if since is not None:
+                for hour in [h for h in self.buckets if h < since]:
+                    del self.buckets[hour]
+                self.loaded_since = max(self.loaded_since, since)
+            for bucket in self.buckets.values():
+                for pokemon_id, count in bucket.items():
+                    counts[pokemon_id] = counts.get(pokemon_id, 0) + count
+        return counts, sum(counts.values())
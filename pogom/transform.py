@@ -1,8 +1,15 @@
+import sys
 import math
 import geopy
 import geopy.distance
 import random
 
+# NumPy is optional, haversine_distances() loops without it.
+try:
+    import numpy as np
+except ImportError:
+    pass
+
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
@@ -229,3 +236,41 @@ def intermediate_point(pos1, pos2, fraction):
 
     return (((math.degrees(lat3) + 540) % 360) - 180,
             ((math.degrees(lon3) + 540) % 360) - 180)
+
+
+# IUGG mean earth radius in meters.
+EARTH_RADIUS_M = 6371008.8
+
+
+# Great-circle distance in meters. Within 0.6% of Vincenty anywhere, and a
+# couple of orders of magnitude faster.
+def haversine_distance(lat1, lng1, lat2, lng2):
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) *
+         math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Flat earth approximation in meters, good enough for the few km between a
+# device and what it sees.
+def equirectangular_distance(lat1, lng1, lat2, lng2):
+    x = math.radians(lng2 - lng1) * math.cos(math.radians(lat1 + lat2) / 2)
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_M * math.sqrt(x * x + y * y)
+
+
+# Haversine distances in meters from one location to many, as a list.
+def haversine_distances(lat, lng, lats, lngs):
+    if 'numpy' not in sys.modules:
+        return [haversine_distance(lat, lng, lat2, lng2)
+                for lat2, lng2 in zip(lats, lngs)]
+
+    lat1 = math.radians(lat)
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    dlng = np.radians(np.asarray(lngs, dtype=float) - lng)
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2)
+    return (2 * EARTH_RADIUS_M *
+            np.arcsin(np.sqrt(np.minimum(a, 1.0)))).tolist()
@@ -14,6 +14,7 @@ import psutil
 import subprocess
 import requests
 import configargparse
+import threading
 from datetime import datetime
 
 from s2sphere import CellId, LatLng
@@ -304,6 +305,38 @@ def get_args():
     parser.add_argument('-tig', '--teleport-ignore',
                         help=('Ignore coordinates inside this radius for teleport scheduling'),
                         type=int, default=300)
+    parser.add_argument('-r2o', '--route-two-opt',
+                        help=('Shorten teleport routes with a 2-opt pass ' +
+                              'after nearest neighbour ordering'),
+                        action='store_true', default=False)
+    parser.add_argument('-rcr', '--route-cache-refresh',
+                        help=('Seconds between recomputing the routes ' +
+                              'shared by devices fetching a whole geofence, ' +
+                              '0 to disable sharing'),
+                        type=int, default=60)
+    parser.add_argument('-ipr', '--ingest-processes',
+                        help=('Number of processes parsing the posts of ' +
+                              'devices, 0 to parse them in the web server ' +
+                              'process'),
+                        type=int, default=0)
+    parser.add_argument('-fet', '--feed-etag',
+                        help=('Send the text feeds whole with an ETag, so ' +
+                              'clients polling an unchanged feed get a 304, ' +
+                              'instead of streaming them'),
+                        action='store_true', default=False)
+    parser.add_argument('-ia', '--ingest-async',
+                        help=('Acknowledge device posts right away and ' +
+                              'parse them in the background, uses at least ' +
+                              'one ingest process'),
+                        action='store_true', default=False)
+    parser.add_argument('-iqs', '--ingest-queue-size',
+                        help=('Posts waiting per ingest process before new ' +
+                              'posts wait or push out the oldest'),
+                        type=int, default=100)
+    parser.add_argument('-ido', '--ingest-drop-oldest',
+                        help=('Drop the oldest waiting post when an ingest ' +
+                              'queue is full, instead of waiting'),
+                        action='store_true', default=False)
     parser.add_argument('-s', '--speed',
                         help=('Speed in km/h for walking endpoints'),
                         type=int, default=10)
@@ -357,6 +390,43 @@ def get_args():
               'queue falls behind.'),
         type=int,
         default=1)
+    group.add_argument(
+        '--db-flush-ms',
+        help=('Merge queued db updates per model and write them at ' +
+              'least every this many milliseconds. 0 to disable.'),
+        type=int,
+        default=250)
+    group.add_argument(
+        '--db-flush-rows',
+        help=('Write merged db updates of a model as soon as this ' +
+              'many rows are pending.'),
+        type=int,
+        default=2000)
+    group.add_argument(
+        '--db-lookup-threads',
+        help=('Number of threads that look up the Pokemon, details, ' +
+              'raids and quests of the forts on the map in parallel. ' +
+              '0 to look them up in the request thread.'),
+        type=int,
+        default=3)
+    group.add_argument(
+        '--db-lookup-chunk',
+        help=('Maximum number of fort ids per lookup query.'),
+        type=int,
+        default=1000)
+    group.add_argument(
+        '--spawnpoint-cache-size',
+        help=('Number of spawnpoints kept in memory to avoid a db ' +
+              'lookup per sighting. 0 to disable.'),
+        type=int,
+        default=50000)
+    group.add_argument(
+        '--no-pokemon-index',
+        help=('Query active Pokemon from the db instead of keeping them ' +
+              'in memory. The in memory index only sees Pokemon written ' +
+              'by this process, so use this when other processes write ' +
+              'Pokemon to the same db. Implied by --map-only.'),
+        action='store_true', default=False)
     group = parser.add_argument_group('Database Cleanup')
     group.add_argument('-DC', '--db-cleanup',
                        help='Enable regular database cleanup thread.',
@@ -565,9 +635,19 @@ def get_args():
                        default=[], action='append')
     group.add_argument('-UAri', '--user-auth-role-invite', default=None,
                        help='Invitation link for the required role.')
+    parser.add_argument('-mst', '--map-stream',
+                        help=('Push new and changed Pokemon, Pokestops and ' +
+                              'Gyms to map clients over Server-Sent ' +
+                              'Events instead of having them poll.'),
+                        action='store_true', default=False)
     parser.add_argument('-gen', '--generate-images',
                         help='Use ImageMagick to generate gym images on demand.',
                         action='store_true', default=False)
+    parser.add_argument('-genp', '--generate-images-prerender',
+                        help=('Render the images of all gyms without a ' +
+                              'raid boss at startup, in this many ' +
+                              'threads. Requires -gen. 0 to disable.'),
+                        type=int, default=0)
     parser.set_defaults(DEBUG=False)
 
     args = parser.parse_args()
@@ -1683,15 +1763,6 @@ def get_debug_dump_link():
     return upload_to_hastebin(result)
 
 
-def point_is_scheduled(key, scheduled_points):
-    found = False
-    for point in scheduled_points:
-        if key == point[2]:
-            found = True
-            break
-    return found
-
-
 def get_pokemon_rarity(total_spawns_all, total_spawns_pokemon):
     spawn_group = 'Common'
 
@@ -1784,6 +1855,64 @@ def device_worker_refresher(db_update_queue, wh_update_queue, args):
         time.sleep(refresh_time_sec)
 
 
+class RarityTable(object):
+    """Rarity names by Pokemon id, kept in memory.
+
+    dynamic_rarity_refresher() updates the table directly. Processes that
+    don't run the refresher pick up its rarity.json when the file's mtime
+    changes, checked at most every check_interval seconds.
+    """
+
+    def __init__(self, check_interval=10):
+        self.check_interval = check_interval
+        self.rarities = {}
+        self.mtime = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def path():
+        return os.path.join(get_args().root_path,
+                            'static/dist/data/rarity.json')
+
+    def get(self, pokemon_id):
+        self.reload_if_changed()
+        return self.rarities.get(str(pokemon_id), 'New Spawn')
+
+    # Stores new rarities and writes them to rarity.json for the front-end
+    # and other processes.
+    def update(self, rarities):
+        rarities = {str(k): v for k, v in rarities.items()}
+        path = self.path()
+        with self.lock:
+            with open(path, 'w') as outfile:
+                json.dump(rarities, outfile)
+            self.rarities = rarities
+            self.mtime = os.path.getmtime(path)
+
+    def reload_if_changed(self):
+        now_time = default_timer()
+        if (self.checked is not None and
+                now_time - self.checked < self.check_interval):
+            return
+
+        with self.lock:
+            self.checked = now_time
+            path = self.path()
+            try:
+                mtime = os.path.getmtime(path)
+                if mtime == self.mtime:
+                    return
+                with open(path) as f:
+                    self.rarities = json.load(f)
+                self.mtime = mtime
+            except (IOError, OSError, ValueError) as e:
+                log.warning('Unable to load %s: %s', path, e)
+
+
+rarity_table = RarityTable()
+
+
 def dynamic_rarity_refresher():
     # If we import at the top, pogom.models will import pogom.utils,
     # causing the cyclic import to make some things unavailable.
@@ -1792,9 +1921,6 @@ def dynamic_rarity_refresher():
     # Refresh every x hours.
     args = get_args()
     hours = args.rarity_hours
-    root_path = args.root_path
-
-    rarities_path = os.path.join(root_path, 'static/dist/data/rarity.json')
     update_frequency_mins = args.rarity_update_frequency
     refresh_time_sec = update_frequency_mins * 60
 
@@ -1813,9 +1939,8 @@ def dynamic_rarity_refresher():
             rarities[poke['pokemon_id']] = get_pokemon_rarity(total,
                                                               poke['count'])
 
-        # Save to file.
-        with open(rarities_path, 'w') as outfile:
-            json.dump(rarities, outfile)
+        # Save to memory and file.
+        rarity_table.update(rarities)
 
         duration = default_timer() - start
         log.info('Updated dynamic rarity. It took %.2fs for %d entries.',
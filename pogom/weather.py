@@ -1,10 +1,28 @@
 import logging
+import math
 import s2sphere
 
+from cachetools import LRUCache
+from threading import Lock
+
 from pogom.models import Weather
 
 log = logging.getLogger(__name__)
 
+# Weather cells are level 10, about 10km across.
+WEATHER_LEVEL = 10
+# Viewports are widened to a grid of this many degrees before covering, so
+# nearby viewports share a covering.
+COVERING_GRID = 0.05
+
+# Rendered geometry by cell id. Cells never change, so this only needs to
+# hold the cells of the area that is scanned. cachetools isn't thread safe.
+cell_geometry_cache = LRUCache(maxsize=20000)
+cell_geometry_lock = Lock()
+# Cell ids covering a viewport, by its widened bounds.
+covering_cache = LRUCache(maxsize=2000)
+covering_lock = Lock()
+
 def get_weather_cells(swLat, swLng, neLat, neLng):
     return get_weather_cels(Weather.get_weather_by_location(swLat, swLng, neLat, neLng, False))
 
@@ -15,14 +33,8 @@ def get_weather_alerts(swLat, swLng, neLat, neLng):
 
 def get_weather_cels(db_weathers):
     for i in range(0, len(db_weathers)):
-        cell = get_cell_from_string(db_weathers[i]['s2_cell_id'])
-        center = s2sphere.LatLng.from_point(cell.get_center())
-        db_weathers[i]['center'] = {
-            'lat': center.lat().degrees,
-            'lng': center.lng().degrees
-        }
-        db_weathers[i]['vertices'] = get_vertices_from_s2cell(cell)
-        db_weathers[i]['s2_cell_id'] = str(cell.id().id())
+        geometry = get_cell_geometry(db_weathers[i]['s2_cell_id'])
+        db_weathers[i].update(geometry)
 
     return db_weathers
 
@@ -37,33 +49,56 @@ def get_cell_from_string(str_id):
         return s2sphere.Cell(s2sphere.CellId(raw_id))
 
 
-def get_s2_coverage(swLat, swLng, neLat, neLng):
-    geoms = []
-
-    r = s2sphere.RegionCoverer()
-    r.min_level = 10
-    r.max_level = 10
-    r.max_cells = 40
-    p1 = s2sphere.LatLng.from_degrees(float(swLat), float(swLng))
-    p2 = s2sphere.LatLng.from_degrees(float(neLat), float(neLng))
-    covering = r.get_covering(s2sphere.LatLngRect.from_point_pair(p1, p2))
-    for cell_id in covering:
-        cell_to_render = {}
-        rect_bound = s2sphere.Cell(cell_id)
-        center = s2sphere.LatLng.from_point(rect_bound.get_center())
-        cell_to_render['s2_cell_id'] = str(cell_id.id())
-        cell_to_render['center'] = {
-            'lat': center.lat().degrees,
-            'lng': center.lng().degrees
+# Returns {'s2_cell_id', 'center', 'vertices'} of a cell id, as a string
+# or number. The nested dicts are shared, don't modify them.
+def get_cell_geometry(cell_id):
+    with cell_geometry_lock:
+        geometry = cell_geometry_cache.get(cell_id)
+    if geometry is None:
+        cell = get_cell_from_string(cell_id)
+        center = s2sphere.LatLng.from_point(cell.get_center())
+        geometry = {
+            's2_cell_id': str(cell.id().id()),
+            'center': {
+                'lat': center.lat().degrees,
+                'lng': center.lng().degrees
+            },
+            'vertices': get_vertices_from_s2cell(cell)
         }
-        cell_to_render['vertices'] = get_vertices_from_s2cell(rect_bound)
+        with cell_geometry_lock:
+            cell_geometry_cache[cell_id] = geometry
+    return dict(geometry)
+
+
+# Cell ids of the weather cells covering a viewport. The viewport is
+# widened to the covering grid first, which adds at most a row or column
+# of cells around it.
+def get_covering(swLat, swLng, neLat, neLng):
+    key = (int(math.floor(float(swLat) / COVERING_GRID)),
+           int(math.floor(float(swLng) / COVERING_GRID)),
+           int(math.ceil(float(neLat) / COVERING_GRID)),
+           int(math.ceil(float(neLng) / COVERING_GRID)))
+    with covering_lock:
+        cell_ids = covering_cache.get(key)
+    if cell_ids is None:
+        r = s2sphere.RegionCoverer()
+        r.min_level = WEATHER_LEVEL
+        r.max_level = WEATHER_LEVEL
+        r.max_cells = 40
+        p1 = s2sphere.LatLng.from_degrees(key[0] * COVERING_GRID,
+                                          key[1] * COVERING_GRID)
+        p2 = s2sphere.LatLng.from_degrees(key[2] * COVERING_GRID,
+                                          key[3] * COVERING_GRID)
+        covering = r.get_covering(s2sphere.LatLngRect.from_point_pair(p1, p2))
+        cell_ids = tuple(cell_id.id() for cell_id in covering)
+        with covering_lock:
+            covering_cache[key] = cell_ids
+    return cell_ids
 
-        # log.info(rect_bound.approx_area())
 
-        del rect_bound
-        geoms.append(cell_to_render)
-
-    return geoms
+def get_s2_coverage(swLat, swLng, neLat, neLng):
+    return [get_cell_geometry(cell_id)
+            for cell_id in get_covering(swLat, swLng, neLat, neLng)]
 
 
 # convert s2cell vertices to google map api format
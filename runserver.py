@@ -22,9 +22,14 @@ from pogom.utils import (get_args, now, log_resource_usage_loop, get_debug_dump_
 from pogom.altitude import get_gmaps_altitude
 
 from pogom.models import (init_database, create_tables, drop_tables,
-                          db_updater, clean_db_loop,
+                          db_updater, db_write_buffer, clean_db_loop,
                           verify_table_encoding, verify_database_schema)
 from pogom.webhook import wh_updater
+from pogom.routecache import route_cache_refresher
+from pogom.ingest import IngestPool
+from pogom.analytics import analytics_sender
+from pogom.dyn_img import prerender_gym_icons
+from pogom.mapstream import map_stream, map_stream_publisher
 
 from pogom.osm import update_ex_gyms
 from time import strftime
@@ -277,6 +282,15 @@ def main():
 
     args.root_path = os.path.dirname(os.path.abspath(__file__))
 
+    # Processes to parse device posts, forked before any thread starts.
+    if app is not None and not args.map_only and (args.ingest_processes > 0 or
+                                                  args.ingest_async):
+        app.ingest_pool = IngestPool(app, max(args.ingest_processes, 1),
+                                     args.ingest_queue_size,
+                                     args.ingest_drop_oldest,
+                                     not args.ingest_async)
+        app.ingest_pool.start()
+
     # Control the search status (running or not) across threads.
     control_flags = {
         'on_demand': Event(),
@@ -296,11 +310,50 @@ def main():
     new_location_queue = Queue()
     new_location_queue.put(position)
 
+    # Thread to merge database updates before they are written.
+    db_writes_queue = db_updates_queue
+    if args.db_flush_ms > 0:
+        db_writes_queue = Queue()
+        t = Thread(target=db_write_buffer, name='db-write-buffer',
+                   args=(db_updates_queue, db_writes_queue,
+                         args.db_flush_rows, args.db_flush_ms / 1000.0))
+        t.daemon = True
+        t.start()
+
     # Thread(s) to process database updates.
     for i in range(args.db_threads):
         log.debug('Starting db-updater worker thread %d', i)
         t = Thread(target=db_updater, name='db-updater-{}'.format(i),
-                   args=(db_updates_queue, db))
+                   args=(db_writes_queue, db))
+        t.daemon = True
+        t.start()
+
+    # Thread to recompute the routes shared by devices.
+    if app is not None and args.route_cache_refresh > 0:
+        t = Thread(target=route_cache_refresher, name='route-cache',
+                   args=(app.route_cache,))
+        t.daemon = True
+        t.start()
+
+    # Thread to render the gym images before the map asks for them.
+    if (app is not None and args.generate_images and
+            args.generate_images_prerender > 0):
+        t = Thread(target=prerender_gym_icons, name='gym-images',
+                   args=(args.generate_images_prerender,))
+        t.daemon = True
+        t.start()
+
+    # Thread to push map changes to map clients.
+    if app is not None and args.map_stream:
+        t = Thread(target=map_stream_publisher, name='map-stream',
+                   args=(map_stream, app.stream_changes))
+        t.daemon = True
+        t.start()
+
+    # Thread to send Google Analytics events.
+    if app is not None and args.google_analytics_key:
+        t = Thread(target=analytics_sender, name='analytics',
+                   args=(app.analytics,))
         t.daemon = True
         t.start()
 
@@ -80,6 +80,11 @@ var selectedStyle = 'light'
 
 var updateWorker
 var lastUpdateTime
+
+// Server-Sent Events with new and changed Pokémon, Pokéstops and gyms.
+var mapStream = null
+var mapStreamLive = false
+var mapStreamUnavailable = false
 var redrawTimeout = null
 
 const gymTypes = ['Uncontested', 'Mystic', 'Valor', 'Instinct']
@@ -333,6 +338,7 @@ function initMap() { // eslint-disable-line no-unused-vars
 
     map.setMapTypeId(Store.get('map_style'))
     map.addListener('idle', updateMap)
+    map.addListener('idle', updateMapStream)
 
     map.addListener('zoom_changed', function () {
         var showRaidTimers = Store.get('showRaidTimers')
@@ -3181,6 +3187,74 @@ function updateMap() {
     })
 }
 
+// (Re)subscribes to map changes in the current viewport. If the server
+// doesn't stream, the map keeps polling raw_data.
+function updateMapStream() {
+    if (!window.EventSource || mapStreamUnavailable) {
+        return
+    }
+    if (mapStream) {
+        mapStream.close()
+        mapStreamLive = false
+    }
+
+    var bounds = map.getBounds()
+    var swPoint = bounds.getSouthWest()
+    var nePoint = bounds.getNorthEast()
+    var params = $.param({
+        'swLat': swPoint.lat(),
+        'swLng': swPoint.lng(),
+        'neLat': nePoint.lat(),
+        'neLng': nePoint.lng(),
+        'pokemon': Store.get('showPokemon'),
+        'pokestops': Store.get('showPokestops'),
+        'gyms': Store.get('showGyms') || Store.get('showRaids'),
+        'eids': String(excludedPokemon),
+        'geofencenames': geofencenames
+    })
+
+    var stream = new EventSource('stream?' + params)
+    var opened = false
+    mapStream = stream
+    stream.onopen = function () {
+        opened = true
+        mapStreamLive = true
+    }
+    stream.onerror = function () {
+        mapStreamLive = false
+        // Closed without ever opening, streaming is turned off.
+        if (!opened && stream.readyState === EventSource.CLOSED) {
+            mapStreamUnavailable = true
+        }
+    }
+    stream.addEventListener('update', function (e) {
+        var result = JSON.parse(e.data)
+        processPokemons(result.pokemons || [])
+        $.each(result.pokestops || [], processPokestop)
+        $.each(result.gyms || [], processGym)
+        showInBoundsMarkers(mapData.gyms, 'gym')
+        showInBoundsMarkers(mapData.pokestops, 'pokestop')
+        markerCluster.redraw()
+        updatePokestops()
+        updateGyms()
+    })
+    // Updates were lost, load the whole map again.
+    stream.addEventListener('reload', function () {
+        lastpokemon = false
+        lastpokestops = false
+        lastgyms = false
+        updateMap()
+    })
+}
+
+// While the stream is live, raw_data is only polled for everything else.
+function pollMap() {
+    if (mapStreamLive && Date.now() - lastUpdateTime < 30000) {
+        return
+    }
+    updateMap()
+}
+
 function redrawPokemon(pokemonList) {
     $.each(pokemonList, function (key, value) {
         var item = pokemonList[key]
@@ -4297,7 +4371,7 @@ $(function () {
 
     // run interval timers to regularly update map and timediffs
     window.setInterval(updateLabelDiffTime, 1000)
-    window.setInterval(updateMap, 5000)
+    window.setInterval(pollMap, 5000)
     window.setInterval(updateGeoLocation, 1000)
 
     createUpdateWorker()
@@ -4320,11 +4394,13 @@ $(function () {
                     lastspawns = false
                 }
                 updateMap()
+                updateMapStream()
             } else if (storageKey === 'showGyms' || storageKey === 'showRaids') {
                 // if any of switch is enable then do not remove gyms markers, only update them
                 if (Store.get('showGyms') || Store.get('showRaids')) {
                     lastgyms = false
                     updateMap()
+                    updateMapStream()
                 } else {
                     $.each(dataType, function (d, dType) {
                         $.each(data[dType], function (key, value) {
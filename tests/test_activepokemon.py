@@ -0,0 +1,126 @@
+import calendar
+import random
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from pogom.activepokemon import ActivePokemonIndex
+
+
+def pokemon(encounter_id, lat, lng, pokemon_id=16, seconds_left=600,
+            last_modified=None):
+    now = datetime.utcnow()
+    return {'encounter_id': encounter_id, 'pokemon_id': pokemon_id,
+            'latitude': lat, 'longitude': lng,
+            'disappear_time': now + timedelta(seconds=seconds_left),
+            'last_modified': last_modified or now}
+
+
+def in_box(row, swLat, swLng, neLat, neLng):
+    return (row['latitude'] >= swLat and row['longitude'] >= swLng and
+            row['latitude'] <= neLat and row['longitude'] <= neLng)
+
+
+# The WHERE clauses of Pokemon.get_active()'s database query.
+def query_active(rows, swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
+                 oSwLng=None, oNeLat=None, oNeLng=None, exclude=None):
+    now_date = datetime.utcnow()
+    result = []
+    for row in rows:
+        if exclude and row['pokemon_id'] in exclude:
+            continue
+        if not row['disappear_time'] > now_date:
+            continue
+        if not (swLat and swLng and neLat and neLng):
+            result.append(row)
+        elif timestamp > 0:
+            if (row['last_modified'] >
+                    datetime.utcfromtimestamp(timestamp / 1000) and
+                    in_box(row, swLat, swLng, neLat, neLng)):
+                result.append(row)
+        elif oSwLat and oSwLng and oNeLat and oNeLng:
+            if (in_box(row, swLat, swLng, neLat, neLng) and
+                    not in_box(row, oSwLat, oSwLng, oNeLat, oNeLng)):
+                result.append(row)
+        elif in_box(row, swLat, swLng, neLat, neLng):
+            result.append(row)
+    return result
+
+
+def encounter_ids(rows):
+    return sorted(row['encounter_id'] for row in rows)
+
+
+class ActivePokemonIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ActivePokemonIndex()
+
+    def test_matches_database_query(self):
+        random.seed(0)
+        now = datetime.utcnow()
+        rows = [pokemon(i, random.uniform(52.0, 52.2),
+                        random.uniform(4.8, 5.1),
+                        pokemon_id=random.randint(1, 10),
+                        seconds_left=random.choice([-60, 600]),
+                        last_modified=now - timedelta(
+                            seconds=random.randint(0, 600)))
+                for i in range(2000)]
+        self.index.update(rows)
+        since = now - timedelta(seconds=300)
+        timestamp = calendar.timegm(since.timetuple()) * 1000
+
+        view = (52.05, 4.9, 52.1, 5.0)
+        old = (52.07, 4.93, 52.12, 5.03)
+        cases = [
+            ((None, None, None, None), {}),
+            (view, {}),
+            ((52.0, 4.8, 52.2, 5.1), {}),
+            (view, {'timestamp': timestamp}),
+            (view, dict(zip(('oSwLat', 'oSwLng', 'oNeLat', 'oNeLng'), old))),
+            (view, {'exclude': [1, 2, 3]}),
+            (view, dict(zip(('oSwLat', 'oSwLng', 'oNeLat', 'oNeLng'), old),
+                        exclude=[4]))
+        ]
+        for box, kwargs in cases:
+            expected = encounter_ids(query_active(rows, *box, **kwargs))
+            self.assertTrue(expected or box[0] is None)
+            self.assertEqual(expected, encounter_ids(
+                self.index.get_active(*box, **kwargs)), (box, kwargs))
+
+    def test_entries_expire_at_disappear_time(self):
+        self.index.update([pokemon(1, 52.0, 5.0, seconds_left=0.1),
+                           pokemon(2, 52.0, 5.0)])
+
+        self.assertEqual([1, 2], encounter_ids(
+            self.index.get_active(51.9, 4.9, 52.1, 5.1)))
+        time.sleep(0.2)
+        self.assertEqual([2], encounter_ids(
+            self.index.get_active(51.9, 4.9, 52.1, 5.1)))
+        self.assertEqual(1, len(self.index))
+
+    def test_updates_replace_rows(self):
+        self.index.update([pokemon(1, 52.0, 5.0, pokemon_id=16)])
+        self.index.update([pokemon(1, 40.7, -74.0, pokemon_id=19)])
+
+        self.assertEqual([], self.index.get_active(51.9, 4.9, 52.1, 5.1))
+        moved = self.index.get_active(40.6, -74.1, 40.8, -73.9)
+        self.assertEqual([19], [p['pokemon_id'] for p in moved])
+        self.assertEqual([1], encounter_ids(
+            self.index.get_active_by_id([19], None, None, None, None)))
+
+    def test_load_keeps_rows_written_since(self):
+        self.index.update([pokemon(1, 52.0, 5.0, pokemon_id=19)])
+        self.index.load([pokemon(1, 52.0, 5.0, pokemon_id=16),
+                         pokemon(2, 52.0, 5.0)])
+
+        result = self.index.get_active(51.9, 4.9, 52.1, 5.1)
+        self.assertEqual([(1, 19), (2, 16)], sorted(
+            (p['encounter_id'], p['pokemon_id']) for p in result))
+
+    def test_results_are_copies(self):
+        self.index.update([pokemon(1, 52.0, 5.0)])
+        self.index.get_active(51.9, 4.9, 52.1, 5.1)[0]['pokemon_id'] = 1
+
+        self.assertEqual(16, self.index.get_active(
+            51.9, 4.9, 52.1, 5.1)[0]['pokemon_id'])
@@ -0,0 +1,77 @@
+import unittest
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from urlparse import parse_qs
+
+from pogom.analytics import AnalyticsSender
+
+
+# Local stand-in for the measurement protocol batch endpoint.
+class BatchHandler(BaseHTTPRequestHandler):
+    status = 200
+    bodies = []
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        BatchHandler.bodies.append(self.rfile.read(length))
+        self.send_response(BatchHandler.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class AnalyticsSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        BatchHandler.status = 200
+        BatchHandler.bodies = []
+        self.server = HTTPServer(('127.0.0.1', 0), BatchHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = 'http://127.0.0.1:%d/batch' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def hit(self, action):
+        return {'v': '1', 'tid': 'UA-1', 'cid': 'device', 't': 'event',
+                'ec': 'worker', 'ea': action, 'el': None, 'ev': 0}
+
+    def test_sends_queued_hits_in_batches(self):
+        sender = AnalyticsSender(url=self.url, batch_size=2)
+        for action in ('sent', 'walk', 'teleport'):
+            sender.track(self.hit(action))
+
+        self.assertTrue(sender.send_queued())
+        self.assertTrue(sender.send_queued())
+
+        self.assertEqual(2, len(BatchHandler.bodies))
+        lines = BatchHandler.bodies[0].split('\n')
+        self.assertEqual(2, len(lines))
+        first = parse_qs(lines[0])
+        self.assertEqual(['sent'], first['ea'])
+        self.assertNotIn('el', first)
+        self.assertEqual(1, len(BatchHandler.bodies[1].split('\n')))
+        self.assertEqual(3, sender.get_stats()['sent'])
+
+    def test_drops_hits_when_queue_is_full(self):
+        sender = AnalyticsSender(url=self.url, queue_size=2)
+        for action in ('a', 'b', 'c'):
+            sender.track(self.hit(action))
+
+        stats = sender.get_stats()
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(2, stats['queued'])
+
+    def test_counts_failed_batches(self):
+        BatchHandler.status = 500
+        sender = AnalyticsSender(url=self.url)
+        sender.track(self.hit('sent'))
+
+        self.assertFalse(sender.send_queued())
+        self.assertEqual(1, sender.get_stats()['failed'])
+        self.assertEqual(0, sender.get_stats()['sent'])
@@ -0,0 +1,51 @@
+import unittest
+
+from pogom.claims import ClaimTable
+
+
+class ClaimTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.holders = set(['a', 'b'])
+        self.claims = ClaimTable(lambda uuid, kind: uuid in self.holders)
+
+    def test_claims_exclude_other_devices_targets(self):
+        self.claims.claim('walk_pokestop', 'a', [(52.0, 5.0, 'p1'),
+                                                 (52.1, 5.1, 'p2')])
+        self.claims.claim('teleport_gym', 'b', [(52.0, 5.0, 'g1')])
+
+        self.assertEqual(set(['p1', 'p2']),
+                         set(self.claims.claimed('walk_pokestop')))
+        self.assertEqual(set(['g1']),
+                         set(self.claims.claimed('teleport_gym')))
+
+    def test_reached_targets_are_given_back(self):
+        self.claims.claim('walk_pokestop', 'a', [(52.0, 5.0, 'p1'),
+                                                 (52.1, 5.1, 'p2')])
+        self.claims.release('a', 'p1')
+        self.claims.release('b', 'p2')
+
+        self.assertEqual(set(['p2']),
+                         set(self.claims.claimed('walk_pokestop')))
+
+    def test_claims_of_idle_devices_are_handed_off(self):
+        self.claims.claim('walk_pokestop', 'a', [(52.0, 5.0, 'p1')])
+        self.holders.discard('a')
+
+        self.assertIn('p1', self.claims.claimed('walk_pokestop'))
+
+        self.claims.PLANNING_TIMEOUT = 0
+
+        self.assertNotIn('p1', self.claims.claimed('walk_pokestop'))
+        self.assertNotIn('a', self.claims.holders)
+
+    def test_one_device_plans_a_kind_at_a_time(self):
+        self.claims.claim('walk_pokestop', 'a', [(52.0, 5.0, 'p1')])
+
+        self.assertTrue(self.claims.start_planning('walk_pokestop', 'a'))
+        self.assertNotIn('p1', self.claims.claimed('walk_pokestop'))
+        self.assertFalse(self.claims.start_planning('walk_pokestop', 'b'))
+        self.assertTrue(self.claims.start_planning('teleport_gym', 'b'))
+
+        self.claims.claim('walk_pokestop', 'a', [(52.0, 5.0, 'p3')])
+        self.assertTrue(self.claims.start_planning('walk_pokestop', 'b'))
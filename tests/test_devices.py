@@ -0,0 +1,91 @@
+import unittest
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from pogom.devices import DeviceRegistry
+
+
+def device(uuid, fetching='IDLE', scanning=0, seconds_ago=0):
+    now = datetime.utcnow() - timedelta(seconds=seconds_ago)
+    return {'deviceid': uuid, 'name': uuid, 'latitude': 52.0,
+            'longitude': 5.0, 'fetching': fetching, 'scanning': scanning,
+            'last_updated': now, 'last_scanned': now}
+
+
+# A lock whose first user waits a while before taking it, like a thread
+# that's preempted right before it does.
+class DelayedLock(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.waiting = Event()
+        self.release = Event()
+
+    def __enter__(self):
+        if not self.waiting.is_set():
+            self.waiting.set()
+            self.release.wait(0.5)
+        self.lock.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+class DeviceRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.registry = DeviceRegistry(self.load)
+
+    def load(self, uuid, lat, lng):
+        self.loads.append(uuid)
+        return device(uuid)
+
+    def test_loads_unknown_devices_once(self):
+        first = self.registry.get_device('a', 52.0, 5.0)
+        first['name'] = 'changed'
+        second = self.registry.get_device('a', 52.0, 5.0)
+
+        self.assertEqual(['a'], self.loads)
+        self.assertEqual('a', second['name'])
+        self.assertEqual('', second['route'])
+
+    def test_save_bumps_version_without_changing_readers_copy(self):
+        self.registry.save(device('a'))
+        stored = self.registry.get('a')
+        changed = dict(stored, name='b')
+        self.registry.save(changed)
+
+        self.assertEqual(2, self.registry.version('a'))
+        self.assertEqual('a', stored['name'])
+        self.assertEqual('b', self.registry.get('a')['name'])
+
+    def test_active_index_follows_state(self):
+        self.registry.save(device('a', fetching='scanning'))
+        self.registry.save(device('b', scanning=1))
+        self.registry.save(device('c'))
+        self.registry.save(device('d', fetching='scanning', seconds_ago=600))
+
+        self.assertEqual(['a', 'b'], sorted(d['deviceid'] for d in
+                                            self.registry.get_active()))
+        self.registry.save(device('a'))
+        self.assertEqual(['b'], [d['deviceid'] for d in
+                                 self.registry.get_active()])
+
+    def test_save_due(self):
+        self.assertTrue(self.registry.save_due('a'))
+        self.assertFalse(self.registry.save_due('a'))
+        self.assertTrue(self.registry.save_due('a', True))
+
+    def test_active_index_keeps_latest_of_concurrent_saves(self):
+        self.registry.active_lock = DelayedLock()
+        thread = Thread(target=self.registry.save,
+                        args=(device('a', fetching='scanning'),))
+        thread.start()
+        self.registry.active_lock.waiting.wait(1)
+        self.registry.save(device('a'))
+        self.registry.active_lock.release.set()
+        thread.join()
+
+        self.assertEqual('IDLE', self.registry.get('a')['fetching'])
+        self.assertEqual([], self.registry.get_active())
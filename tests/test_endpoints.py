@@ -0,0 +1,60 @@
+import unittest
+
+from werkzeug.datastructures import MultiDict
+
+from pogom.endpoints import (get_endpoint_spec, pogo_version,
+                             requested_endpoint, typed_params)
+
+
+class EndpointSpecTest(unittest.TestCase):
+
+    def test_parses_name_and_typed_params(self):
+        spec = get_endpoint_spec(
+            'https://map.example.com/walk_pokestop?maxradius=2'
+            '&questless=true&stepsize=0.0001&geofence=Centre')
+
+        self.assertEqual('walk_pokestop', spec.name)
+        self.assertEqual({'maxradius': 2, 'questless': True,
+                          'stepsize': 0.0001, 'geofence': 'Centre'},
+                         spec.params)
+
+    def test_empty_endpoint_scans_location(self):
+        self.assertEqual('scan_loc', get_endpoint_spec('').name)
+        self.assertEqual('teleport_gym',
+                         get_endpoint_spec('/Teleport_Gym').name)
+
+    def test_specs_are_parsed_once(self):
+        self.assertIs(get_endpoint_spec('walk_gpx?route=a'),
+                      get_endpoint_spec('walk_gpx?route=a'))
+
+
+class TypedParamsTest(unittest.TestCase):
+
+    def test_keeps_values_that_dont_parse(self):
+        params = typed_params(MultiDict([('maxpoints', '25'),
+                                         ('no_overlap', 'True'),
+                                         ('speed', 'fast'),
+                                         ('route', 'north')]))
+
+        self.assertEqual(25, params['maxpoints'])
+        self.assertIs(True, params['no_overlap'])
+        self.assertEqual('fast', params.get('speed', 10))
+        self.assertEqual('north', params.get('route', '', type=str))
+        self.assertIsNone(params.get('unknown_tth'))
+
+    def test_leaves_json_values_alone(self):
+        params = typed_params({'speed': 12, 'no_overlap': False})
+
+        self.assertEqual({'speed': 12, 'no_overlap': False}, params)
+
+
+class RequestDetailsTest(unittest.TestCase):
+
+    def test_requested_endpoint_drops_location(self):
+        self.assertEqual('/loc/walk_gpx?route=a', requested_endpoint(
+            '/loc/walk_gpx?route=a&latitude=52.1&longitude=-5.2'
+            '&timestamp=1.5'))
+
+    def test_pogo_version(self):
+        self.assertEqual('0.119.2', pogo_version(
+            'pokemongo/0.119.2 CFNetwork/902.2 Darwin/17.7.0'))
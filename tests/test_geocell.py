@@ -0,0 +1,53 @@
+import unittest
+import random
+
+from pogom.geocell import geocell, viewport_ranges, uncovered_ranges
+
+
+def in_ranges(key, ranges):
+    return any(first <= key <= last for first, last in ranges)
+
+
+def in_box(lat, lng, box):
+    return box[0] <= lat <= box[2] and box[1] <= lng <= box[3]
+
+
+class GeocellTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.points = [(52.3 + random.random() * 0.15,
+                        4.8 + random.random() * 0.2) for _ in range(5000)]
+
+    def test_viewport_ranges_hold_everything_in_the_box(self):
+        box = (52.35, 4.85, 52.39, 4.93)
+        ranges = viewport_ranges(*box)
+
+        self.assertLessEqual(len(ranges), 16)
+        for lat, lng in self.points:
+            if in_box(lat, lng, box):
+                self.assertTrue(in_ranges(geocell(lat, lng), ranges))
+
+    def test_viewport_ranges_skip_far_away_points(self):
+        ranges = viewport_ranges(52.35, 4.85, 52.36, 4.86)
+
+        self.assertFalse(in_ranges(geocell(40.7, -74.0), ranges))
+
+    def test_uncovered_ranges_hold_the_new_area(self):
+        new = (52.33, 4.84, 52.38, 4.95)
+        old = (52.34, 4.86, 52.40, 4.97)
+        ranges = uncovered_ranges(*(new + old))
+
+        for lat, lng in self.points:
+            if in_box(lat, lng, new) and not in_box(lat, lng, old):
+                self.assertTrue(in_ranges(geocell(lat, lng), ranges))
+
+    def test_zooming_in_uncovers_nothing(self):
+        new = (52.35, 4.88, 52.36, 4.89)
+        old = (52.30, 4.80, 52.45, 5.00)
+
+        self.assertEqual([], uncovered_ranges(*(new + old)))
+
+    def test_accepts_request_strings(self):
+        self.assertEqual(viewport_ranges(52.35, 4.85, 52.39, 4.93),
+                         viewport_ranges('52.35', '4.85', '52.39', '4.93'))
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pogom.gpxroutes import GpxRoutes
+
+GPX = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test">
+  <trk><trkseg>
+{}
+  </trkseg></trk>
+</gpx>
+'''
+
+
+def write_gpx(path, points):
+    with open(path, 'w') as f:
+        f.write(GPX.format('\n'.join(
+            '    <trkpt lat="{}" lon="{}"></trkpt>'.format(lat, lng)
+            for lat, lng in points)))
+
+
+class GpxRoutesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'route.gpx')
+        write_gpx(self.path, [(52.1, 5.1), (52.2, 5.2), (52.3, 5.3)])
+        self.routes = GpxRoutes()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_schedules_share_parsed_points(self):
+        first = self.routes.schedule(self.path)
+        second = self.routes.schedule(self.path)
+
+        self.assertIs(first.points, second.points)
+        self.assertEqual([(52.1, 5.1), (52.2, 5.2), (52.3, 5.3)],
+                         list(first))
+
+        del first[0]
+        self.assertEqual(2, len(first))
+        self.assertEqual((52.2, 5.2), first[0])
+        self.assertEqual(3, len(second))
+
+    def test_reparses_changed_file(self):
+        self.routes.schedule(self.path)
+        write_gpx(self.path, [(40.0, -74.0)])
+        mtime = os.path.getmtime(self.path) + 10
+        os.utime(self.path, (mtime, mtime))
+
+        self.assertEqual([(40.0, -74.0)],
+                         list(self.routes.schedule(self.path)))
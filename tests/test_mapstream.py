@@ -0,0 +1,76 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+from threading import Thread
+
+from pogom.mapstream import STREAM_KINDS, MapStream, map_stream_publisher
+
+
+def pokemon(lat, lng, pokemon_id=16, last_modified=None):
+    return {'latitude': lat, 'longitude': lng, 'pokemon_id': pokemon_id,
+            'last_modified': last_modified or datetime.utcnow()}
+
+
+class MapStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = MapStream(queue_size=2)
+
+    def test_publishes_to_subscribers_that_can_see_the_item(self):
+        near = self.stream.subscribe(52.3, 4.8, 52.4, 5.0, ['pokemons'])
+        far = self.stream.subscribe(40.6, -74.1, 40.8, -73.9, ['pokemons'])
+        world = self.stream.subscribe(-80, -170, 80, 170, ['pokemons'])
+        gyms = self.stream.subscribe(52.3, 4.8, 52.4, 5.0, ['gyms'])
+
+        self.stream.publish('pokemons', [pokemon(52.35, 4.9)])
+
+        self.assertEqual(1, len(near.queue))
+        self.assertEqual(0, len(far.queue))
+        self.assertEqual(1, len(world.queue))
+        self.assertEqual(0, len(gyms.queue))
+
+    def test_skips_excluded_pokemon(self):
+        subscriber = self.stream.subscribe(52.3, 4.8, 52.4, 5.0,
+                                           ['pokemons'], exclude=[16])
+
+        self.stream.publish('pokemons', [pokemon(52.35, 4.9)])
+
+        self.assertEqual(0, len(subscriber.queue))
+
+    def test_unseen_skips_items_sent_already(self):
+        since = datetime.utcnow() - timedelta(seconds=10)
+        items = [(1, pokemon(52.35, 4.9))]
+
+        self.assertEqual(1, len(self.stream.unseen('pokemons', items, since)))
+        self.assertEqual(0, len(self.stream.unseen('pokemons', items, since)))
+
+    def test_slow_subscriber_is_asked_to_reload(self):
+        subscriber = self.stream.subscribe(52.3, 4.8, 52.4, 5.0,
+                                           ['pokemons'])
+        for _ in range(3):
+            self.stream.publish('pokemons', [pokemon(52.35, 4.9)])
+
+        events = subscriber.events()
+        next(events)
+        self.assertTrue(next(events).startswith('event: reload'))
+        events.close()
+        self.assertNotIn(subscriber, self.stream.subscribers)
+
+    def test_publisher_polls_without_local_writes(self):
+        fetched = []
+        item = pokemon(52.35, 4.9)
+
+        def fetch(kind, since):
+            fetched.append(kind)
+            return [(1, item)] if kind == 'pokemons' else []
+
+        subscriber = self.stream.subscribe(52.3, 4.8, 52.4, 5.0,
+                                           ['pokemons'])
+        publisher = Thread(target=map_stream_publisher,
+                           args=(self.stream, fetch, 0.01))
+        publisher.daemon = True
+        publisher.start()
+        time.sleep(0.3)
+
+        self.assertEqual(set(STREAM_KINDS), set(fetched))
+        self.assertEqual(1, len(subscriber.queue))
@@ -0,0 +1,58 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from pogom.recentlyseen import ExpiringStore
+
+
+def in_seconds(seconds):
+    return datetime.utcnow() + timedelta(seconds=seconds)
+
+
+class ExpiringStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ExpiringStore(3, timedelta(hours=1))
+
+    def test_set_tells_new_keys_apart(self):
+        self.assertTrue(self.store.set('a', 1))
+        self.assertFalse(self.store.set('a', 2))
+
+        self.assertEqual(2, self.store.get('a'))
+        self.assertIn('a', self.store)
+        self.assertNotIn('b', self.store)
+        self.assertEqual({'a': 2}, self.store.get_many(['a', 'b']))
+
+    def test_entries_expire_at_their_own_time(self):
+        self.store.set('a', 1, in_seconds(0.1))
+        self.store.set('b', 2)
+
+        time.sleep(0.2)
+        self.assertIsNone(self.store.get('a'))
+        self.assertEqual({'b': 2}, self.store.get_many(['a', 'b']))
+        # Seen again after it expired counts as new.
+        self.assertTrue(self.store.set('a', 1, in_seconds(60)))
+        self.assertEqual(2, len(self.store))
+
+    def test_expired_values_are_not_stored(self):
+        self.assertFalse(self.store.set('a', 1, in_seconds(-1)))
+        self.assertNotIn('a', self.store)
+
+    def test_full_store_drops_what_expires_first(self):
+        self.store.set('a', 1, in_seconds(30))
+        self.store.set('b', 2, in_seconds(10))
+        self.store.set('c', 3, in_seconds(20))
+        self.store.set('d', 4, in_seconds(40))
+
+        self.assertEqual({'a': 1, 'c': 3, 'd': 4},
+                         self.store.get_many(['a', 'b', 'c', 'd']))
+
+    def test_updated_keys_keep_their_new_expiry(self):
+        self.store.set('a', 1, in_seconds(10))
+        self.store.set('a', 1, in_seconds(50))
+        self.store.set('b', 2, in_seconds(20))
+        self.store.set('c', 3, in_seconds(30))
+        self.store.set('d', 4, in_seconds(40))
+
+        self.assertEqual({'a': 1, 'c': 3, 'd': 4},
+                         self.store.get_many(['a', 'b', 'c', 'd']))
@@ -0,0 +1,49 @@
+import time
+import unittest
+from threading import Thread
+
+from pogom.routecache import RouteCache
+
+
+class RouteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RouteCache()
+        self.computed = []
+
+    def compute(self):
+        self.computed.append(1)
+        time.sleep(0.2)
+        return [(52.0, 5.0, 'a'), (52.1, 5.1, 'b')]
+
+    def get_route(self, uuid, results):
+        results[uuid] = self.cache.get_route(('walk_pokestop', 'centre'),
+                                             uuid, 52.0, 5.0, self.compute)
+
+    def test_first_requests_compute_once(self):
+        results = {}
+        threads = [Thread(target=self.get_route, args=(uuid, results))
+                   for uuid in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len(self.computed))
+        for route in results.values():
+            self.assertEqual(2, len(route))
+
+    def test_stale_route_is_served_while_recomputing(self):
+        results = {}
+        self.get_route(0, results)
+        self.cache.invalidate('walk_pokestop')
+        self.cache.refresh_interval = 0
+        recompute = Thread(target=self.cache.refresh)
+        recompute.start()
+        time.sleep(0.05)
+
+        self.get_route(1, results)
+        recompute.join()
+
+        self.assertEqual(2, len(self.computed))
+        self.assertEqual(2, len(results[1]))
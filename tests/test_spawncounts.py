@@ -0,0 +1,79 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from pogom.spawncounts import EPOCH, SpawnCounts, hour_bucket
+
+
+def sighting(pokemon_id, disappear_time):
+    return {'pokemon_id': pokemon_id, 'disappear_time': disappear_time}
+
+
+# What Pokemon.get_spawn_counts()'s query returns, rows of (hour,
+# pokemon_id, count) for sightings since the hour.
+def query_counts(sightings, since):
+    counts = {}
+    for row in sightings:
+        if since is None or row['disappear_time'] >= (
+                EPOCH + timedelta(hours=since)):
+            key = (hour_bucket(row['disappear_time']), row['pokemon_id'])
+            counts[key] = counts.get(key, 0) + 1
+    return [bucket + (count,) for bucket, count in counts.items()]
+
+
+def totals(rows):
+    counts = {}
+    for hour, pokemon_id, count in rows:
+        counts[pokemon_id] = counts.get(pokemon_id, 0) + count
+    return counts, sum(counts.values())
+
+
+class SpawnCountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.counts = SpawnCounts()
+        self.now = datetime(2018, 11, 5, 12, 30)
+        self.hour = hour_bucket(self.now)
+
+    def test_hour_bucket(self):
+        self.assertEqual(0, hour_bucket(EPOCH + timedelta(minutes=59)))
+        self.assertEqual(1, hour_bucket(EPOCH + timedelta(minutes=60)))
+
+    def test_covers_what_was_loaded(self):
+        self.assertFalse(self.counts.covers(self.hour))
+
+        self.counts.load([], self.hour - 24)
+        self.assertTrue(self.counts.covers(self.hour - 24))
+        self.assertTrue(self.counts.covers(self.hour))
+        self.assertFalse(self.counts.covers(self.hour - 48))
+        self.assertFalse(self.counts.covers(None))
+
+        self.counts.load([], None)
+        self.assertTrue(self.counts.covers(None))
+
+    def test_matches_database_query(self):
+        random.seed(0)
+        sightings = [sighting(random.randint(1, 20), self.now - timedelta(
+            minutes=random.randint(0, 72 * 60))) for _ in range(1000)]
+        loaded, added = sightings[:600], sightings[600:]
+
+        since = self.hour - 48
+        self.counts.load(query_counts(loaded, since), since)
+        self.counts.add(added)
+
+        for hours in (48, 24, 1):
+            since = self.hour - hours
+            self.assertEqual(totals(query_counts(sightings, since)),
+                             self.counts.get(since))
+
+    def test_counts_nothing_before_loading(self):
+        self.counts.add([sighting(1, self.now)])
+        self.counts.load([], None)
+
+        self.assertEqual(({}, 0), self.counts.get(None))
+
+    def test_dropped_hours_need_loading_again(self):
+        self.counts.load([(self.hour - 30, 1, 2), (self.hour, 1, 3)], None)
+
+        self.assertEqual(({1: 3}, 3), self.counts.get(self.hour - 24))
+        self.assertFalse(self.counts.covers(self.hour - 48))
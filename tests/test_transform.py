@@ -0,0 +1,50 @@
+import random
+import unittest
+
+import geopy.distance
+
+from pogom.transform import (haversine_distance, equirectangular_distance,
+                             haversine_distances)
+
+
+class DistanceTest(unittest.TestCase):
+
+    # City scale pairs: up to ~20km apart, from the equator to the arctic.
+    def setUp(self):
+        random.seed(42)
+        self.pairs = []
+        for _ in range(500):
+            lat = random.uniform(-70, 70)
+            lng = random.uniform(-180, 180)
+            self.pairs.append((lat, lng,
+                               lat + random.uniform(-0.1, 0.1),
+                               lng + random.uniform(-0.1, 0.1)))
+
+    def test_haversine_close_to_vincenty(self):
+        for lat1, lng1, lat2, lng2 in self.pairs:
+            expected = geopy.distance.vincenty(
+                (lat1, lng1), (lat2, lng2)).meters
+            self.assertAlmostEqual(
+                haversine_distance(lat1, lng1, lat2, lng2), expected,
+                delta=expected * 0.006 + 0.01)
+
+    def test_equirectangular_close_to_haversine(self):
+        for lat1, lng1, lat2, lng2 in self.pairs:
+            expected = haversine_distance(lat1, lng1, lat2, lng2)
+            self.assertAlmostEqual(
+                equirectangular_distance(lat1, lng1, lat2, lng2), expected,
+                delta=expected * 0.001 + 0.01)
+
+    def test_haversine_distances_matches_scalar(self):
+        lat, lng = 52.37, 4.89
+        lats = [p[2] for p in self.pairs]
+        lngs = [p[3] for p in self.pairs]
+        distances = haversine_distances(lat, lng, lats, lngs)
+        self.assertEqual(len(distances), len(self.pairs))
+        for d, lat2, lng2 in zip(distances, lats, lngs):
+            self.assertAlmostEqual(
+                d, haversine_distance(lat, lng, lat2, lng2), delta=1e-3)
+
+    def test_zero_distance(self):
+        self.assertEqual(haversine_distance(52.0, 5.0, 52.0, 5.0), 0)
+        self.assertEqual(haversine_distances(52.0, 5.0, [], []), [])
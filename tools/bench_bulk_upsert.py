@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmark for bulk_upsert.
+
+Compares the old bulk_upsert, which rebuilt its query, field list and
+defaults on every call and toggled FOREIGN_KEY_CHECKS around every 500 rows,
+against the cached upsert plans and the single transaction that
+bulk_upsert_many uses for several queued batches.
+
+Usage:
+    python tools/bench_bulk_upsert.py [-n ROWS] [-b BATCHES] [--rounds N]
+                                      [--mysql] [RocketMap args...]
+
+By default the statements go to a cursor that discards them, which measures
+the Python side only. With --mysql the database from config/config.ini (or
+the RocketMap args given) is used, and rows are written to the pokemon table.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--rows', type=int, default=100,
+                    help='Rows per queued batch.')
+parser.add_argument('-b', '--batches', type=int, default=10,
+                    help='Queued batches per transaction.')
+parser.add_argument('--rounds', type=int, default=50)
+parser.add_argument('--mysql', action='store_true',
+                    help='Write to the configured database.')
+bench_args, sys.argv[1:] = parser.parse_known_args()
+
+from peewee import InsertQuery  # noqa: E402
+from pogom.models import (Pokemon, add_geocells,  # noqa: E402
+                          bulk_upsert_many, init_database, upsert_plans)
+from pogom.utils import peewee_attr_to_col  # noqa: E402
+
+
+class NullCursor(object):
+
+    def executemany(self, query, rows):
+        pass
+
+
+class NullConnection(object):
+
+    def escape_string(self, s):
+        return s.replace('`', '``')
+
+
+class NullDatabase(object):
+
+    def __init__(self):
+        self.conn = NullConnection()
+        self.cursor = NullCursor()
+
+    def is_closed(self):
+        return False
+
+    def get_conn(self):
+        return self.conn
+
+    def get_cursor(self):
+        return self.cursor
+
+    def atomic(self):
+        return self
+
+    def execute_sql(self, sql):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def synthetic_batch(rows):
+    now_date = datetime.utcnow()
+    data = {}
+    for _ in range(rows):
+        encounter_id = random.getrandbits(63)
+        data[encounter_id] = {
+            'encounter_id': encounter_id,
+            'spawnpoint_id': random.getrandbits(40),
+            'pokemon_id': random.randint(1, 380),
+            'latitude': 52.0 + random.random() / 100,
+            'longitude': 5.0 + random.random() / 100,
+            'disappear_time': now_date + timedelta(minutes=30),
+            'individual_attack': None,
+            'individual_defense': None,
+            'individual_stamina': None,
+            'move_1': None,
+            'move_2': None,
+            'cp': None,
+            'cp_multiplier': None,
+            'height': None,
+            'weight': None,
+            'gender': random.randint(1, 2),
+            'costume': 0,
+            'form': 0,
+            'weather_boosted_condition': 0
+        }
+    # As the parsers queue them.
+    add_geocells(data)
+    return data
+
+
+# The previous implementation, one call and transaction per queued batch.
+def legacy_bulk_upsert(cls, data, db):
+    rows = data.values()
+    num_rows = len(rows)
+    step = 500
+    conn = db.get_conn()
+    cursor = db.get_cursor()
+
+    query = InsertQuery(cls, rows=[rows[0]])
+    first_row = {}
+    for first_row in query._iter_rows():
+        break
+    row_fields = sorted(first_row.keys(), key=lambda x: x._sort_key)
+    row_fields = map(lambda x: x.name, row_fields)
+    db_columns = [peewee_attr_to_col(cls, f) for f in row_fields]
+
+    defaults = {}
+    for f in cls._meta.fields.values():
+        defaults[f.name] = cls._meta.defaults.get(f, None)
+
+    table = '`' + conn.escape_string(cls._meta.db_table) + '`'
+    escaped_fields = ['`' + conn.escape_string(f) + '`'
+                      for f in db_columns]
+    placeholders = ['%s' for escaped_field in escaped_fields]
+    assignments = ['{x} = VALUES({x})'.format(
+        x=escaped_field
+    ) for escaped_field in escaped_fields]
+    query_string = ('INSERT INTO {table} ({fields}) VALUES' +
+                    ' ({placeholders}) ON DUPLICATE KEY UPDATE' +
+                    ' {assignments}')
+
+    with db.atomic():
+        for i in range(0, num_rows, step):
+            db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+            batch = []
+            batch_rows = rows[i:min(i + step, num_rows)]
+            while len(batch_rows) > 0:
+                row = batch_rows.pop()
+                row_data = []
+                for field in row_fields:
+                    if field not in row:
+                        default = defaults.get(field, None)
+                        if callable(default):
+                            default = default()
+                        row[field] = default
+                    row_data.append(row[field])
+                batch.append(row_data)
+
+            formatted_query = query_string.format(
+                table=table,
+                fields=', '.join(escaped_fields),
+                placeholders=', '.join(placeholders),
+                assignments=', '.join(assignments)
+            )
+            cursor.executemany(formatted_query, batch)
+            db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+
+
+def bench(func, rounds, batches, rows):
+    # Fresh dicts every round, bulk_upsert fills in defaults in place.
+    work = [[(Pokemon, synthetic_batch(rows)) for _ in range(batches)]
+            for _ in range(rounds)]
+    start = time.time()
+    for queued in work:
+        func(queued)
+    return (time.time() - start) / rounds
+
+
+def main():
+    random.seed(0)
+    if bench_args.mysql:
+        db = init_database(None)
+        label = 'mysql'
+    else:
+        db = NullDatabase()
+        label = 'null cursor'
+
+    def legacy(queued):
+        for cls, data in queued:
+            legacy_bulk_upsert(cls, data, db)
+
+    def planned(queued):
+        bulk_upsert_many(queued, db)
+
+    # Warm up, the first call builds the plan.
+    planned([(Pokemon, synthetic_batch(1))])
+    assert upsert_plans
+
+    rounds, batches, rows = (bench_args.rounds, bench_args.batches,
+                             bench_args.rows)
+    legacy_secs = bench(legacy, rounds, batches, rows)
+    planned_secs = bench(planned, rounds, batches, rows)
+    print('%s, %d batches of %d rows per transaction' % (
+        label, batches, rows))
+    print('legacy bulk_upsert: %8.3f ms/transaction' % (legacy_secs * 1000))
+    print('bulk_upsert_many:   %8.3f ms/transaction' % (planned_secs * 1000))
+    print('speedup: %.1fx' % (legacy_secs / planned_secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmark for the distance functions in pogom.transform.
+
+Times geopy's Vincenty, which parse_map_protos and the get_nearby_* methods
+used per object, against the haversine and equirectangular replacements and
+the batch haversine_distances(), on city scale distances. Also prints the
+largest relative error against Vincenty.
+
+Usage:
+    python tools/bench_distance.py [-n POINTS] [--size KM]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import geopy.distance
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from pogom.transform import (haversine_distance,  # noqa: E402
+                             equirectangular_distance, haversine_distances)
+
+
+def vincenty(lat1, lng1, lat2, lng2):
+    return geopy.distance.vincenty((lat1, lng1), (lat2, lng2)).meters
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--points', type=int, default=20000)
+    parser.add_argument('--size', type=float, default=20,
+                        help='Width of the area in km.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    lat, lng = 52.37, 4.89
+    deg = args.size / 111.0 / 2
+    lats = [lat + random.uniform(-deg, deg) for _ in range(args.points)]
+    lngs = [lng + random.uniform(-deg, deg) for _ in range(args.points)]
+
+    secs, expected = timed(lambda: [
+        vincenty(lat, lng, a, b) for a, b in zip(lats, lngs)])
+    print('%d points within %.0f km' % (args.points, args.size))
+    print('%-26s %8.2f us/point' % ('vincenty', secs * 1e6 / args.points))
+
+    for name, func in (('haversine_distance', haversine_distance),
+                       ('equirectangular_distance',
+                        equirectangular_distance)):
+        secs, result = timed(lambda: [
+            func(lat, lng, a, b) for a, b in zip(lats, lngs)])
+        error = max(abs(r - e) / e for r, e in zip(result, expected) if e)
+        print('%-26s %8.2f us/point, max error %.3f%%' % (
+            name, secs * 1e6 / args.points, error * 100))
+
+    secs, result = timed(lambda: haversine_distances(lat, lng, lats, lngs))
+    error = max(abs(r - e) / e for r, e in zip(result, expected) if e)
+    print('%-26s %8.2f us/point, max error %.3f%% (numpy: %s)' % (
+        'haversine_distances', secs * 1e6 / args.points, error * 100,
+        'numpy' in sys.modules))
+
+
+if __name__ == '__main__':
+    main()
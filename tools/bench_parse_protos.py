@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmark for decoding GetMapObjects protos.
+
+Compares the old MessageToJson/json.loads round-trip against reading the
+parsed proto objects directly, the way Pogom.parse_map_protos does now.
+
+Usage:
+    python tools/bench_parse_protos.py [recorded.json] [-n ROUNDS]
+
+recorded.json holds webhook bodies as posted by the devices, either a single
+body or a list of them. Each body has a 'protos' list of dicts with base64
+encoded responses. Without a file, a synthetic payload is generated.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from base64 import b64decode
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import pogom.protos  # noqa: E402, F401
+from google.protobuf.json_format import MessageToJson  # noqa: E402
+from pogoprotos.networking.responses import (  # noqa: E402
+    get_map_objects_response_pb2)
+from pogoprotos.map.fort.fort_type_pb2 import CHECKPOINT  # noqa: E402
+from pogoprotos.enums.pokemon_id_pb2 import _POKEMONID  # noqa: E402
+from pogoprotos.enums.gender_pb2 import _GENDER  # noqa: E402
+from pogoprotos.enums.form_pb2 import _FORM  # noqa: E402
+from pogoprotos.enums.costume_pb2 import _COSTUME  # noqa: E402
+from pogoprotos.enums.team_color_pb2 import _TEAMCOLOR  # noqa: E402
+from pogoprotos.enums.weather_condition_pb2 import (  # noqa: E402
+    _WEATHERCONDITION)
+from pogoprotos.enums.raid_level_pb2 import _RAIDLEVEL  # noqa: E402
+
+
+def synthetic_gmo(cells=20, pokemon=8, forts=4):
+    gmo = get_map_objects_response_pb2.GetMapObjectsResponse()
+    gmo.status = 1
+    gmo.time_of_day = 1
+    for c in range(cells):
+        cell = gmo.map_cells.add()
+        cell.s2_cell_id = 5764607523034234880 + c
+        cell.current_timestamp_ms = 1540000000000
+        for i in range(pokemon):
+            p = cell.wild_pokemons.add()
+            p.encounter_id = random.getrandbits(63)
+            p.spawn_point_id = '%x' % random.getrandbits(40)
+            p.latitude = 52.0 + random.random() / 100
+            p.longitude = 5.0 + random.random() / 100
+            p.time_till_hidden_ms = random.randint(0, 3600000)
+            p.pokemon_data.pokemon_id = random.randint(1, 380)
+            p.pokemon_data.pokemon_display.gender = random.randint(1, 2)
+            p.pokemon_data.pokemon_display.weather_boosted_condition = 3
+            n = cell.nearby_pokemons.add()
+            n.encounter_id = random.getrandbits(63)
+            n.pokemon_id = random.randint(1, 380)
+            n.fort_id = '%x.16' % random.getrandbits(64)
+            n.distance_in_meters = random.random() * 200
+        for i in range(forts):
+            f = cell.forts.add()
+            f.id = '%x.16' % random.getrandbits(64)
+            f.latitude = 52.0 + random.random() / 100
+            f.longitude = 5.0 + random.random() / 100
+            f.last_modified_timestamp_ms = 1540000000000
+            f.enabled = True
+            if i % 2:
+                f.type = CHECKPOINT
+                f.image_url = 'http://example.com/stop.png'
+            else:
+                f.owned_by_team = random.randint(1, 3)
+                f.guard_pokemon_id = random.randint(1, 380)
+                f.gym_display.slots_available = 2
+                f.gym_display.total_gym_cp = 8000
+                f.raid_info.raid_level = 5
+                f.raid_info.raid_spawn_ms = 1540000000000
+                f.raid_info.raid_battle_ms = 1540003600000
+                f.raid_info.raid_end_ms = 1540006300000
+                f.raid_info.raid_pokemon.pokemon_id = 150
+                f.raid_info.raid_pokemon.cp = 40000
+    return gmo.SerializeToString()
+
+
+def load_recorded(path):
+    with open(path) as f:
+        bodies = json.load(f)
+    if isinstance(bodies, dict):
+        bodies = [bodies]
+    payloads = []
+    for body in bodies:
+        for proto in body.get('protos', []):
+            if 'GetMapObjects' in proto:
+                payloads.append(b64decode(proto['GetMapObjects']))
+    return payloads
+
+
+def decode_json(data):
+    gmo = get_map_objects_response_pb2.GetMapObjectsResponse()
+    gmo.ParseFromString(data)
+    gmo_json = json.loads(MessageToJson(gmo))
+    rows = []
+    for cell in gmo_json.get('mapCells', []):
+        for p in cell.get('wildPokemons', []):
+            display = p['pokemonData'].get('pokemonDisplay', {})
+            rows.append((
+                long(p['encounterId']), p['spawnPointId'],
+                p['latitude'], p['longitude'],
+                float(p.get('timeTillHiddenMs', 0)),
+                _POKEMONID.values_by_name[
+                    p['pokemonData']['pokemonId']].number,
+                _GENDER.values_by_name[
+                    display.get('gender', 'GENDER_UNSET')].number,
+                _COSTUME.values_by_name[
+                    display.get('costume', 'COSTUME_UNSET')].number,
+                _FORM.values_by_name[
+                    display.get('form', 'FORM_UNSET')].number,
+                _WEATHERCONDITION.values_by_name[
+                    display.get('weatherBoostedCondition', 'NONE')].number))
+        for p in cell.get('nearbyPokemons', []):
+            rows.append((
+                long(p['encounterId']), p.get('fortId'),
+                _POKEMONID.values_by_name[p['pokemonId']].number,
+                round(p.get('distanceInMeters', 0), 5)))
+        for f in cell.get('forts', []):
+            if f.get('type') == 'CHECKPOINT':
+                rows.append((f['id'], f['latitude'], f['longitude'],
+                             f.get('enabled', False),
+                             float(f['lastModifiedTimestampMs']),
+                             f.get('imageUrl', '')))
+                continue
+            rows.append((
+                f['id'], f['latitude'], f['longitude'],
+                _TEAMCOLOR.values_by_name[
+                    f.get('ownedByTeam', 'NEUTRAL')].number,
+                _POKEMONID.values_by_name[
+                    f.get('guardPokemonId', 'MISSINGNO')].number,
+                f['gymDisplay'].get('slotsAvailable', 0),
+                f['gymDisplay'].get('totalGymCp', 0)))
+            if 'raidInfo' in f:
+                raid = f['raidInfo']
+                rows.append((
+                    _RAIDLEVEL.values_by_name[raid['raidLevel']].number,
+                    float(raid['raidSpawnMs']), float(raid['raidBattleMs']),
+                    float(raid['raidEndMs']),
+                    raid.get('raidPokemon', {}).get('cp')))
+    return rows
+
+
+def decode_direct(data):
+    gmo = get_map_objects_response_pb2.GetMapObjectsResponse()
+    gmo.ParseFromString(data)
+    rows = []
+    for cell in gmo.map_cells:
+        for p in cell.wild_pokemons:
+            display = p.pokemon_data.pokemon_display
+            rows.append((
+                p.encounter_id, p.spawn_point_id, p.latitude, p.longitude,
+                float(p.time_till_hidden_ms), p.pokemon_data.pokemon_id,
+                display.gender, display.costume, display.form,
+                display.weather_boosted_condition))
+        for p in cell.nearby_pokemons:
+            rows.append((p.encounter_id, p.fort_id, p.pokemon_id,
+                         round(p.distance_in_meters, 5)))
+        for f in cell.forts:
+            if f.type == CHECKPOINT:
+                rows.append((f.id, f.latitude, f.longitude, f.enabled,
+                             float(f.last_modified_timestamp_ms),
+                             f.image_url))
+                continue
+            rows.append((f.id, f.latitude, f.longitude, f.owned_by_team,
+                         f.guard_pokemon_id, f.gym_display.slots_available,
+                         f.gym_display.total_gym_cp))
+            if f.HasField('raid_info'):
+                raid = f.raid_info
+                rows.append((raid.raid_level, float(raid.raid_spawn_ms),
+                             float(raid.raid_battle_ms),
+                             float(raid.raid_end_ms),
+                             raid.raid_pokemon.cp or None))
+    return rows
+
+
+def bench(func, payloads, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        for data in payloads:
+            func(data)
+    return (time.time() - start) / (rounds * len(payloads))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recorded', nargs='?',
+                        help='JSON file with recorded webhook bodies.')
+    parser.add_argument('-n', '--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.recorded:
+        payloads = load_recorded(args.recorded)
+    else:
+        random.seed(0)
+        payloads = [synthetic_gmo() for _ in range(5)]
+    if not payloads:
+        sys.exit('No GetMapObjects payloads found.')
+
+    # Both paths must see the same data.
+    assert ([decode_json(p) for p in payloads] ==
+            [decode_direct(p) for p in payloads])
+
+    json_secs = bench(decode_json, payloads, args.rounds)
+    direct_secs = bench(decode_direct, payloads, args.rounds)
+    print('payloads: %d, avg size: %d bytes' % (
+        len(payloads), sum(len(p) for p in payloads) / len(payloads)))
+    print('MessageToJson + json.loads: %8.3f ms/payload' % (json_secs * 1000))
+    print('direct proto access:        %8.3f ms/payload' % (
+        direct_secs * 1000))
+    print('speedup: %.1fx' % (json_secs / direct_secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmark for the teleport route planner.
+
+Compares the old route building in get_nearby_pokestops & co, which re-sorted
+all remaining points by Vincenty distance after every step, against
+pogom.routing's grid nearest neighbour search with and without the 2-opt
+pass, on random points spread over a city-sized area.
+
+Usage:
+    python tools/bench_routing.py [-n POINTS ...] [--size KM] [--legacy-max N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from collections import OrderedDict
+
+import geopy.distance
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from pogom.routing import plan_route  # noqa: E402
+from pogom.transform import haversine_distance  # noqa: E402
+
+
+def synthetic_points(n, size_km, lat=52.37, lng=4.89):
+    # Clustered like real stops: a few dense centers plus some noise.
+    deg = size_km / 111.0
+    centers = [(lat + random.uniform(-deg, deg) / 2,
+                lng + random.uniform(-deg, deg) / 2) for _ in range(12)]
+    points = []
+    for i in range(n):
+        if i % 4:
+            c = random.choice(centers)
+            points.append((c[0] + random.gauss(0, deg / 20),
+                           c[1] + random.gauss(0, deg / 20), i))
+        else:
+            points.append((lat + random.uniform(-deg, deg) / 2,
+                           lng + random.uniform(-deg, deg) / 2, i))
+    return points
+
+
+def legacy_route(points, lat, lng):
+    ordered = OrderedDict(sorted(
+        ((p[2], p) for p in points),
+        key=lambda x: geopy.distance.vincenty((lat, lng), x[1][:2]).km))
+    result = []
+    while len(ordered) > 0:
+        value = ordered.items()[0][1]
+        result.append(value)
+        newlat, newlong = value[0], value[1]
+        ordered.popitem(last=False)
+        ordered = OrderedDict(sorted(
+            ordered.items(),
+            key=lambda x: geopy.distance.vincenty(
+                (newlat, newlong), x[1][:2]).km))
+    return result
+
+
+def route_km(route, lat, lng):
+    total = 0
+    for p in route:
+        total += haversine_distance(lat, lng, p[0], p[1]) / 1000
+        lat, lng = p[0], p[1]
+    return total
+
+
+def run(name, func, points, lat, lng):
+    start = time.time()
+    route = func(points, lat, lng)
+    secs = time.time() - start
+    assert sorted(p[2] for p in route) == sorted(p[2] for p in points)
+    print('  %-22s %9.3f s  %9.1f km' % (
+        name, secs, route_km(route, lat, lng)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--points', type=int, nargs='+',
+                        default=[250, 1000, 5000, 20000])
+    parser.add_argument('--size', type=float, default=15,
+                        help='Width of the area in km.')
+    parser.add_argument('--legacy-max', type=int, default=1000,
+                        help='Skip the old planner above this many points.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    lat, lng = 52.37, 4.89
+    for n in args.points:
+        points = synthetic_points(n, args.size, lat, lng)
+        print('%d points in %.0f km:' % (n, args.size))
+        if n <= args.legacy_max:
+            run('vincenty resort', legacy_route, points, lat, lng)
+        run('grid nearest neighbour', plan_route, points, lat, lng)
+        run('grid nn + 2-opt',
+            lambda p, la, ln: plan_route(p, la, ln, improve=True),
+            points, lat, lng)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the map's viewport queries.
+
+Compares the old queries, a latitude/longitude box and a NOT over the
+previous box for panning, against the geocell ranges used by in_viewport
+and in_uncovered_area. Both return the same rows; the difference is how
+much of the table MySQL reads to find them.
+
+Usage:
+    python tools/bench_viewport_query.py [-n ROWS] [--rounds N] [--keep]
+                                         [RocketMap args...]
+
+Rows are written to a scratch table, bench_viewport, in the database from
+config/config.ini (or the RocketMap args given). The table is dropped
+afterwards unless --keep is given, in which case a later run with the same
+number of rows reuses it.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--rows', type=int, default=2000000,
+                    help='Rows in the scratch table.')
+parser.add_argument('--rounds', type=int, default=200)
+parser.add_argument('--keep', action='store_true',
+                    help='Keep the scratch table for the next run.')
+bench_args, sys.argv[1:] = parser.parse_known_args()
+
+from peewee import BigIntegerField, DoubleField, PrimaryKeyField  # noqa: E402
+from pogom.geocell import geocell  # noqa: E402
+from pogom.models import LatLongModel, init_database  # noqa: E402
+
+# Area the rows are spread over, roughly a large metro area.
+AREA = (52.0, 4.5, 52.6, 5.3)
+# Size of a viewport, a phone at street level.
+VIEW = (0.02, 0.035)
+
+
+class BenchViewport(LatLongModel):
+    id = PrimaryKeyField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+    geocell = BigIntegerField(index=True)
+
+    class Meta:
+        db_table = 'bench_viewport'
+        indexes = ((('latitude', 'longitude'), False),)
+
+
+def populate(db, rows, step=5000):
+    if BenchViewport.table_exists():
+        if BenchViewport.select().count() == rows:
+            print 'Reusing bench_viewport with {} rows.'.format(rows)
+            return
+        db.drop_tables([BenchViewport])
+    db.create_tables([BenchViewport])
+
+    start = time.time()
+    for i in range(0, rows, step):
+        batch = []
+        for _ in range(min(step, rows - i)):
+            lat = random.uniform(AREA[0], AREA[2])
+            lng = random.uniform(AREA[1], AREA[3])
+            batch.append({'latitude': lat, 'longitude': lng,
+                          'geocell': geocell(lat, lng)})
+        with db.atomic():
+            BenchViewport.insert_many(batch).execute()
+    db.execute_sql('ANALYZE TABLE `bench_viewport`;')
+    print 'Inserted {} rows in {:.1f}s.'.format(rows, time.time() - start)
+
+
+def random_view():
+    lat = random.uniform(AREA[0], AREA[2] - VIEW[0])
+    lng = random.uniform(AREA[1], AREA[3] - VIEW[1])
+    return (lat, lng, lat + VIEW[0], lng + VIEW[1])
+
+
+# The view after panning by up to half its size.
+def panned(view):
+    dlat = random.uniform(-0.5, 0.5) * VIEW[0]
+    dlng = random.uniform(-0.5, 0.5) * VIEW[1]
+    return (view[0] + dlat, view[1] + dlng, view[2] + dlat, view[3] + dlng)
+
+
+def viewport_queries(view, old):
+    m = BenchViewport
+    return {
+        'viewport, box': m.in_box(*view),
+        'viewport, geocell': m.in_viewport(*view),
+        'panned, NOT old box': m.in_box(*view) & ~m.in_box(*old),
+        'panned, geocell': m.in_uncovered_area(*(view + old))
+    }
+
+
+def run(where):
+    return len(list(BenchViewport.select(BenchViewport.id)
+                    .where(where).tuples()))
+
+
+def explain(db, where):
+    sql, params = BenchViewport.select(BenchViewport.id).where(where).sql()
+    cursor = db.execute_sql('EXPLAIN ' + sql, params)
+    columns = [c[0] for c in cursor.description]
+    for row in cursor.fetchall():
+        row = dict(zip(columns, row))
+        print '    type={} key={} rows={}'.format(
+            row.get('type'), row.get('key'), row.get('rows'))
+
+
+def main():
+    random.seed(0)
+    db = init_database(None)
+    populate(db, bench_args.rows)
+
+    views = []
+    for _ in range(bench_args.rounds):
+        old = random_view()
+        views.append((panned(old), old))
+
+    results = {}
+    for view, old in views:
+        counts = {}
+        for name, where in viewport_queries(view, old).items():
+            start = time.time()
+            counts[name] = run(where)
+            results[name] = (results.get(name, 0) +
+                             time.time() - start)
+        if (counts['viewport, box'] != counts['viewport, geocell'] or
+                counts['panned, NOT old box'] != counts['panned, geocell']):
+            print 'Row counts differ for {} / {}: {}'.format(view, old,
+                                                             counts)
+
+    print '{} rows, {} rounds:'.format(bench_args.rows, bench_args.rounds)
+    for name in sorted(results):
+        print '  {:<22} {:8.2f} ms/query'.format(
+            name, results[name] * 1000 / bench_args.rounds)
+
+    view, old = views[0]
+    for name, where in sorted(viewport_queries(view, old).items()):
+        print '  EXPLAIN {}:'.format(name)
+        explain(db, where)
+
+    if not bench_args.keep:
+        db.drop_tables([BenchViewport])
+
+
+if __name__ == '__main__':
+    main()